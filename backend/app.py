@@ -1,19 +1,67 @@
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
+import time
+import asyncio
+import importlib
+import threading
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from backend.contract_term_extraction import ContractTermExtractionAgent
-from backend.file_utils import extract_text_from_docx, read_tasks_from_csv, read_tasks_from_excel
+from backend.contract_diff import TERM_ADDED, TERM_CHANGED, TERM_REMOVED
+from backend.job_manager import JobManager
+from backend.job_store import JobStore, JOB_CANCELLED, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+from backend.metrics import current_session_id, http_request_duration, render_metrics, task_decisions, time_stage, trace
 from backend.models import (
     ContractUploadResponse,
     TaskUploadResponse,
-    TaskAnalysisResponse
+    TaskListItem,
+    TaskListResponse,
+    TaskAnalysisResponse,
+    TaskAnalysisStreamEvent,
+    AnalysisEstimateResponse,
+    JobStatusResponse,
+    JobResultsResponse,
+    JobTaskResult,
+    ReanalysisResponse
 )
 from backend.session_manager import create_session, get_session, set_session_data
-from backend.task_compliance_analysis import TaskComplianceAnalysisAgent, analyze_tasks_compliance
+from backend.token_budget import BudgetExceededError, token_budget
+from backend.upload_handling import (
+    PARSING_RETRY_AFTER,
+    ParsingPoolFullError,
+    UploadSizeLimitMiddleware,
+    UploadTooLargeError,
+    parsing_pool,
+    upload_too_large_response
+)
+
+
+# Set to false to load the agents on the first request that needs them instead of right after startup
+WARM_UP = os.getenv('CONTRACT_ANALYSIS_LLM_WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+# Modules that import LangChain, the OpenAI client or pandas. They are imported on first use, in a thread, so a worker
+# serves requests like /version as soon as it starts.
+LAZY_MODULES = ("backend.file_utils", "backend.task_compliance_analysis", "backend.incremental_analysis")
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Jobs that were interrupted by a restart continue where they left off
+    job_manager.resume_interrupted_jobs()
+    # The warm-up runs in the background, so it does not delay the startup
+    warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up)) if WARM_UP else None
+    yield
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    await job_manager.shutdown()
+    # Task results that are still written in the background are not lost
+    if task_compliance_analysis_agent is not None:
+        await task_compliance_analysis_agent.result_cache.flush()
+    parsing_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for all origins
 app.add_middleware(
@@ -26,9 +74,62 @@ app.add_middleware(
 
 __version__ = "0.1.0"
 
+# Maximum number of rows with an error that are listed in the response of /upload_tasks
+MAX_REPORTED_ROW_ERRORS = 100
+# Maximum number of tasks or results in a page of /get_tasks and /jobs/{job_id}/results
+MAX_PAGE_SIZE = 1000
+
+
+# Created on first use by create_agents. They can be replaced before that, e.g. by agents with a fake model.
+contract_term_extraction_agent = None
+task_compliance_analysis_agent = None
+agents_lock = threading.Lock()
+
+
+def create_agents():
+    global contract_term_extraction_agent, task_compliance_analysis_agent
+    with agents_lock:
+        if contract_term_extraction_agent is None:
+            from backend.contract_term_extraction import ContractTermExtractionAgent
+            contract_term_extraction_agent = ContractTermExtractionAgent()
+        if task_compliance_analysis_agent is None:
+            from backend.task_compliance_analysis import TaskComplianceAnalysisAgent
+            task_compliance_analysis_agent = TaskComplianceAnalysisAgent()
+
+
+def warm_up():
+    with time_stage("warm_up"):
+        create_agents()
+        for module_name in LAZY_MODULES:
+            importlib.import_module(module_name)
+
+
+async def get_contract_term_extraction_agent():
+    if contract_term_extraction_agent is None:
+        await asyncio.to_thread(create_agents)
+    return contract_term_extraction_agent
 
-contract_term_extraction_agent = ContractTermExtractionAgent()
-task_compliance_analysis_agent = TaskComplianceAnalysisAgent()
+
+async def get_task_compliance_analysis_agent():
+    if task_compliance_analysis_agent is None:
+        await asyncio.to_thread(create_agents)
+    return task_compliance_analysis_agent
+
+
+async def import_lazy_module(module_name: str):
+    # Importing in a thread keeps the event loop responsive while a module is imported for the first time
+    return await asyncio.to_thread(importlib.import_module, module_name)
+
+
+job_manager = JobManager(JobStore(), get_task_compliance_analysis_agent)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+
+@app.exception_handler(UploadTooLargeError)
+async def handle_upload_too_large(request: Request, e: UploadTooLargeError):
+    return upload_too_large_response()
 
 
 @app.middleware("http")
@@ -37,11 +138,21 @@ async def add_session_id(request: Request, call_next):
     if not session_id:
         session_id = create_session()
     request.state.session_id = session_id
+    # Trace logs and the tasks that are started by this request are correlated by the session
+    current_session_id.set(session_id)
 
     # Proceed to process the request
+    start = time.perf_counter()
     response = await call_next(request)
     response.set_cookie(key="session_id", value=session_id, httponly=True)
 
+    # The route template (e.g. /jobs/{job_id}) is used as label, so the number of label values stays small
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    duration = time.perf_counter() - start
+    http_request_duration.observe(duration, request.method, path, str(response.status_code))
+    trace("request=%s %s status=%d duration=%.4f", request.method, path, response.status_code, duration)
+
     return response
 
 
@@ -50,19 +161,33 @@ def version():
     return Response(content=__version__, media_type="text/plain")
 
 
+@app.get('/metrics')
+def metrics():
+    # Prometheus text format
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/upload_contract", response_model=ContractUploadResponse)
 async def upload_contract(request: Request, file: UploadFile = File(...)):
     try:
-        content = await file.read()
         filename = file.filename
         file_extension = os.path.splitext(filename)[1].lower()
 
+        # The upload is spooled to a temporary file, which is parsed in the parsing pool instead of the event loop
         if file_extension == '.docx':
-            contract_text = extract_text_from_docx(content)
+            file_utils = await import_lazy_module("backend.file_utils")
+            contract_text = await parsing_pool.run(file_utils.extract_text_from_docx, file.file)
         else:
             raise HTTPException(status_code=400, detail="Unsupported file type. Please upload a DOCX or TXT file.")
 
-        contract, contract_json = await contract_term_extraction_agent.extract_contract_terms(contract_text)
+        agent = await get_contract_term_extraction_agent()
+        if token_budget.enabled:
+            # Reads the cache and renders the prompts, so it runs in a thread
+            estimate = await asyncio.to_thread(agent.estimate_contract_terms_extraction, contract_text)
+            rejection = await admit_run(request.state.session_id, estimate.total_tokens)
+            if rejection is not None:
+                return rejection
+        contract, contract_json = await agent.extract_contract_terms(contract_text)
 
         # Store in session
         session_id = request.state.session_id
@@ -73,6 +198,8 @@ async def upload_contract(request: Request, file: UploadFile = File(...)):
             contract_filename=filename,
             contract_json=contract_json
         )
+    except ParsingPoolFullError as e:
+        return parsing_pool_full_response(e)
     except Exception as e:
         return JSONResponse(
             content={"message": f"An error occurred while processing the contract: {str(e)}"},
@@ -83,28 +210,41 @@ async def upload_contract(request: Request, file: UploadFile = File(...)):
 @app.post("/upload_tasks", response_model=TaskUploadResponse)
 async def upload_tasks(request: Request, file: UploadFile = File(...)):
     try:
-        content = await file.read()
         filename = file.filename
         file_extension = os.path.splitext(filename)[1].lower()
 
+        file_utils = await import_lazy_module("backend.file_utils")
         if file_extension == '.csv':
-            tasks = read_tasks_from_csv(content)
+            tasks, row_errors = await parsing_pool.run(file_utils.read_tasks_from_csv, file.file)
         elif file_extension == '.xlsx':
-            tasks = read_tasks_from_excel(content)
+            tasks, row_errors = await parsing_pool.run(file_utils.read_tasks_from_excel, file.file)
         else:
             return JSONResponse(
                 content={"message": "Unsupported file type. Please upload a CSV or XLSX file."},
                 status_code=400
             )
 
+        if not tasks:
+            return JSONResponse(
+                content={
+                    "message": "The file does not contain any valid tasks.",
+                    "row_errors": [row_error.model_dump() for row_error in row_errors[:MAX_REPORTED_ROW_ERRORS]]
+                },
+                status_code=400
+            )
+
         # Store tasks in session
         session_id = request.state.session_id
         set_session_data(session_id, "tasks", tasks)
 
         return TaskUploadResponse(
             message="Tasks uploaded successfully.",
-            tasks_uploaded=len(tasks)
+            tasks_uploaded=len(tasks),
+            rows_rejected=len(row_errors),
+            row_errors=row_errors[:MAX_REPORTED_ROW_ERRORS]
         )
+    except ParsingPoolFullError as e:
+        return parsing_pool_full_response(e)
     except Exception as e:
         return JSONResponse(
             content={"message": f"An error occurred while processing the tasks: {str(e)}"},
@@ -112,8 +252,10 @@ async def upload_tasks(request: Request, file: UploadFile = File(...)):
         )
 
 
-@app.get("/get_tasks")
-def get_tasks(request: Request):
+@app.get("/get_tasks", response_model=TaskListResponse)
+def get_tasks(request: Request, offset: int = Query(0, ge=0),
+              limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+              min_cost: Optional[float] = None, max_cost: Optional[float] = None):
     # Retrieve tasks from session
     session_id = request.state.session_id
     session_data = get_session(session_id)
@@ -125,7 +267,11 @@ def get_tasks(request: Request):
             status_code=404
         )
 
-    return {"tasks": tasks}
+    # Without a limit all matching tasks are returned
+    matching_tasks = [TaskListItem(index=index, **task) for index, task in enumerate(tasks)
+                      if is_cost_in_range(task['task_cost'], min_cost, max_cost)]
+    end = None if limit is None else offset + limit
+    return TaskListResponse(tasks=matching_tasks[offset:end], total=len(matching_tasks), offset=offset, limit=limit)
 
 
 @app.get("/analyze_tasks", response_model=TaskAnalysisResponse)
@@ -143,10 +289,259 @@ async def analyze_tasks(request: Request):
             status_code=400
         )
 
-    results = await analyze_tasks_compliance(contract_json, tasks, task_compliance_analysis_agent)
+    rejection = await admit_analysis(session_id, contract_json, tasks)
+    if rejection is not None:
+        return rejection
+
+    agent = await get_task_compliance_analysis_agent()
+    task_compliance_analysis = await import_lazy_module("backend.task_compliance_analysis")
+    results = await task_compliance_analysis.analyze_tasks_compliance(contract_json, tasks, agent)
     return results
 
 
+@app.get("/analyze_tasks_stream")
+async def analyze_tasks_stream(request: Request):
+    # Same as /analyze_tasks, but streams each result as a line of JSON (NDJSON) as soon as it is available
+    session_id = request.state.session_id
+    session_data = get_session(session_id)
+
+    contract_json = session_data.get("contract_json")
+    tasks = session_data.get("tasks")
+
+    if contract_json is None or not tasks:
+        return JSONResponse(
+            content={"message": "Contract and tasks must be uploaded before analysis."},
+            status_code=400
+        )
+
+    rejection = await admit_analysis(session_id, contract_json, tasks)
+    if rejection is not None:
+        return rejection
+
+    agent = await get_task_compliance_analysis_agent()
+    task_compliance_analysis = await import_lazy_module("backend.task_compliance_analysis")
+
+    async def stream_results():
+        completed = 0
+        async for task_index, result in task_compliance_analysis.iter_tasks_compliance(contract_json, tasks, agent):
+            completed += 1
+            event = TaskAnalysisStreamEvent(index=task_index, completed=completed, total=len(tasks), result=result)
+            yield event.model_dump_json() + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs", response_model=JobStatusResponse)
+async def submit_analysis_job(request: Request):
+    # Starts the analysis in the background. The results are checkpointed, so they survive a client disconnect.
+    session_id = request.state.session_id
+    session_data = get_session(session_id)
+
+    contract_json = session_data.get("contract_json")
+    tasks = session_data.get("tasks")
+
+    if contract_json is None or not tasks:
+        return JSONResponse(
+            content={"message": "Contract and tasks must be uploaded before analysis."},
+            status_code=400
+        )
+
+    rejection = await admit_analysis(session_id, contract_json, tasks)
+    if rejection is not None:
+        return rejection
+
+    job_id = job_manager.submit(session_id, contract_json, tasks)
+    return get_job_status_response(job_id, session_id)
+
+
+@app.get("/estimate_analysis", response_model=AnalysisEstimateResponse)
+async def estimate_analysis(request: Request):
+    # Dry run of /analyze_tasks: estimates the LLM requests, tokens and duration of the analysis, and the decision of
+    # the token budgets, without calling the LLM or charging the budgets
+    session_id = request.state.session_id
+    session_data = get_session(session_id)
+
+    contract_json = session_data.get("contract_json")
+    tasks = session_data.get("tasks")
+
+    if contract_json is None or not tasks:
+        return JSONResponse(
+            content={"message": "Contract and tasks must be uploaded before analysis."},
+            status_code=400
+        )
+
+    agent = await get_task_compliance_analysis_agent()
+    task_compliance_analysis = await import_lazy_module("backend.task_compliance_analysis")
+    estimate = await task_compliance_analysis.estimate_tasks_compliance(contract_json, tasks, agent)
+    admission = await asyncio.to_thread(token_budget.check, session_id, estimate.total_tokens)
+    return AnalysisEstimateResponse(
+        **estimate.model_dump(),
+        admission=admission.decision,
+        queue_wait_s=round(admission.wait, 1) if admission.wait is not None else None,
+        session_budget_remaining=admission.session_remaining,
+        global_budget_remaining=admission.global_remaining
+    )
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+def get_analysis_job(request: Request, job_id: str):
+    job_status = get_job_status_response(job_id, request.state.session_id)
+    if job_status is None:
+        return job_not_found_response()
+    return job_status
+
+
+@app.get("/jobs/{job_id}/results", response_model=JobResultsResponse)
+def get_analysis_job_results(request: Request, job_id: str, offset: int = Query(0, ge=0),
+                             limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                             compliance: Optional[bool] = None, ambiguous: Optional[bool] = None,
+                             min_cost: Optional[float] = None, max_cost: Optional[float] = None):
+    # Returns the results that are available so far, also while the job is still running. Without a limit all
+    # matching results are returned.
+    job_status = get_job_status_response(job_id, request.state.session_id)
+    if job_status is None:
+        return job_not_found_response()
+    results_filter = dict(compliance=compliance, ambiguous=ambiguous, min_cost=min_cost, max_cost=max_cost)
+    results = job_manager.store.get_results(job_id, offset=offset, limit=limit, **results_filter)
+    return JobResultsResponse(
+        **job_status.model_dump(),
+        results=[JobTaskResult(index=index, result=result) for index, result in results.items()],
+        total_results=job_manager.store.count_results(job_id, **results_filter),
+        offset=offset,
+        limit=limit
+    )
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobStatusResponse)
+async def cancel_analysis_job(request: Request, job_id: str):
+    session_id = request.state.session_id
+    job_status = get_job_status_response(job_id, session_id)
+    if job_status is None:
+        return job_not_found_response()
+    if not job_manager.cancel(job_id):
+        return JSONResponse(
+            content={"message": f"Job cannot be cancelled, because its status is '{job_status.status}'."},
+            status_code=409
+        )
+    return get_job_status_response(job_id, session_id)
+
+
+@app.post("/jobs/{job_id}/resume", response_model=JobStatusResponse)
+async def resume_analysis_job(request: Request, job_id: str):
+    # Runs only the tasks of the job that do not have a result yet, or whose analysis failed
+    session_id = request.state.session_id
+    job_status = get_job_status_response(job_id, session_id)
+    if job_status is None:
+        return job_not_found_response()
+    # A job that stopped is a new run for the budgets; queued and running jobs were admitted when they were submitted
+    if job_status.status in (JOB_FAILED, JOB_CANCELLED):
+        job = job_manager.store.get_job(job_id)
+        completed_indices = set(job_manager.store.get_result_indices(job_id))
+        missing_tasks = [task for i, task in enumerate(job['tasks']) if i not in completed_indices]
+        rejection = await admit_analysis(session_id, job['contract_json'], missing_tasks)
+        if rejection is not None:
+            return rejection
+    if not job_manager.resume(job_id):
+        return JSONResponse(
+            content={"message": f"Job cannot be resumed, because its status is '{job_status.status}'."},
+            status_code=409
+        )
+    return get_job_status_response(job_id, session_id)
+
+
+@app.post("/jobs/{job_id}/reanalyze", response_model=ReanalysisResponse)
+async def reanalyze_analysis_job(request: Request, job_id: str):
+    # Starts a new job for the tasks of a job with the contract in the session, e.g. after an amended contract was
+    # uploaded. Only the tasks that are affected by the changed terms are analyzed; the other results are carried over.
+    session_id = request.state.session_id
+    job = job_manager.store.get_job(job_id)
+    if job is None or job['session_id'] != session_id:
+        return job_not_found_response()
+    if job['status'] in (JOB_QUEUED, JOB_RUNNING):
+        return JSONResponse(
+            content={"message": f"Job cannot be reanalyzed, because its status is '{job['status']}'."},
+            status_code=409
+        )
+    contract_json = get_session(session_id).get("contract_json")
+    if contract_json is None:
+        return JSONResponse(
+            content={"message": "A contract must be uploaded before reanalysis."},
+            status_code=400
+        )
+
+    # Diffing and retrieval for thousands of tasks takes a while, so it runs outside the event loop
+    incremental_analysis = await import_lazy_module("backend.incremental_analysis")
+    plan = await asyncio.to_thread(incremental_analysis.plan_reanalysis, job['contract_json'], contract_json,
+                                   job['tasks'], job_manager.store.get_results(job_id))
+    rejection = await admit_analysis(session_id, contract_json, [job['tasks'][i] for i in plan.affected_indices])
+    if rejection is not None:
+        return rejection
+    task_decisions.inc("carried_over", amount=len(plan.carried_results))
+    new_job_id = job_manager.submit(session_id, contract_json, job['tasks'], results=plan.carried_results)
+    return ReanalysisResponse(
+        **get_job_status_response(new_job_id, session_id).model_dump(),
+        added_terms=plan.diff.count(TERM_ADDED),
+        removed_terms=plan.diff.count(TERM_REMOVED),
+        changed_terms=plan.diff.count(TERM_CHANGED),
+        changed_definitions=plan.diff.changed_definitions,
+        carried_over=len(plan.carried_results),
+        reanalyzed=len(plan.affected_indices)
+    )
+
+
+async def admit_analysis(session_id: str, contract_json: str, tasks: List[dict]) -> Optional[JSONResponse]:
+    # The analysis is estimated and charged to the token budgets before any LLM call is made. Returns the response
+    # for a rejected run.
+    if not token_budget.enabled or not tasks:
+        return None
+    agent = await get_task_compliance_analysis_agent()
+    task_compliance_analysis = await import_lazy_module("backend.task_compliance_analysis")
+    estimate = await task_compliance_analysis.estimate_tasks_compliance(contract_json, tasks, agent)
+    return await admit_run(session_id, estimate.total_tokens)
+
+
+async def admit_run(session_id: str, tokens: int) -> Optional[JSONResponse]:
+    # A run that does not fit the budgets yet waits for them, up to the maximum wait
+    try:
+        await token_budget.admit(session_id, tokens)
+    except BudgetExceededError as e:
+        return budget_exceeded_response(e)
+    return None
+
+
+def get_job_status_response(job_id: str, session_id: str):
+    # Jobs of other sessions are not found, so a job id alone does not give access to a job
+    job = job_manager.store.get_job_status(job_id)
+    if job is None or job['session_id'] != session_id:
+        return None
+    return JobStatusResponse(
+        job_id=job['id'],
+        status=job['status'],
+        total=job['total'],
+        completed=job['completed'],
+        failed=job['failed'],
+        error=job['error']
+    )
+
+
+def job_not_found_response():
+    return JSONResponse(content={"message": "Job not found."}, status_code=404)
+
+
+def parsing_pool_full_response(e: ParsingPoolFullError):
+    return JSONResponse(content={"message": str(e)}, status_code=503,
+                        headers={"Retry-After": str(PARSING_RETRY_AFTER)})
+
+
+def budget_exceeded_response(e: BudgetExceededError):
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+    return JSONResponse(content={"message": str(e)}, status_code=429, headers=headers)
+
+
+def is_cost_in_range(cost: float, min_cost: Optional[float], max_cost: Optional[float]) -> bool:
+    return (min_cost is None or cost >= min_cost) and (max_cost is None or cost <= max_cost)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="localhost", port=8008)
@@ -0,0 +1,108 @@
+import re
+from typing import List, Dict
+
+from backend.models import Contract, Section, Term
+
+
+# A line that starts a new part of the contract: a DOCX heading ("## Payment"), a numbered heading ("1.",
+# "2.3 Payment"), a keyword heading ("Article 4", "Amendment 1", "Schedule A") or a short line in capitals
+# ("DEFINITIONS").
+HEADING_PATTERN = re.compile(
+    r"^\s*(?:#{1,9}\s+\S"
+    r"|\d+(?:\.\d+)*\.?\s+\S"
+    r"|(?i:article|section|clause|amendment|schedule|annex|appendix|exhibit)\b"
+    r"|[A-Z][A-Z0-9 ,&'()\-]{2,80}$)"
+)
+
+
+def split_contract_text(contract_text: str, max_chars: int) -> List[str]:
+    # Split the text into blocks that each start with a heading, then pack consecutive blocks into chunks
+    blocks = []
+    current_block = []
+    for line in contract_text.splitlines():
+        if current_block and HEADING_PATTERN.match(line):
+            blocks.append('\n'.join(current_block))
+            current_block = []
+        current_block.append(line)
+    if current_block:
+        blocks.append('\n'.join(current_block))
+
+    chunks = []
+    current_chunk = ""
+    for block in blocks:
+        for part in split_oversized_block(block, max_chars):
+            if current_chunk and len(current_chunk) + len(part) + 1 > max_chars:
+                chunks.append(current_chunk)
+                current_chunk = ""
+            current_chunk = f"{current_chunk}\n{part}" if current_chunk else part
+    if current_chunk.strip():
+        chunks.append(current_chunk)
+    return chunks
+
+
+def split_oversized_block(block: str, max_chars: int) -> List[str]:
+    # A single section that does not fit in a chunk is split on line boundaries
+    if len(block) <= max_chars:
+        return [block]
+    parts = []
+    current_part = ""
+    for line in block.splitlines():
+        if current_part and len(current_part) + len(line) + 1 > max_chars:
+            parts.append(current_part)
+            current_part = ""
+        current_part = f"{current_part}\n{line}" if current_part else line
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+
+def merge_contracts(contracts: List[Contract]) -> Contract:
+    title = next((contract.title for contract in contracts if contract.title.strip()), "")
+
+    definitions: Dict[str, str] = {}
+    for contract in contracts:
+        for name, definition in contract.definitions.items():
+            if not definitions.get(name):
+                definitions[name] = definition
+
+    sections: List[Section] = []
+    for contract in contracts:
+        merge_sections(sections, contract.sections)
+
+    # Validate the merged contract again, so it is guaranteed to conform to the model
+    return Contract.model_validate({
+        "title": title,
+        "definitions": definitions,
+        "sections": [section.model_dump() for section in sections]
+    })
+
+
+def merge_sections(sections: List[Section], new_sections: List[Section]):
+    # A section that was split over two chunks is extracted twice with the same title: merge those into one section
+    for new_section in new_sections:
+        existing_section = find_section(sections, new_section.title)
+        if existing_section is None:
+            sections.append(new_section.model_copy(deep=True))
+        else:
+            merge_terms(existing_section.terms, new_section.terms)
+            merge_sections(existing_section.subsections, new_section.subsections)
+
+
+def find_section(sections: List[Section], title: str):
+    key = normalize_title(title)
+    if not key:
+        return None
+    return next((section for section in sections if normalize_title(section.title) == key), None)
+
+
+def merge_terms(terms: List[Term], new_terms: List[Term]):
+    existing_keys = {(normalize_title(term.title), term.content.strip()) for term in terms}
+    for term in new_terms:
+        key = (normalize_title(term.title), term.content.strip())
+        if key not in existing_keys:
+            terms.append(term.model_copy())
+            existing_keys.add(key)
+
+
+def normalize_title(title: str) -> str:
+    return re.sub(r"\s+", " ", title).strip().rstrip('.:').lower()
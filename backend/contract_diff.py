@@ -0,0 +1,97 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from backend.models import Contract, Term
+from backend.term_index import IndexedTerm, flatten_contract_terms
+
+
+TERM_ADDED = "added"
+TERM_REMOVED = "removed"
+TERM_CHANGED = "changed"
+
+
+# A term that was added, removed or changed. Positions are in the order of flatten_contract_terms of the old and the
+# new contract, so they match the positions of a TermIndex.
+class TermChange(NamedTuple):
+    kind: str
+    old_position: Optional[int]
+    new_position: Optional[int]
+
+
+class ContractDiff(NamedTuple):
+    old_terms: List[IndexedTerm]
+    new_terms: List[IndexedTerm]
+    changes: List[TermChange]
+    # Positions of the unchanged terms: old position -> new position. Terms that only moved or were renumbered by
+    # the term ids are unchanged.
+    unchanged_positions: Dict[int, int]
+    changed_definitions: List[str]
+
+    def count(self, kind: str) -> int:
+        return sum(change.kind == kind for change in self.changes)
+
+
+def diff_contracts(old_contract: Contract, new_contract: Contract) -> ContractDiff:
+    # Term ids are positions, so they change when a term is inserted. Terms are matched by their text instead:
+    # first identical terms, then terms with the same section and title, then terms with the same unique title.
+    old_terms = flatten_contract_terms(old_contract)
+    new_terms = flatten_contract_terms(new_contract)
+    unmatched_old = list(range(len(old_terms)))
+    unmatched_new = list(range(len(new_terms)))
+
+    unchanged_positions = match_terms(unmatched_old, unmatched_new, lambda indexed_term: term_fingerprint(
+        indexed_term.term), old_terms, new_terms)
+    changed_positions = match_terms(unmatched_old, unmatched_new, lambda indexed_term: (
+        tuple(normalize_text(title) for title in indexed_term.section_titles),
+        normalize_text(indexed_term.term.title)), old_terms, new_terms)
+    changed_positions.update(match_terms(unmatched_old, unmatched_new, lambda indexed_term: normalize_text(
+        indexed_term.term.title) or None, old_terms, new_terms, unique=True))
+
+    changes = [TermChange(TERM_CHANGED, old_position, new_position)
+               for old_position, new_position in sorted(changed_positions.items())]
+    changes += [TermChange(TERM_REMOVED, old_position, None) for old_position in unmatched_old]
+    changes += [TermChange(TERM_ADDED, None, new_position) for new_position in unmatched_new]
+
+    changed_definitions = sorted(
+        name for name in set(old_contract.definitions) | set(new_contract.definitions)
+        if normalize_text(old_contract.definitions.get(name) or "") !=
+        normalize_text(new_contract.definitions.get(name) or "")
+    )
+    return ContractDiff(old_terms, new_terms, changes, unchanged_positions, changed_definitions)
+
+
+def match_terms(unmatched_old: List[int], unmatched_new: List[int], get_key, old_terms: List[IndexedTerm],
+                new_terms: List[IndexedTerm], unique: bool = False) -> Dict[int, int]:
+    # Matches the unmatched terms with the same key in order, and removes them from the unmatched lists. With
+    # unique, a key only matches when it belongs to one old and one new term. A key of None never matches.
+    new_positions_by_key: Dict[object, List[int]] = {}
+    for new_position in unmatched_new:
+        new_positions_by_key.setdefault(get_key(new_terms[new_position]), []).append(new_position)
+    old_keys = {old_position: get_key(old_terms[old_position]) for old_position in unmatched_old}
+    old_key_counts: Dict[object, int] = {}
+    for key in old_keys.values():
+        old_key_counts[key] = old_key_counts.get(key, 0) + 1
+
+    matches = {}
+    for old_position in unmatched_old:
+        key = old_keys[old_position]
+        new_positions = new_positions_by_key.get(key)
+        if key is None or not new_positions:
+            continue
+        if unique and (old_key_counts[key] > 1 or len(new_positions) > 1):
+            continue
+        matches[old_position] = new_positions.pop(0)
+
+    matched_new = set(matches.values())
+    unmatched_old[:] = [position for position in unmatched_old if position not in matches]
+    unmatched_new[:] = [position for position in unmatched_new if position not in matched_new]
+    return matches
+
+
+def term_fingerprint(term: Term) -> Tuple[str, str]:
+    # Ignores the id, case, whitespace and punctuation, so an extraction that only differs in formatting matches
+    return normalize_text(term.title), normalize_text(term.content)
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join(re.findall(r"\w+", text.lower()))
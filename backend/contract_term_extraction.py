@@ -1,38 +1,149 @@
+import os
 import json
-from typing import Tuple
+import asyncio
+from typing import Tuple, Optional
 
 from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain.schema import BaseOutputParser
 from langchain_core.exceptions import OutputParserException
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
 from pydantic import ValidationError
 
-from backend.langchain_utils import invoke_chain_with_error_handling
-from backend.utils import extract_json_from_text
-from models import Contract
+from backend.contract_chunking import split_contract_text, merge_contracts
+from backend.disk_cache import DiskCache
+from backend.json_repair import load_json_with_repair, coerce_contract_data, record_repairs
+from backend.langchain_utils import ainvoke_chain_with_error_handling
+from backend.metrics import time_stage
+from backend.single_flight import SingleFlight
+from backend.term_index import assign_term_ids
+from backend.token_estimation import estimate_prompt_tokens, estimate_text_tokens, estimate_wall_time
+from backend.utils import extract_json_from_text, hash_text
+from backend.models import Contract, TokenEstimate
+
+
+# Bump the prompt version whenever the extraction prompt changes, so stale cache entries are no longer used
+EXTRACT_CONTRACT_TERMS_PROMPT_VERSION = "2"
+
+CONTRACT_CACHE_MAX_BYTES = int(os.getenv('CONTRACT_ANALYSIS_LLM_CONTRACT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+CONTRACT_CACHE_MAX_AGE = int(os.getenv('CONTRACT_ANALYSIS_LLM_CONTRACT_CACHE_MAX_AGE', 7 * 24 * 60 * 60))  # 7 days
+
+# Contracts longer than this are split into chunks that are extracted separately. Set to 0 to disable chunking.
+CONTRACT_CHUNK_CHARS = int(os.getenv('CONTRACT_ANALYSIS_LLM_CONTRACT_CHUNK_CHARS', 40000))
+
+# Tokens of the extracted JSON per token of contract text: the JSON restates the terms, with keys and indentation
+EXTRACTION_OUTPUT_TOKEN_RATIO = 1.3
 
 
 class ContractTermExtractionAgent:
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0.6)
+    def __init__(self, llm: Optional[BaseChatModel] = None):
+        # Another chat model can be passed in, e.g. a fake model for benchmarks. Retries are done by the retry policy
+        # in langchain_utils, so the client does not retry by itself.
+        self.llm = llm if llm is not None else ChatOpenAI(model="gpt-4o", temperature=0.6, max_retries=0)
         self.extract_contract_terms_chain = get_extract_contract_terms_chain(self.llm)
+        self.extract_contract_chunk_terms_chain = get_extract_contract_terms_chain(self.llm, chunked=True)
+        self.cache = DiskCache("contract_terms.sqlite3", CONTRACT_CACHE_MAX_BYTES, CONTRACT_CACHE_MAX_AGE)
+        self.in_flight = SingleFlight("extract_contract_terms")
 
-    async def extract_contract_terms(self, contract_text: str) -> Tuple[Contract, str]:
-        input_data = {
-            'contract_text': contract_text,
-            'extra_messages': []
-        }
-        contract_tuple = invoke_chain_with_error_handling(self.extract_contract_terms_chain, input_data)
-        return contract_tuple
-
+    def get_cache_key(self, contract_text: str) -> str:
+        if use_chunked_extraction(contract_text):
+            return hash_text(self.llm.model_name, EXTRACT_CONTRACT_TERMS_PROMPT_VERSION,
+                             f"chunked:{CONTRACT_CHUNK_CHARS}", contract_text)
+        return hash_text(self.llm.model_name, EXTRACT_CONTRACT_TERMS_PROMPT_VERSION, contract_text)
 
-def get_extract_contract_terms_chain(llm: ChatOpenAI):
+    async def extract_contract_terms(self, contract_text: str) -> Tuple[Contract, str]:
+        with time_stage("contract_extraction"):
+            cache_key = self.get_cache_key(contract_text)
+            # Concurrent uploads of the same contract share one extraction
+            return await self.in_flight.run(cache_key,
+                                            lambda: self.extract_contract_terms_cached(contract_text, cache_key))
+
+    async def extract_contract_terms_cached(self, contract_text: str, cache_key: str) -> Tuple[Contract, str]:
+        # SQLite blocks, so the cache is read and written in a thread
+        cached_contract_json = await asyncio.to_thread(self.cache.get, cache_key)
+        if cached_contract_json is not None:
+            # The cached JSON was validated before it was stored, but parse it again to get the Contract model
+            contract, contract_json = ContractJsonOutputParser().parse(cached_contract_json)
+        elif use_chunked_extraction(contract_text):
+            contract, contract_json = await self.extract_contract_terms_chunked(contract_text)
+        else:
+            input_data = {
+                'contract_text': contract_text,
+                'extra_messages': []
+            }
+            contract, contract_json = await ainvoke_chain_with_error_handling(self.extract_contract_terms_chain,
+                                                                              input_data, "extract_contract_terms")
+        # Every term gets a stable id, which the task analysis uses to refer to the term
+        if assign_term_ids(contract):
+            contract_json = contract.model_dump_json(indent=2)
+        if contract_json != cached_contract_json:
+            await asyncio.to_thread(self.cache.set, cache_key, contract_json)
+        return contract, contract_json
+
+    def estimate_contract_terms_extraction(self, contract_text: str) -> TokenEstimate:
+        # Estimates the calls of extract_contract_terms without calling the LLM. A cached contract needs no calls.
+        if self.cache.peek(self.get_cache_key(contract_text)) is not None:
+            return TokenEstimate()
+        if use_chunked_extraction(contract_text):
+            chunks = split_contract_text(contract_text, CONTRACT_CHUNK_CHARS)
+            prompt = self.extract_contract_chunk_terms_chain.first
+            inputs = [{'contract_text': chunk, 'part_number': i + 1, 'part_count': len(chunks), 'extra_messages': []}
+                      for i, chunk in enumerate(chunks)]
+            operation = "extract_contract_chunk_terms"
+        else:
+            prompt = self.extract_contract_terms_chain.first
+            inputs = [{'contract_text': contract_text, 'extra_messages': []}]
+            operation = "extract_contract_terms"
+        input_tokens = sum(estimate_prompt_tokens(prompt, input_data) for input_data in inputs)
+        output_tokens = round(sum(estimate_text_tokens(input_data['contract_text']) for input_data in inputs) *
+                              EXTRACTION_OUTPUT_TOKEN_RATIO)
+        return TokenEstimate(
+            llm_requests=len(inputs),
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=input_tokens + output_tokens,
+            wall_time_s=estimate_wall_time(len(inputs), input_tokens, operation)
+        )
+
+    async def extract_contract_terms_chunked(self, contract_text: str) -> Tuple[Contract, str]:
+        chunks = split_contract_text(contract_text, CONTRACT_CHUNK_CHARS)
+
+        async def extract_chunk(part_number: int, chunk: str) -> Contract:
+            input_data = {
+                'contract_text': chunk,
+                'part_number': part_number,
+                'part_count': len(chunks),
+                'extra_messages': []
+            }
+            chunk_contract, _ = await ainvoke_chain_with_error_handling(self.extract_contract_chunk_terms_chain,
+                                                                        input_data, "extract_contract_chunk_terms")
+            return chunk_contract
+
+        # Extract the chunks concurrently, then merge the partial contracts in the original order
+        chunk_contracts = await asyncio.gather(*(extract_chunk(i + 1, chunk) for i, chunk in enumerate(chunks)))
+        contract = merge_contracts(chunk_contracts)
+        return contract, contract.model_dump_json(indent=2)
+
+
+def use_chunked_extraction(contract_text: str) -> bool:
+    return 0 < CONTRACT_CHUNK_CHARS < len(contract_text)
+
+
+def get_extract_contract_terms_chain(llm: BaseChatModel, chunked: bool = False):
 
     # JSON in prompt has double brackets, which is needed as escape characters.
     # Otherwise, LangChain tries to parse the texts as variables.
 
+    if chunked:
+        context_text = """The following text is part {part_number} of {part_count} of a contract text containing various terms \
+and constraints for work execution. The other parts are processed separately, so only extract what is in this part. \
+If the title of the contract is not in this part, use an empty string as title. \
+Keep the titles of sections exactly as written in the text, so the parts can be merged afterwards."""
+    else:
+        context_text = "The following text is a contract text containing various terms and constraints for work execution."
+
     prompt_text = """### CONTEXT:
-The following text is a contract text containing various terms and constraints for work execution.
+""" + context_text + """
 
 %%%
 {contract_text}
@@ -44,6 +155,9 @@ Your task is to extract all definitions, sections and terms from the contract an
 ### GUIDELINES
 - Section may contain subsections, but this is not always the case.
 - Amendments can be treated as sections.
+- Lines starting with '#' are headings of the document. The number of '#' characters is the level of the heading.
+- Lines starting with '|' are rows of a table, with '|' between the cells. Tables often contain rates, caps and other \
+limits: include them in the terms.
 
 ### EXAMPLE
 This is an example of the desired output, unrelated to the contract text above.
@@ -98,7 +212,8 @@ class ContractJsonOutputParser(BaseOutputParser):
     def parse(self, text: str) -> Tuple[Contract, str]:
         try:
             text = extract_json_from_text(text)
-            data = json.loads(text)
+            # Mechanical errors are repaired locally, which avoids another round trip to the LLM
+            data, repairs = load_json_with_repair(text)
         except json.JSONDecodeError as e:
             raise OutputParserException(
                 error=f"Invalid JSON format: {e}",
@@ -106,8 +221,9 @@ class ContractJsonOutputParser(BaseOutputParser):
                 llm_output=text,
                 send_to_llm=True
             )
+        repairs += coerce_contract_data(data)
         try:
-            contract = Contract(**data)
+            contract = Contract.model_validate(data)
         except ValidationError as e:
             raise OutputParserException(
                 error=f"JSON does not conform to the expected structure: {e}",
@@ -115,4 +231,7 @@ class ContractJsonOutputParser(BaseOutputParser):
                 llm_output=text,
                 send_to_llm=True
             )
+        if repairs:
+            record_repairs("contract", repairs)
+            text = contract.model_dump_json(indent=2)
         return contract, text
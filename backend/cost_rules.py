@@ -0,0 +1,129 @@
+import re
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+
+from backend.models import TaskAnalysisResult, Term
+from backend.term_index import IndexedTerm, TermIndex, tokenize
+
+
+MAXIMUM_PATTERN = (r"(?:must|shall|may|will|can|does|do|should)\s+not\s+exceed|not\s+to\s+exceed|cannot\s+exceed"
+                   r"|no\s+more\s+than|not\s+more\s+than|(?:a\s+)?maximum(?:\s+of)?|at\s+most|up\s+to|capped\s+at"
+                   r"|limited\s+to|(?:a\s+)?cap\s+of|ceiling\s+of")
+MINIMUM_PATTERN = r"at\s+least|(?:a\s+)?minimum(?:\s+of)?|no\s+less\s+than|not\s+less\s+than"
+# Only amounts with a currency are treated as cost limits, so "3 nights" or "10 days" are not
+AMOUNT_PATTERN = (r"(?:[$€£]|USD|EUR|GBP)\s?\d[\d,]*(?:\.\d+)?"
+                  r"|\d[\d,]*(?:\.\d+)?\s?(?:USD|EUR|GBP|dollars|euros|pounds)")
+LIMIT_PATTERN = re.compile(
+    rf"(?P<keyword>{MAXIMUM_PATTERN}|{MINIMUM_PATTERN})\W+(?:\w+\W+){{0,4}}?(?P<amount>{AMOUNT_PATTERN})",
+    re.IGNORECASE
+)
+# Terms with exceptions, approvals, rates or limits over several tasks cannot be decided for a single task
+QUALIFIER_PATTERN = re.compile(
+    r"unless|except|approv|provided\s+that|subject\s+to|may\s+exceed|discretion|per\s+(?:hour|day|night|person|km|mile"
+    r"|year|month|quarter|week)|hourly|daily|weekly|monthly|annual|aggregate|cumulative|combined|%|percent",
+    re.IGNORECASE
+)
+# Words of term and section titles that say that a term is a limit, but not what it limits
+GENERIC_SUBJECT_WORDS = {
+    "cap", "capped", "limit", "limitation", "maximum", "minimum", "ceiling", "cost", "expense", "expenditure", "budget",
+    "total", "amount", "price", "fee", "charge", "spend", "spending", "payment", "financial", "constraint",
+    "restriction", "rule", "policy", "term", "condition", "provision", "requirement", "general"
+}
+
+
+class CostRule(NamedTuple):
+    term: Term
+    limit: float
+    is_maximum: bool
+    # Words of the titles that name what the rule limits, e.g. "travel" for "Budget Caps" under "Travel Provisions"
+    subject_tokens: FrozenSet[str]
+
+
+def parse_limit_amount(amount: str) -> float:
+    return float(re.sub(r"[^\d.]", "", amount.replace(',', '')))
+
+
+def get_subject_tokens(indexed_term: IndexedTerm) -> FrozenSet[str]:
+    # The title of the term names the subject, unless it only says that the term is a limit (e.g. "Budget Caps"),
+    # then the title of its section does
+    for title in (indexed_term.term.title,) + indexed_term.section_titles[::-1]:
+        subject_tokens = frozenset(token for token in tokenize(title)
+                                   if token not in GENERIC_SUBJECT_WORDS and not token.isdigit())
+        if subject_tokens:
+            return subject_tokens
+    return frozenset()
+
+
+def compile_cost_rule(indexed_term: IndexedTerm) -> Optional[CostRule]:
+    term = indexed_term.term
+    text = f"{term.title} {term.content}"
+    if QUALIFIER_PATTERN.search(text):
+        return None
+    matches = list(LIMIT_PATTERN.finditer(term.content))
+    # A term with several limits needs interpretation, so it is left to the LLM
+    if len(matches) != 1:
+        return None
+    match = matches[0]
+    is_maximum = re.fullmatch(MAXIMUM_PATTERN, match.group('keyword'), re.IGNORECASE) is not None
+    return CostRule(term=term, limit=parse_limit_amount(match.group('amount')), is_maximum=is_maximum,
+                    subject_tokens=get_subject_tokens(indexed_term))
+
+
+# Decides tasks locally when the only contract terms that match the task are simple cost limits, the best match names
+# the subject of the task in its titles, and the cost is clearly below or above the limits. All other tasks are left to
+# the LLM.
+class CostRuleEngine:
+    def __init__(self, term_index: TermIndex, margin: float):
+        self.term_index = term_index
+        self.margin = margin
+        self.rules: Dict[int, CostRule] = {}
+        for position, indexed_term in enumerate(term_index.terms):
+            rule = compile_cost_rule(indexed_term)
+            if rule is not None:
+                self.rules[position] = rule
+
+    def decide(self, task_description: str, task_cost: float) -> Optional[TaskAnalysisResult]:
+        if not self.rules:
+            return None
+        hits = self.term_index.search(task_description, len(self.term_index.terms))
+        if not hits or any(position not in self.rules for position, _ in hits):
+            return None
+        # BM25 matches on any shared word, e.g. "single" or "event", so only the rules whose subject the task
+        # mentions apply, and the task is left to the LLM when the best match is not one of them
+        task_tokens = set(tokenize(task_description))
+        rules = [self.rules[position] for position, _ in hits if self.rules[position].subject_tokens & task_tokens]
+        if not rules or rules[0] is not self.rules[hits[0][0]]:
+            return None
+        reasons = []
+        compliance = True
+        for rule in rules:
+            if rule.is_maximum:
+                clearly_satisfied = task_cost <= rule.limit * (1 - self.margin)
+                clearly_violated = task_cost > rule.limit * (1 + self.margin)
+                relation = "does not exceed" if clearly_satisfied else "exceeds"
+            else:
+                clearly_satisfied = task_cost >= rule.limit * (1 + self.margin)
+                clearly_violated = task_cost < rule.limit * (1 - self.margin)
+                relation = "meets" if clearly_satisfied else "is below"
+            if not clearly_satisfied and not clearly_violated:
+                # Too close to the limit to decide without interpretation
+                return None
+            compliance = compliance and clearly_satisfied
+            limit_name = "maximum" if rule.is_maximum else "minimum"
+            reasons.append(f"The cost of {task_cost:,.2f} {relation} the {limit_name} of {rule.limit:,.2f} "
+                           f"in '{rule.term.title}'.")
+
+        return TaskAnalysisResult(
+            task_description=task_description,
+            task_cost=task_cost,
+            applicable_terms=[rule.term for rule in rules],
+            reasoning=' '.join(reasons),
+            compliance=compliance,
+            ambiguous=False,
+            decided_by="rules"
+        )
+
+
+def find_cost_limits(term_index: TermIndex) -> List[float]:
+    # All limits of the contract, also those in terms that the rules leave to the LLM
+    return sorted({parse_limit_amount(match.group('amount')) for indexed_term in term_index.terms
+                   for match in LIMIT_PATTERN.finditer(indexed_term.term.content)})
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from backend.metrics import cache_requests
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv('CONTRACT_ANALYSIS_LLM_CACHE_DIR', '.cache')
+# Expired entries are removed, and the size of the cache is counted again, at most this often. Other workers write
+# to the same cache, so the size that a worker keeps track of is only exact after a count.
+CACHE_EVICTION_INTERVAL = 60  # seconds
+# Eviction removes entries until the cache is this fraction of its maximum size, so it is not needed on every write
+CACHE_EVICTION_TARGET = 0.9
+# Number of keys per query; SQLite limits the number of parameters of a statement
+CACHE_QUERY_KEYS = 500
+
+
+# Small persistent key-value store backed by SQLite. Entries older than max_age seconds are dropped, and when the
+# total size exceeds max_bytes the least recently used entries are evicted.
+class DiskCache:
+
+    def __init__(self, filename: str, max_bytes: int, max_age: float):
+        self.path = os.path.join(CACHE_DIR, filename)
+        self.name = os.path.splitext(filename)[0]
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Total size of the entries, counted on the first write and kept up to date by the writes of this worker
+        self.total_size: Optional[int] = None
+        self.next_eviction = 0.0
+        self.size_lock = threading.Lock()
+        # Writes of set_later that are not written yet, and the write that runs in a thread
+        self.pending_writes: Dict[str, str] = {}
+        self.write_task: Optional[asyncio.Task] = None
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        # Looks up many keys with one connection. Blocks on SQLite, so async code runs it in a thread.
+        values = self._get_pending(keys)
+        values.update(self._get_many([key for key in keys if key not in values], touch=True))
+        cache_requests.inc(self.name, "hit", amount=len(values))
+        cache_requests.inc(self.name, "miss", amount=len(keys) - len(values))
+        return values
+
+    def peek(self, key: str) -> Optional[str]:
+        return self.peek_many([key]).get(key)
+
+    def peek_many(self, keys: List[str]) -> Dict[str, str]:
+        # Like get_many, but neither counted in the metrics nor marked as used, e.g. for estimates
+        values = self._get_pending(keys)
+        values.update(self._get_many([key for key in keys if key not in values], touch=False))
+        return values
+
+    def _get_pending(self, keys: List[str]) -> Dict[str, str]:
+        # Runs in a thread while the event loop removes written entries, so each key is read only once
+        values = {}
+        for key in keys:
+            value = self.pending_writes.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _get_many(self, keys: List[str], touch: bool) -> Dict[str, str]:
+        if not keys:
+            return {}
+        now = time.time()
+        values = {}
+        expired_keys = []
+        with self._connect() as conn:
+            for key_chunk in chunks(keys, CACHE_QUERY_KEYS):
+                placeholders = ', '.join('?' * len(key_chunk))
+                for key, value, created_at in conn.execute(
+                        f"SELECT key, value, created_at FROM cache_entries WHERE key IN ({placeholders})", key_chunk):
+                    if now - created_at >= self.max_age:
+                        expired_keys.append((key,))
+                    else:
+                        values[key] = value
+            if touch:
+                conn.executemany("DELETE FROM cache_entries WHERE key = ?", expired_keys)
+                conn.executemany("UPDATE cache_entries SET accessed_at = ? WHERE key = ?",
+                                 [(now, key) for key in values])
+        return values
+
+    def set(self, key: str, value: str):
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, str]):
+        # Writes many entries in one transaction. Blocks on SQLite, so async code runs it in a thread.
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, value, len(value.encode('utf-8')), now, now) for key, value in items.items()]
+        with self._connect() as conn:
+            replaced_size = 0
+            for key_chunk in chunks(list(items), CACHE_QUERY_KEYS):
+                placeholders = ', '.join('?' * len(key_chunk))
+                replaced_size += conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM cache_entries WHERE key IN ({placeholders})", key_chunk
+                ).fetchone()[0]
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache_entries (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            with self.size_lock:
+                if self.total_size is None:
+                    self.total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                else:
+                    self.total_size += sum(row[2] for row in rows) - replaced_size
+                if self.total_size > self.max_bytes or now >= self.next_eviction:
+                    self._evict(conn, now)
+
+    def set_later(self, key: str, value: str):
+        # Writes the entry in the background, so the event loop does not wait for SQLite. The entries that are set
+        # while a write runs are written together by the next write. Must be called on the event loop.
+        self.pending_writes[key] = value
+        if self.write_task is None:
+            self.write_task = asyncio.create_task(self._write_pending())
+
+    async def flush(self):
+        # Waits until the entries of set_later are written
+        while self.write_task is not None:
+            await asyncio.shield(self.write_task)
+
+    async def _write_pending(self):
+        try:
+            while self.pending_writes:
+                items = dict(self.pending_writes)
+                try:
+                    await asyncio.to_thread(self.set_many, items)
+                except sqlite3.Error as e:
+                    # The cache only saves LLM calls, so the entries are dropped instead of failing the analysis
+                    logger.warning("Could not write %d entries to the %s cache: %s", len(items), self.name, e)
+                finally:
+                    # Entries that were set again during the write keep their newer value
+                    for key, value in items.items():
+                        if self.pending_writes.get(key) is value:
+                            del self.pending_writes[key]
+        finally:
+            self.write_task = None
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        # Called with the size lock held
+        conn.execute("DELETE FROM cache_entries WHERE created_at <= ?", (now - self.max_age,))
+        self.total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        self.next_eviction = now + CACHE_EVICTION_INTERVAL
+        if self.total_size <= self.max_bytes:
+            return
+        # Evict the least recently used entries until the cache is below its target size
+        target_size = self.max_bytes * CACHE_EVICTION_TARGET
+        expired_keys = []
+        for key, size in conn.execute("SELECT key, size FROM cache_entries ORDER BY accessed_at"):
+            if self.total_size <= target_size:
+                break
+            expired_keys.append((key,))
+            self.total_size -= size
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?", expired_keys)
+
+
+def chunks(items: List[str], size: int) -> Iterable[List[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -1,35 +1,220 @@
+import os
+import re
+import zipfile
 from io import BytesIO
-from docx import Document
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from xml.etree import ElementTree
 import pandas as pd
 
+from backend.metrics import time_stage
+from backend.models import TaskRowError
 
-def extract_text_from_docx(file_content: bytes) -> str:
-    document = Document(BytesIO(file_content))
-    text = '\n'.join([para.text for para in document.paragraphs])
+
+TASK_DESCRIPTION_COLUMN = 'Task Description'
+AMOUNT_COLUMN = 'Amount'
+TASK_COLUMNS = (TASK_DESCRIPTION_COLUMN, AMOUNT_COLUMN)
+# CSV files are parsed in chunks of this number of rows, so large files never become one big data frame
+TASKS_CSV_CHUNK_ROWS = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASKS_CSV_CHUNK_ROWS', 50000))
+
+# Currency symbols, ISO currency codes, whitespace and apostrophes (used as thousands separator in e.g. 1'000)
+AMOUNT_NOISE_PATTERN = r"[$€£¥₹₩₽¢'\s]|\b[A-Za-z]{3}\b"
+# A single comma that is not followed by exactly three digits is a decimal comma, e.g. 12,5 or 1234,50
+DECIMAL_COMMA_PATTERN = r"^-?\d*,(?:\d{1,2}|\d{4,})$"
+
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+BODY_TAG = WORD_NAMESPACE + 'body'
+PARAGRAPH_TAG = WORD_NAMESPACE + 'p'
+TABLE_TAG = WORD_NAMESPACE + 'tbl'
+TABLE_ROW_TAG = WORD_NAMESPACE + 'tr'
+TABLE_CELL_TAG = WORD_NAMESPACE + 'tc'
+TEXT_TAG = WORD_NAMESPACE + 't'
+VAL_ATTRIBUTE = WORD_NAMESPACE + 'val'
+# Elements inside a paragraph that are rendered as whitespace, like python-docx does
+WHITESPACE_TAGS = {WORD_NAMESPACE + 'tab': '\t', WORD_NAMESPACE + 'br': '\n', WORD_NAMESPACE + 'cr': '\n'}
+HEADING_STYLE_PATTERN = re.compile(r"^heading ([1-9])$", re.IGNORECASE)
+# outlineLvl 9 means body text
+BODY_TEXT_OUTLINE_LEVEL = 9
+
+
+# Uploads are passed as the (spooled) file, so a large upload is not copied into memory; bytes are accepted as well
+FileContent = Union[bytes, BinaryIO]
+
+
+# A paragraph, heading or table row of a DOCX document, in the order of the document body
+class DocxBlock(NamedTuple):
+    kind: str  # 'paragraph', 'heading' or 'table_row'
+    text: str
+    heading_level: Optional[int] = None
+    cells: Optional[List[str]] = None
+
+
+def extract_text_from_docx(file_content: FileContent) -> str:
+    # Headings are marked with '#' per level and table rows are written as '| cell | cell |', so the structure of
+    # the document is kept in the text
+    with time_stage("docx_parsing"):
+        lines = []
+        for block in iter_docx_blocks(file_content):
+            if block.kind == 'heading':
+                lines.append(f"{'#' * block.heading_level} {block.text}")
+            elif block.kind == 'table_row':
+                lines.append("| " + " | ".join(cell.replace('\n', ' ') for cell in block.cells) + " |")
+            else:
+                lines.append(block.text)
+        text = '\n'.join(lines)
     return text
 
 
-def read_tasks_from_csv(file_content: bytes) -> list:
-    df = pd.read_csv(BytesIO(file_content))
-    tasks = process_tasks_dataframe(df)
-    return tasks
+def iter_docx_blocks(file_content: FileContent) -> Iterator[DocxBlock]:
+    # Reads word/document.xml incrementally instead of building the python-docx object model. Every element of the
+    # body is dropped as soon as it has been processed, so the memory use does not grow with the document.
+    with zipfile.ZipFile(open_file_content(file_content)) as docx_file:
+        heading_styles = read_heading_styles(docx_file)
+        with docx_file.open('word/document.xml') as document_xml:
+            parents = []
+            table_depth = 0
+            for event, element in ElementTree.iterparse(document_xml, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    if element.tag == TABLE_TAG:
+                        table_depth += 1
+                    continue
+
+                parents.pop()
+                if element.tag == PARAGRAPH_TAG and table_depth == 0:
+                    heading_level = get_heading_level(element, heading_styles)
+                    text = get_paragraph_text(element)
+                    if heading_level is not None and text.strip():
+                        yield DocxBlock('heading', text, heading_level=heading_level)
+                    else:
+                        yield DocxBlock('paragraph', text)
+                elif element.tag == TABLE_ROW_TAG and table_depth == 1:
+                    # Nested tables are part of the text of the cell that contains them
+                    cells = ['\n'.join(get_paragraph_text(paragraph) for paragraph in cell.iter(PARAGRAPH_TAG)).strip()
+                             for cell in element.findall(TABLE_CELL_TAG)]
+                    if any(cell.strip() for cell in cells):
+                        yield DocxBlock('table_row', " | ".join(cells), cells=cells)
+                elif element.tag == TABLE_TAG:
+                    table_depth -= 1
+
+                if parents and parents[-1].tag == BODY_TAG:
+                    parents[-1].remove(element)
+
+
+def read_heading_styles(docx_file: zipfile.ZipFile) -> Dict[str, int]:
+    # Maps style ids to heading levels. The ids are localized (e.g. "Kop1" in Dutch), but the style names and outline
+    # levels are not.
+    try:
+        styles_xml = docx_file.read('word/styles.xml')
+    except KeyError:
+        return {}
+    heading_styles = {}
+    for style in ElementTree.fromstring(styles_xml).iter(WORD_NAMESPACE + 'style'):
+        style_id = style.get(WORD_NAMESPACE + 'styleId')
+        name = style.find(WORD_NAMESPACE + 'name')
+        outline_level = style.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}outlineLvl")
+        name_match = HEADING_STYLE_PATTERN.match(name.get(VAL_ATTRIBUTE, '')) if name is not None else None
+        if name_match:
+            heading_styles[style_id] = int(name_match.group(1))
+        elif name is not None and name.get(VAL_ATTRIBUTE, '').lower() == 'title':
+            heading_styles[style_id] = 1
+        elif outline_level is not None and int(outline_level.get(VAL_ATTRIBUTE, 0)) < BODY_TEXT_OUTLINE_LEVEL:
+            heading_styles[style_id] = int(outline_level.get(VAL_ATTRIBUTE, 0)) + 1
+    return heading_styles
+
+
+def get_heading_level(paragraph: ElementTree.Element, heading_styles: Dict[str, int]) -> Optional[int]:
+    outline_level = paragraph.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}outlineLvl")
+    if outline_level is not None:
+        level = int(outline_level.get(VAL_ATTRIBUTE, 0))
+        return level + 1 if level < BODY_TEXT_OUTLINE_LEVEL else None
+    style = paragraph.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}pStyle")
+    return heading_styles.get(style.get(VAL_ATTRIBUTE)) if style is not None else None
+
+
+def get_paragraph_text(paragraph: ElementTree.Element) -> str:
+    # Paragraphs nested in this one (e.g. in a text box) are yielded separately, so their text is skipped here
+    parts = []
+    elements = list(reversed(paragraph))
+    while elements:
+        element = elements.pop()
+        if element.tag == TEXT_TAG:
+            parts.append(element.text or '')
+        elif element.tag in WHITESPACE_TAGS:
+            parts.append(WHITESPACE_TAGS[element.tag])
+        elif element.tag != PARAGRAPH_TAG:
+            elements.extend(reversed(element))
+    return ''.join(parts)
+
+
+def read_tasks_from_csv(file_content: FileContent) -> Tuple[list, List[TaskRowError]]:
+    with time_stage("tasks_parsing"):
+        tasks = []
+        row_errors = []
+        # All cells are read as text, so amounts are normalized the same way regardless of their format
+        reader = pd.read_csv(open_file_content(file_content), usecols=lambda column: column in TASK_COLUMNS, dtype=str,
+                             chunksize=TASKS_CSV_CHUNK_ROWS)
+        for df in reader:
+            chunk_tasks, chunk_row_errors = process_tasks_dataframe(df)
+            tasks += chunk_tasks
+            row_errors += chunk_row_errors
+    return tasks, row_errors
+
+
+def read_tasks_from_excel(file_content: FileContent) -> Tuple[list, List[TaskRowError]]:
+    with time_stage("tasks_parsing"):
+        df = pd.read_excel(open_file_content(file_content), usecols=lambda column: column in TASK_COLUMNS, dtype=str)
+        tasks, row_errors = process_tasks_dataframe(df)
+    return tasks, row_errors
+
+
+def open_file_content(file_content: FileContent) -> BinaryIO:
+    return BytesIO(file_content) if isinstance(file_content, bytes) else file_content
+
+
+def process_tasks_dataframe(df: pd.DataFrame) -> Tuple[list, List[TaskRowError]]:
+    missing_columns = [column for column in TASK_COLUMNS if column not in df.columns]
+    if missing_columns:
+        raise ValueError(f"The file must contain the columns 'Task Description' and 'Amount'. "
+                         f"Missing: {', '.join(missing_columns)}.")
+
+    task_descriptions = df[TASK_DESCRIPTION_COLUMN].str.strip()
+    task_costs = normalize_amounts(df[AMOUNT_COLUMN])
+    missing_description = task_descriptions.isna() | (task_descriptions == '')
+    invalid_amount = task_costs.isna()
+
+    valid_rows = ~missing_description & ~invalid_amount
+    tasks = [
+        {"task_description": task_description, "task_cost": task_cost}
+        for task_description, task_cost in zip(task_descriptions[valid_rows].tolist(), task_costs[valid_rows].tolist())
+    ]
+
+    row_errors = []
+    for index in df.index[missing_description | invalid_amount]:
+        # Row numbers as shown in a spreadsheet: the header is row 1
+        row_number = int(index) + 2
+        if missing_description[index]:
+            row_errors.append(TaskRowError(row=row_number, message="The task description is empty."))
+        else:
+            row_errors.append(TaskRowError(row=row_number, message=f"Invalid amount: '{df[AMOUNT_COLUMN][index]}'."))
+    return tasks, row_errors
 
 
-def read_tasks_from_excel(file_content: bytes) -> list:
-    df = pd.read_excel(BytesIO(file_content))
-    tasks = process_tasks_dataframe(df)
-    return tasks
+def normalize_amounts(amounts: pd.Series) -> pd.Series:
+    # Converts amounts like "$1,234.50", "€ 1.234,50", "1 234,50 EUR" or "(500)" to floats. Amounts that cannot be
+    # parsed become NaN.
+    amounts = amounts.astype("string").str.replace(AMOUNT_NOISE_PATTERN, '', regex=True)
+    # Accounting notation for negative amounts
+    amounts = amounts.str.replace(r"^\((.*)\)$", r"-\1", regex=True)
 
+    # The separator that comes last is the decimal separator when both are used, e.g. 1.234,50 and 1,234.50
+    last_comma = amounts.str.rfind(',')
+    last_dot = amounts.str.rfind('.')
+    decimal_comma = ((last_dot >= 0) & (last_comma > last_dot)) | amounts.str.match(DECIMAL_COMMA_PATTERN)
+    # A dot that occurs more than once can only be a thousands separator, e.g. 1.234.567
+    thousands_dot = decimal_comma | (amounts.str.count(r'\.') > 1)
 
-def process_tasks_dataframe(df: pd.DataFrame) -> list:
-    tasks = []
-    for index, row in df.iterrows():
-        task_description = row['Task Description']
-        amount_str = str(row['Amount'])
-        # Remove any currency symbols and commas, and convert to float
-        task_cost = float(amount_str.replace('$', '').replace(',', '').strip())
-        tasks.append({
-            "task_description": task_description,
-            "task_cost": task_cost
-        })
-    return tasks
+    amounts = amounts.where(~thousands_dot, amounts.str.replace('.', '', regex=False))
+    amounts = amounts.where(decimal_comma, amounts.str.replace(',', '', regex=False))
+    amounts = amounts.where(~decimal_comma, amounts.str.replace(',', '.', regex=False))
+    return pd.to_numeric(amounts, errors='coerce').astype(float)
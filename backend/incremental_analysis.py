@@ -0,0 +1,79 @@
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from backend.contract_diff import ContractDiff, diff_contracts, normalize_text, term_fingerprint
+from backend.models import TaskAnalysisResult, Term
+from backend.task_compliance_analysis import RETRIEVAL_TOP_K
+from backend.term_index import TermIndex
+
+
+class ReanalysisPlan(NamedTuple):
+    diff: ContractDiff
+    # Results of the tasks that are not affected by the changes, with their terms taken from the new contract
+    carried_results: Dict[int, TaskAnalysisResult]
+    affected_indices: List[int]
+
+
+def plan_reanalysis(old_contract_json: str, new_contract_json: str, tasks: List[dict],
+                    previous_results: Dict[int, TaskAnalysisResult]) -> ReanalysisPlan:
+    # A task is analyzed again when it has no previous result or its analysis failed, or when one of its previous
+    # applicable terms, or one of the terms that retrieval selects for it in the old or the new contract, was added,
+    # removed or changed.
+    # Changed definitions affect the tasks that mention them, directly or in one of those terms.
+    old_index = TermIndex.from_contract_json(old_contract_json)
+    new_index = TermIndex.from_contract_json(new_contract_json)
+    diff = diff_contracts(old_index.contract, new_index.contract)
+
+    changed_old_positions = {change.old_position for change in diff.changes if change.old_position is not None}
+    changed_new_positions = {change.new_position for change in diff.changes if change.new_position is not None}
+    # The previous results refer to the terms of the old contract, which are mapped by their text
+    new_terms_by_fingerprint = {
+        term_fingerprint(diff.old_terms[old_position].term): diff.new_terms[new_position].term
+        for old_position, new_position in diff.unchanged_positions.items()
+    }
+    changed_definitions = [normalize_text(name) for name in diff.changed_definitions if normalize_text(name)]
+
+    carried_results = {}
+    affected_indices = []
+    for task_index, task in enumerate(tasks):
+        previous_result = previous_results.get(task_index)
+        carried_terms = None
+        if previous_result is not None and not previous_result.failed:
+            carried_terms = get_carried_terms(previous_result, new_terms_by_fingerprint)
+        if carried_terms is None:
+            affected_indices.append(task_index)
+            continue
+
+        old_positions = old_index.relevant_positions([task['task_description']], RETRIEVAL_TOP_K)
+        new_positions = new_index.relevant_positions([task['task_description']], RETRIEVAL_TOP_K)
+        if old_positions & changed_old_positions or new_positions & changed_new_positions:
+            affected_indices.append(task_index)
+            continue
+        if changed_definitions and mentions_definition(
+                changed_definitions, [task['task_description']] +
+                [new_index.terms[position].term.content for position in new_positions] +
+                [term.content for term in carried_terms]):
+            affected_indices.append(task_index)
+            continue
+        carried_results[task_index] = previous_result.model_copy(update={
+            'applicable_terms': carried_terms,
+            'cached': True
+        })
+    return ReanalysisPlan(diff, carried_results, affected_indices)
+
+
+def get_carried_terms(previous_result: TaskAnalysisResult,
+                      new_terms_by_fingerprint: Dict[tuple, Term]) -> Optional[List[Term]]:
+    # Returns the applicable terms of the previous result as terms of the new contract, or None when one of them
+    # was changed or removed
+    carried_terms = []
+    for term in previous_result.applicable_terms:
+        new_term = new_terms_by_fingerprint.get(term_fingerprint(term))
+        if new_term is None:
+            return None
+        carried_terms.append(new_term)
+    return carried_terms
+
+
+def mentions_definition(changed_definitions: List[str], texts: List[str]) -> bool:
+    normalized_texts: Set[str] = {f" {normalize_text(text)} " for text in texts}
+    return any(f" {name} " in text for name in changed_definitions for text in normalized_texts)
@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
+
+from backend.job_store import JobStore, JOB_QUEUED, JOB_RUNNING, JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED
+from backend.metrics import current_session_id
+from backend.models import TaskAnalysisResult
+
+if TYPE_CHECKING:
+    from backend.task_compliance_analysis import TaskComplianceAnalysisAgent
+
+
+# A running job that has not saved a result for this long is considered interrupted and may be resumed
+JOB_STALE_AFTER = int(os.getenv('CONTRACT_ANALYSIS_LLM_JOB_STALE_AFTER', 10 * 60))  # 10 minutes
+
+
+# Runs analysis jobs in the background of this worker. Every completed task result is checkpointed in the job store,
+# so a resumed job only analyzes the tasks that are still missing.
+class JobManager:
+    def __init__(self, store: JobStore, get_agent: Callable[[], Awaitable['TaskComplianceAnalysisAgent']]):
+        self.store = store
+        # The agent is created on first use, so creating the job manager does not import LangChain
+        self.get_agent = get_agent
+        self.running: Dict[str, asyncio.Task] = {}
+        self.shutting_down = False
+
+    def submit(self, session_id: str, contract_json: str, tasks: List[dict],
+               results: Optional[Dict[int, TaskAnalysisResult]] = None) -> str:
+        # Results that are passed in, e.g. carried over from a previous analysis, are saved first, so only the
+        # other tasks are analyzed
+        job_id = self.store.create_job(session_id, contract_json, tasks)
+        if results:
+            self.store.save_results(job_id, results)
+        self.start(job_id, [JOB_QUEUED])
+        return job_id
+
+    def start(self, job_id: str, from_statuses: List[str]) -> bool:
+        if job_id in self.running:
+            return False
+        if not self.store.claim_job(job_id, from_statuses, running_stale_before=time.time() - JOB_STALE_AFTER):
+            return False
+        job_task = asyncio.create_task(self._run(job_id))
+        self.running[job_id] = job_task
+        job_task.add_done_callback(lambda _: self.running.pop(job_id, None))
+        return True
+
+    def resume(self, job_id: str) -> bool:
+        return self.start(job_id, [JOB_QUEUED, JOB_RUNNING, JOB_FAILED, JOB_CANCELLED])
+
+    def resume_interrupted_jobs(self):
+        # Called at startup: picks up the jobs that were queued or running when a worker stopped
+        for job_id in self.store.get_job_ids([JOB_QUEUED, JOB_RUNNING]):
+            self.start(job_id, [JOB_QUEUED, JOB_RUNNING])
+
+    def cancel(self, job_id: str) -> bool:
+        if self.store.get_status(job_id) not in (JOB_QUEUED, JOB_RUNNING):
+            return False
+        # The status is also checked by a job running in another worker, which then stops
+        self.store.set_status(job_id, JOB_CANCELLED)
+        job_task = self.running.get(job_id)
+        if job_task is not None:
+            job_task.cancel()
+        return True
+
+    async def shutdown(self):
+        # Running jobs are queued again, so they are resumed when the backend starts
+        self.shutting_down = True
+        for job_task in list(self.running.values()):
+            job_task.cancel()
+        await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    async def _run(self, job_id: str):
+        job = self.store.get_job(job_id)
+        # Jobs resumed at startup are not started by a request, so the session for the trace logs is set here
+        current_session_id.set(job['session_id'])
+        tasks = job['tasks']
+        completed_indices = set(self.store.get_result_indices(job_id))
+        missing_indices = [i for i in range(len(tasks)) if i not in completed_indices]
+        missing_tasks = [tasks[i] for i in missing_indices]
+        failed_tasks = 0
+        try:
+            agent = await self.get_agent()
+            # Imported here, because the module imports LangChain; it is already loaded by the agent
+            from backend.task_compliance_analysis import iter_tasks_compliance
+            async for missing_index, result in iter_tasks_compliance(job['contract_json'], missing_tasks, agent):
+                result = remap_task_indices(result, missing_indices)
+                # SQLite blocks, so the store is used in a thread to keep the other jobs and requests running
+                await asyncio.to_thread(self.store.save_result, job_id, missing_indices[missing_index], result)
+                failed_tasks += result.failed
+                if await asyncio.to_thread(self.store.get_status, job_id) == JOB_CANCELLED:
+                    return
+        except asyncio.CancelledError:
+            self.store.set_status(job_id, JOB_QUEUED if self.shutting_down else JOB_CANCELLED)
+            raise
+        except Exception as e:
+            self.store.set_status(job_id, JOB_FAILED, error=str(e))
+            return
+        if failed_tasks:
+            # The results of the failed tasks are shown, but the job can be resumed to analyze them again
+            self.store.set_status(job_id, JOB_FAILED,
+                                  error=f"{failed_tasks} tasks could not be analyzed. Resume the job to retry them.")
+            return
+        self.store.set_status(job_id, JOB_COMPLETED)
+
+
+def remap_task_indices(result: TaskAnalysisResult, task_indices: List[int]) -> TaskAnalysisResult:
+    # The cluster of a result refers to the tasks that were analyzed, which are only the missing tasks of the job
+    if result.cluster_id is None:
+        return result
+    return result.model_copy(update={'cluster_id': task_indices[result.cluster_id],
+                                     'representative_index': task_indices[result.representative_index]})
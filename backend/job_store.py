@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple
+
+from backend.models import TaskAnalysisResult
+from backend.utils import DATA_DIR
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Results saved before results had the failed flag do not have it
+FAILED_RESULT = "COALESCE(json_extract(result, '$.failed'), 0)"
+
+
+# Stores analysis jobs and a checkpoint of every completed task result, so a job survives client disconnects and
+# backend restarts. SQLite makes the jobs visible to all workers on this machine.
+class JobStore:
+    def __init__(self, filename: str = "jobs.sqlite3"):
+        self.path = os.path.join(DATA_DIR, filename)
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, session_id TEXT, status TEXT NOT NULL, contract_json TEXT NOT NULL, "
+                "tasks TEXT NOT NULL, total INTEGER NOT NULL, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_results ("
+                "job_id TEXT NOT NULL, task_index INTEGER NOT NULL, result TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, task_index))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_job(self, session_id: str, contract_json: str, tasks: List[dict]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, session_id, status, contract_json, tasks, total, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, JOB_QUEUED, contract_json, json.dumps(tasks), len(tasks), now, now)
+            )
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job['tasks'] = json.loads(job['tasks'])
+            job.update(self._count_results(conn, job_id))
+            return job
+
+    def get_job_status(self, job_id: str) -> Optional[dict]:
+        # The job without its contract and tasks, which are large and not needed to poll the progress
+        with self._connect() as conn:
+            row = conn.execute("SELECT id, session_id, status, total, error FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+            if row is None:
+                return None
+            return {**dict(row), **self._count_results(conn, job_id)}
+
+    def _count_results(self, conn: sqlite3.Connection, job_id: str) -> dict:
+        completed, failed = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM({FAILED_RESULT}), 0) FROM job_results WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return {'completed': completed, 'failed': failed}
+
+    def get_job_ids(self, statuses: List[str]) -> List[str]:
+        placeholders = ', '.join('?' * len(statuses))
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT id FROM jobs WHERE status IN ({placeholders})", statuses).fetchall()
+            return [row['id'] for row in rows]
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+
+    def get_status(self, job_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return row['status'] if row else None
+
+    def claim_job(self, job_id: str, from_statuses: List[str], running_stale_before: float) -> bool:
+        # Atomically moves a job to running, so only one worker starts it. A running job can only be claimed when it
+        # has not saved a result since running_stale_before, i.e. when the worker that ran it has stopped.
+        placeholders = ', '.join('?' * len(from_statuses))
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET status = ?, error = NULL, updated_at = ? WHERE id = ? AND status IN ({placeholders}) "
+                f"AND (status != ? OR updated_at < ?)",
+                (JOB_RUNNING, time.time(), job_id, *from_statuses, JOB_RUNNING, running_stale_before)
+            )
+            return cursor.rowcount == 1
+
+    def save_result(self, job_id: str, task_index: int, result: TaskAnalysisResult):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, task_index, result) VALUES (?, ?, ?)",
+                (job_id, task_index, result.model_dump_json())
+            )
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def save_results(self, job_id: str, results: Dict[int, TaskAnalysisResult]):
+        # Saves many results in one transaction
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_results (job_id, task_index, result) VALUES (?, ?, ?)",
+                [(job_id, task_index, result.model_dump_json()) for task_index, result in results.items()]
+            )
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def get_result_indices(self, job_id: str) -> List[int]:
+        # The tasks whose analysis failed are not included, so a resumed job analyzes them again
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT task_index FROM job_results WHERE job_id = ? AND NOT {FAILED_RESULT}",
+                                (job_id,)).fetchall()
+            return [row['task_index'] for row in rows]
+
+    def get_results(self, job_id: str, offset: int = 0, limit: Optional[int] = None,
+                    compliance: Optional[bool] = None, ambiguous: Optional[bool] = None,
+                    min_cost: Optional[float] = None,
+                    max_cost: Optional[float] = None) -> Dict[int, TaskAnalysisResult]:
+        # Filtered in SQLite, so a page of a large job is read without loading the other results
+        where, params = get_results_filter(job_id, compliance, ambiguous, min_cost, max_cost)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT task_index, result FROM job_results WHERE {where} ORDER BY task_index LIMIT ? OFFSET ?",
+                (*params, -1 if limit is None else limit, offset)
+            ).fetchall()
+            return {row['task_index']: TaskAnalysisResult.model_validate_json(row['result']) for row in rows}
+
+    def count_results(self, job_id: str, compliance: Optional[bool] = None, ambiguous: Optional[bool] = None,
+                      min_cost: Optional[float] = None, max_cost: Optional[float] = None) -> int:
+        where, params = get_results_filter(job_id, compliance, ambiguous, min_cost, max_cost)
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM job_results WHERE {where}", params).fetchone()[0]
+
+
+def get_results_filter(job_id: str, compliance: Optional[bool], ambiguous: Optional[bool], min_cost: Optional[float],
+                       max_cost: Optional[float]) -> Tuple[str, list]:
+    # The results are stored as JSON; json_extract returns booleans as 1 and 0
+    conditions = ["job_id = ?"]
+    params: list = [job_id]
+    if compliance is not None:
+        conditions.append("json_extract(result, '$.compliance') = ?")
+        params.append(int(compliance))
+    if ambiguous is not None:
+        conditions.append("json_extract(result, '$.ambiguous') = ?")
+        params.append(int(ambiguous))
+    if min_cost is not None:
+        conditions.append("json_extract(result, '$.task_cost') >= ?")
+        params.append(min_cost)
+    if max_cost is not None:
+        conditions.append("json_extract(result, '$.task_cost') <= ?")
+        params.append(max_cost)
+    return " AND ".join(conditions), params
@@ -0,0 +1,284 @@
+import re
+import json
+import logging
+from typing import Any, List, Tuple, Optional
+
+from langchain_core.exceptions import OutputParserException
+
+from backend.metrics import json_repairs
+
+logger = logging.getLogger(__name__)
+
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+CLOSING_BRACKET_PATTERN = re.compile(r"\s*[}\]]")
+# Letters of any script, like str.isalpha
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def load_json_with_repair(text: str) -> Tuple[Any, List[str]]:
+    # Returns the parsed JSON and the names of the repairs that were needed. Raises the original JSONDecodeError when
+    # the text cannot be repaired.
+    try:
+        return json.loads(text), []
+    except json.JSONDecodeError as e:
+        original_error = e
+
+    repairs = []
+    candidate = text
+    json_text = extract_outer_json(candidate)
+    if json_text != candidate:
+        candidate = json_text
+        repairs.append("removed text around JSON")
+
+    candidate, scan_repairs, cut_positions = scan_json(candidate)
+    repairs.extend(scan_repairs)
+    closed_candidate = close_json(candidate)
+    if closed_candidate != candidate:
+        repairs.append("closed truncated JSON")
+    data = try_load_json(closed_candidate)
+    if data is not None:
+        return data, repairs
+
+    # The output was probably truncated in the middle of an element: drop that element and close the JSON
+    for cut_position in reversed(cut_positions[-3:]):
+        data = try_load_json(close_json(candidate[:cut_position]))
+        if data is not None:
+            return data, repairs + ["dropped truncated element"]
+    raise original_error
+
+
+def try_load_json(text: str) -> Optional[Any]:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def extract_outer_json(text: str) -> str:
+    starts = [position for position in (text.find('{'), text.find('[')) if position >= 0]
+    if not starts:
+        return text
+    start = min(starts)
+    end = max(text.rfind('}'), text.rfind(']'))
+    # Text after the last bracket is only removed when it is prose, and not the start of a truncated element
+    if end > start and not re.search(r'[{\["]', text[end + 1:]):
+        return text[start:end + 1]
+    return text[start:]
+
+
+def scan_json(text: str) -> Tuple[str, List[str], List[int]]:
+    # Walks the JSON text once, outside of strings it removes trailing commas and replaces Python literals. Also
+    # returns the positions of the commas, where a truncated text can be cut.
+    output = []
+    repairs = set()
+    cut_positions = []
+    in_string = False
+    escaped = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            output.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            i += 1
+            continue
+        if char == '"':
+            in_string = True
+        elif char == ',':
+            if CLOSING_BRACKET_PATTERN.match(text, i + 1):
+                repairs.add("removed trailing comma")
+                i += 1
+                continue
+            cut_positions.append(len(output))
+        elif char.isalpha():
+            word_match = WORD_PATTERN.match(text, i)
+            word = word_match.group(0) if word_match is not None else char
+            # Extended per character, so len(output) stays a position in the output text
+            if word in PYTHON_LITERALS:
+                output.extend(PYTHON_LITERALS[word])
+                repairs.add("replaced Python literal")
+            else:
+                output.extend(word)
+            i += len(word)
+            continue
+        output.append(char)
+        i += 1
+    return ''.join(output), sorted(repairs), cut_positions
+
+
+def close_json(text: str) -> str:
+    # Closes an unterminated string and all brackets that are still open at the end of the text
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(','):
+        text = text[:-1]
+    elif text.endswith(':'):
+        text += ' null'
+    return text + ''.join(reversed(stack))
+
+
+def parse_amount(value: Any) -> Any:
+    # "$2,800", "2.800,00 EUR" and "USD 2800" become floats, other values are returned unchanged
+    if not isinstance(value, str):
+        return value
+    amount = re.sub(r"[^\d.,\-]", "", value)
+    if re.search(r",\d{1,2}$", amount):
+        # Comma as decimal separator
+        amount = amount.replace('.', '').replace(',', '.')
+    else:
+        amount = amount.replace(',', '')
+    try:
+        return float(amount)
+    except ValueError:
+        return value
+
+
+def parse_bool(value: Any) -> Any:
+    if isinstance(value, str) and value.strip().lower() in ('true', 'yes'):
+        return True
+    if isinstance(value, str) and value.strip().lower() in ('false', 'no'):
+        return False
+    return value
+
+
+def coerce_term_data(term: Any, repairs: List[str]):
+    if isinstance(term, dict):
+        for key in ('title', 'content'):
+            if term.get(key) is None:
+                term[key] = ""
+                repairs.append(f"added empty term {key}")
+
+
+def coerce_task_analysis_data(data: Any, llm_output: str) -> List[str]:
+    # Fixes the common deviations of a task analysis result in place, and returns the names of the repairs
+    repairs = []
+    if not isinstance(data, dict):
+        return repairs
+    if 'task_cost' in data:
+        task_cost = parse_amount(data['task_cost'])
+        if task_cost is not data['task_cost']:
+            data['task_cost'] = task_cost
+            repairs.append("converted task_cost to a number")
+    for key in ('compliance', 'ambiguous'):
+        if key in data:
+            value = parse_bool(data[key])
+            if value is not data[key]:
+                data[key] = value
+                repairs.append(f"converted {key} to a boolean")
+    if 'applicable_term_ids' not in data and isinstance(data.get('applicable_terms'), list):
+        # The terms were copied instead of referenced by id
+        terms = data['applicable_terms']
+        term_ids = [term.get('id') for term in terms if isinstance(term, dict) and term.get('id')]
+        if terms and not term_ids:
+            # Without ids the terms cannot be resolved, and an empty list would claim that no term applies
+            raise OutputParserException(
+                error="Applicable terms without ids",
+                observation="The applicable terms have no ids. Only list the ids of the terms in applicable_term_ids.",
+                llm_output=llm_output,
+                send_to_llm=True
+            )
+        del data['applicable_terms']
+        data['applicable_term_ids'] = term_ids
+        repairs.append("converted applicable_terms to ids")
+    term_ids = data.get('applicable_term_ids', [])
+    if term_ids is None:
+        data['applicable_term_ids'] = []
+        repairs.append("replaced null applicable_term_ids")
+    elif isinstance(term_ids, (str, int)):
+        data['applicable_term_ids'] = [term_ids]
+        repairs.append("wrapped single term id in a list")
+    if isinstance(data.get('applicable_term_ids'), list):
+        data['applicable_term_ids'] = [coerce_term_id(term_id, repairs) for term_id in data['applicable_term_ids']]
+    if data.get('reasoning', "") is None:
+        data['reasoning'] = ""
+        repairs.append("replaced null reasoning")
+    return repairs
+
+
+def coerce_term_id(term_id: Any, repairs: List[str]) -> Any:
+    # Term ids are "T" followed by the number of the term; a bare number refers to the same term
+    if isinstance(term_id, int) and not isinstance(term_id, bool):
+        repairs.append("converted term id to a string")
+        return f"T{term_id}"
+    if isinstance(term_id, str) and term_id.strip() != term_id:
+        term_id = term_id.strip()
+        repairs.append("stripped term id")
+    if isinstance(term_id, str) and term_id.isdigit():
+        repairs.append("added T to term id")
+        return f"T{term_id}"
+    return term_id
+
+
+def coerce_contract_data(data: Any) -> List[str]:
+    # Fixes the common deviations of an extracted contract in place, and returns the names of the repairs
+    repairs = []
+    if not isinstance(data, dict):
+        return repairs
+    if data.get('title') is None:
+        data['title'] = ""
+        repairs.append("added empty title")
+    definitions = data.get('definitions')
+    if definitions is None:
+        data['definitions'] = {}
+        repairs.append("added empty definitions")
+    elif isinstance(definitions, list):
+        # [{"term": "Agreement", "definition": "..."}] instead of {"Agreement": "..."}
+        converted = {}
+        for definition in definitions:
+            if isinstance(definition, dict) and len(definition) == 2:
+                name, text = definition.values()
+                converted[str(name)] = str(text)
+        data['definitions'] = converted
+        repairs.append("converted definitions list to an object")
+    if data.get('sections') is None:
+        data['sections'] = []
+        repairs.append("added empty sections")
+    for section in data['sections'] if isinstance(data['sections'], list) else []:
+        coerce_section_data(section, repairs)
+    return repairs
+
+
+def coerce_section_data(section: Any, repairs: List[str]):
+    if not isinstance(section, dict):
+        return
+    if section.get('title') is None:
+        section['title'] = ""
+        repairs.append("added empty section title")
+    for key in ('terms', 'subsections'):
+        if section.get(key) is None:
+            section[key] = []
+            repairs.append(f"added empty {key}")
+    for term in section['terms'] if isinstance(section['terms'], list) else []:
+        coerce_term_data(term, repairs)
+    for subsection in section['subsections'] if isinstance(section['subsections'], list) else []:
+        coerce_section_data(subsection, repairs)
+
+
+def record_repairs(output_name: str, repairs: List[str]):
+    for repair in set(repairs):
+        json_repairs.inc(output_name, repair)
+    if repairs:
+        logger.info("Repaired %s locally: %s", output_name, ", ".join(sorted(set(repairs))))
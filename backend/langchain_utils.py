@@ -1,16 +1,167 @@
+import time
+import asyncio
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import LLMResult
 
+from backend.metrics import (hedged_requests, llm_calls, llm_calls_in_flight, llm_retries, llm_tokens, observe_stage,
+                             trace)
+from backend.rate_limiting import COMPLETION_TOKENS_ESTIMATE, llm_rate_limiter
+from backend.retry_policy import (LLM_CALL_TIMEOUT, RETRY_LIMITS, classify_error, get_backoff_delay,
+                                  get_hedge_delay, latency_tracker)
+from backend.token_estimation import estimate_prompt_tokens
 
-def invoke_chain_with_error_handling(chain, input_data):
-    try:
-        ai_output = chain.invoke(input_data)
-        return ai_output
-    except OutputParserException as e:
-        if e.send_to_llm:
+
+# Records the duration of the prompt, LLM and parser steps of a chain, and the tokens used by the LLM
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # Called directly in the event loop instead of in a thread, because the handlers only update counters
+    run_inline = True
+
+    def __init__(self):
+        self.stages: Dict[UUID, Tuple[str, float]] = {}
+
+    def _start(self, run_id: UUID, stage: str):
+        self.stages[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id: UUID):
+        stage, start = self.stages.pop(run_id, (None, None))
+        if stage is not None:
+            observe_stage(stage, time.perf_counter() - start)
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, run_type: Optional[str] = None, **kwargs):
+        if run_type == "prompt":
+            self._start(run_id, "prompt_rendering")
+        elif run_type == "parser":
+            self._start(run_id, "output_parsing")
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        llm_calls_in_flight.inc()
+        self._start(run_id, "llm_call")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        llm_calls_in_flight.dec()
+        llm_calls.inc("success")
+        self._end(run_id)
+        prompt_tokens, completion_tokens = get_token_usage(response)
+        llm_tokens.inc("prompt", amount=prompt_tokens)
+        llm_tokens.inc("completion", amount=completion_tokens)
+        trace("llm_call prompt_tokens=%d completion_tokens=%d", prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        llm_calls_in_flight.dec()
+        llm_calls.inc("error")
+        self._end(run_id)
+        trace("llm_call error=%s", type(error).__name__)
+
+
+def get_token_usage(response: LLMResult) -> Tuple[int, int]:
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage_metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if usage_metadata:
+                prompt_tokens += usage_metadata.get('input_tokens', 0)
+                completion_tokens += usage_metadata.get('output_tokens', 0)
+    if not prompt_tokens and not completion_tokens and response.llm_output:
+        # Older integrations only report the usage in the provider output
+        token_usage = response.llm_output.get('token_usage') or {}
+        prompt_tokens = token_usage.get('prompt_tokens', 0)
+        completion_tokens = token_usage.get('completion_tokens', 0)
+    return prompt_tokens, completion_tokens
+
+
+metrics_callback_handler = MetricsCallbackHandler()
+
+
+# Every chain call reports the durations of its steps and the token usage to the metrics
+METRICS_CONFIG = {"callbacks": [metrics_callback_handler]}
+
+
+async def ainvoke_chain_with_error_handling(chain, input_data, operation: str = "llm_call"):
+    # Retries transient API errors with backoff and sends unparsable outputs back to the LLM, each up to the limit
+    # of its error class. The operation groups the latencies that decide when a call is hedged.
+    retries = {}
+    while True:
+        try:
+            return await ainvoke_hedged(chain, input_data, operation)
+        except OutputParserException as e:
+            if not e.send_to_llm or retries.get('parse', 0) >= RETRY_LIMITS['parse']:
+                raise e
+            retries['parse'] = retries.get('parse', 0) + 1
+            record_retry('parse', e)
             extra_messages = input_data.get("extra_messages", [])
             extra_messages.append(("ai", e.llm_output))
             extra_messages.append(("human", e.observation))
             input_data["extra_messages"] = extra_messages
-            return chain.invoke(input_data)
-        else:
-            raise e
+        except Exception as e:
+            reason = classify_error(e)
+            if reason is None or retries.get(reason, 0) >= RETRY_LIMITS[reason]:
+                raise e
+            retries[reason] = retries.get(reason, 0) + 1
+            record_retry(reason, e)
+            await asyncio.sleep(get_backoff_delay(e, retries[reason]))
+
+
+async def ainvoke_hedged(chain, input_data, operation: str):
+    hedge_delay = get_hedge_delay(operation)
+    if hedge_delay is None:
+        return await ainvoke_rate_limited(chain, input_data, operation)
+
+    call_started = asyncio.Event()
+
+    async def wait_for_hedge():
+        # The delay counts from the moment the first call passed the rate limiter
+        await call_started.wait()
+        await asyncio.sleep(hedge_delay)
+
+    calls = [asyncio.ensure_future(ainvoke_rate_limited(chain, input_data, operation, call_started))]
+    hedge_timer = asyncio.ensure_future(wait_for_hedge())
+    pending = {calls[0], hedge_timer}
+    error = None
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if hedge_timer in done:
+                hedged_requests.inc(operation)
+                trace("llm_hedge operation=%s delay=%.2f", operation, hedge_delay)
+                calls.append(asyncio.ensure_future(ainvoke_rate_limited(chain, dict(input_data), operation)))
+                pending.add(calls[-1])
+            for call in calls:
+                if call in done:
+                    if call.exception() is None:
+                        return call.result()
+                    error = error or call.exception()
+            if not any(call in pending for call in calls):
+                raise error
+    finally:
+        # The slower call is not needed anymore
+        for task in pending:
+            task.cancel()
+
+
+async def ainvoke_rate_limited(chain, input_data, operation: str = "llm_call", call_started=None):
+    wait_start = time.perf_counter()
+    # The chains start with their prompt, which is rendered to estimate the tokens of the call
+    async with llm_rate_limiter.limit(estimate_prompt_tokens(chain.first, input_data) + COMPLETION_TOKENS_ESTIMATE):
+        observe_stage("rate_limit_wait", time.perf_counter() - wait_start)
+        if call_started is not None:
+            call_started.set()
+        call_start = time.perf_counter()
+        ai_output = await asyncio.wait_for(chain.ainvoke(input_data, config=METRICS_CONFIG),
+                                           LLM_CALL_TIMEOUT if LLM_CALL_TIMEOUT > 0 else None)
+        latency_tracker.record(operation, time.perf_counter() - call_start)
+        return ai_output
+
+
+def record_retry(reason: str, e: Exception):
+    llm_retries.inc(reason)
+    trace("llm_retry reason=%s error=%s", reason, str(e).splitlines()[0] if str(e) else type(e).__name__)
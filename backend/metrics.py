@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from backend.utils import hash_text
+
+
+# Set to true to log a trace line for every request and pipeline stage, with the session to correlate them
+TRACE_ENABLED = os.getenv('CONTRACT_ANALYSIS_LLM_TRACE', 'false').lower() in ('1', 'true', 'yes')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+trace_logger = logging.getLogger("backend.trace")
+# Session of the request that is being handled; copied into the asyncio tasks that the request starts
+current_session_id: ContextVar[Optional[str]] = ContextVar("current_session_id", default=None)
+
+LabelValues = Tuple[str, ...]
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        # Metrics without labels are exported from the start, so their rate can be computed from zero
+        self.values: Dict[LabelValues, float] = {} if label_names else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def render(self, metric_type: str = "counter") -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {metric_type}"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value:g}")
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self, metric_type: str = "gauge") -> List[str]:
+        return super().render(metric_type)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label set: the count of every bucket (the last one is +Inf), the sum and the total count
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            bucket_counts, totals = self.values.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+            bucket_counts[bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (bucket_counts, totals) in sorted(self.values.items()):
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets + (float('inf'),), bucket_counts):
+                    cumulative_count += count
+                    bucket_labels = format_labels(self.label_names + ('le',),
+                                                  label_values + ('+Inf' if upper_bound == float('inf') else
+                                                                  f"{upper_bound:g}",))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative_count}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {totals[0]:g}")
+                lines.append(f"{self.name}_count{labels} {totals[1]}")
+        return lines
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: LabelValues) -> str:
+    if not label_names:
+        return ""
+    escaped_values = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                      for value in label_values]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, escaped_values)) + "}"
+
+
+stage_duration = Histogram(
+    "contract_analysis_stage_duration_seconds", "Duration of the stages of the analysis pipeline.", ("stage",))
+http_request_duration = Histogram(
+    "contract_analysis_http_request_duration_seconds", "Duration of the HTTP requests.", ("method", "path", "status"))
+llm_calls = Counter("contract_analysis_llm_calls_total", "LLM calls by outcome.", ("outcome",))
+llm_calls_in_flight = Gauge("contract_analysis_llm_calls_in_flight", "LLM calls that are waiting for a response.")
+llm_tokens = Counter("contract_analysis_llm_tokens_total", "Tokens used by the LLM calls.", ("type",))
+llm_retries = Counter("contract_analysis_llm_retries_total",
+                      "LLM calls that were repeated after an unparsable output or a transient error, by reason.",
+                      ("reason",))
+hedged_requests = Counter("contract_analysis_hedged_requests_total",
+                          "Duplicate LLM calls that were sent because the first call was slow, by operation.",
+                          ("operation",))
+json_repairs = Counter(
+    "contract_analysis_json_repairs_total", "LLM outputs that were repaired locally, by output and repair.",
+    ("output", "repair"))
+cache_requests = Counter("contract_analysis_cache_requests_total", "Cache lookups by cache and result.",
+                         ("cache", "result"))
+task_decisions = Counter("contract_analysis_task_decisions_total", "Analyzed tasks by the way they were decided.",
+                         ("decided_by",))
+cascade_escalations = Counter("contract_analysis_cascade_escalations_total",
+                              "Tasks that were sent from the fast model to the strong model, by reason.", ("reason",))
+coalesced_calls = Counter("contract_analysis_coalesced_calls_total",
+                          "Calls that joined an identical call in flight instead of calling the LLM, by operation.",
+                          ("operation",))
+rejected_uploads = Counter("contract_analysis_rejected_uploads_total",
+                           "Uploads that were rejected before parsing, by reason.", ("reason",))
+budget_decisions = Counter("contract_analysis_budget_decisions_total",
+                           "Runs that were admitted, queued or rejected by the token budgets, by decision.",
+                           ("decision",))
+estimated_tokens = Counter("contract_analysis_estimated_tokens_total",
+                           "Estimated tokens of the runs that were admitted by the token budgets.")
+
+METRICS = [stage_duration, http_request_duration, llm_calls, llm_calls_in_flight, llm_tokens, llm_retries,
+           hedged_requests, json_repairs, cache_requests, task_decisions, cascade_escalations, coalesced_calls,
+           rejected_uploads, budget_decisions, estimated_tokens]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def observe_stage(stage: str, duration: float):
+    stage_duration.observe(duration, stage)
+    trace("stage=%s duration=%.4f", stage, duration)
+
+
+@contextmanager
+def time_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def trace(message: str, *args):
+    if TRACE_ENABLED:
+        trace_logger.info("session=%s " + message, get_trace_session(), *args)
+
+
+def get_trace_session() -> str:
+    # Session ids are signed tokens that grant access to the session, so only a hash of them is logged
+    session_id = current_session_id.get()
+    return hash_text(session_id)[:12] if session_id else "-"
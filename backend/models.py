@@ -10,16 +10,48 @@ class ContractUploadResponse(BaseModel):
     contract_json: str
 
 
+class TaskRowError(BaseModel):
+    row: int
+    message: str
+
+
 class TaskUploadResponse(BaseModel):
     message: str
     tasks_uploaded: int
+    # Rows that could not be parsed are skipped; only the first rows with an error are listed
+    rows_rejected: int = 0
+    row_errors: List[TaskRowError] = []
+
+
+class TaskListItem(BaseModel):
+    index: int
+    task_description: str
+    task_cost: float
+
+
+class TaskListResponse(BaseModel):
+    # A page of the tasks that match the filter; total is the number of matching tasks
+    tasks: List[TaskListItem]
+    total: int
+    offset: int = 0
+    limit: Optional[int] = None
 
 
 class Term(BaseModel):
+    # Assigned by the backend after the extraction, e.g. "T12", so the analysis can refer to the term by its id
+    id: str = ""
     title: str
     content: str
 
 
+# The analysis as returned by the LLM: the applicable terms are referred to by their id instead of being copied
+class TaskAnalysisOutput(BaseModel):
+    applicable_term_ids: List[str]
+    reasoning: str
+    compliance: bool
+    ambiguous: bool
+
+
 class TaskAnalysisResult(BaseModel):
     task_description: str
     task_cost: float
@@ -27,10 +59,97 @@ class TaskAnalysisResult(BaseModel):
     reasoning: str
     compliance: bool
     ambiguous: bool
+    # Set by the backend when the result was reused from the cache or from an identical task, without an LLM call
+    cached: bool = False
+    # Set by the backend when the result was reused from the representative of the task's cluster, without an LLM call
+    cluster_reused: bool = False
+    # Set by the backend when the analysis failed; the result is not cached, and a resumed job analyzes the task again
+    failed: bool = False
+    # Set by the backend: "llm" (the strong model), "fast_llm" (the fast model of the cascade), or "rules" when the
+    # result was decided by the local cost rules
+    decided_by: str = "llm"
+    # Set when the fast model's result was not accepted and the strong model decided: "ambiguous", "invalid",
+    # "non_compliant", "no_terms" or "cost"
+    escalation_reason: Optional[str] = None
+    # Set for the tasks of a cluster of near-duplicate tasks: the cluster id is the index of the task that represents
+    # the cluster, the representative index is the index of the task whose analysis is used for this task
+    cluster_id: Optional[int] = None
+    representative_index: Optional[int] = None
 
 
 class TaskAnalysisResponse(BaseModel):
     results: List[TaskAnalysisResult]
+    cache_hits: int = 0
+    rule_decisions: int = 0
+    fast_model_decisions: int = 0
+    escalations: int = 0
+    cluster_reuses: int = 0
+
+
+class TaskAnalysisStreamEvent(BaseModel):
+    index: int
+    completed: int
+    total: int
+    result: TaskAnalysisResult
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    # Tasks with a result; the failed ones are analyzed again when the job is resumed
+    completed: int
+    failed: int = 0
+    error: Optional[str] = None
+
+
+class ReanalysisResponse(JobStatusResponse):
+    # The new job analyzes only the tasks that are affected by the contract changes; the others are carried over
+    added_terms: int
+    removed_terms: int
+    changed_terms: int
+    changed_definitions: List[str]
+    carried_over: int
+    reanalyzed: int
+
+
+class TokenEstimate(BaseModel):
+    llm_requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+    wall_time_s: float = 0.0
+
+
+class AnalysisEstimate(TokenEstimate):
+    # Tasks by the way they are expected to be decided; only the llm_tasks are sent to the LLM
+    tasks: int = 0
+    llm_tasks: int = 0
+    cache_hits: int = 0
+    rule_decisions: int = 0
+    duplicates: int = 0
+    cluster_reuses: int = 0
+
+
+class AnalysisEstimateResponse(AnalysisEstimate):
+    # Decision of the token budgets for the run: "admit", "queue" (it waits for the budget) or "reject"
+    admission: str
+    queue_wait_s: Optional[float] = None
+    session_budget_remaining: Optional[int] = None
+    global_budget_remaining: Optional[int] = None
+
+
+class JobTaskResult(BaseModel):
+    index: int
+    result: TaskAnalysisResult
+
+
+class JobResultsResponse(JobStatusResponse):
+    # A page of the results that match the filter; total_results is the number of matching results so far
+    results: List[JobTaskResult]
+    total_results: int = 0
+    offset: int = 0
+    limit: Optional[int] = None
 
 
 class Section(BaseModel):
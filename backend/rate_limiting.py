@@ -0,0 +1,84 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv('CONTRACT_ANALYSIS_LLM_MAX_CONCURRENT_CALLS', 16))
+# Provider quota. The defaults are the gpt-4o limits of OpenAI usage tier 1. Set to 0 to disable a limit.
+REQUESTS_PER_MINUTE = int(os.getenv('CONTRACT_ANALYSIS_LLM_REQUESTS_PER_MINUTE', 500))
+TOKENS_PER_MINUTE = int(os.getenv('CONTRACT_ANALYSIS_LLM_TOKENS_PER_MINUTE', 30000))
+# Tokens reserved for the completion when a call is checked against the tokens per minute limit
+COMPLETION_TOKENS_ESTIMATE = 1000
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock: Optional[asyncio.Lock] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    async def acquire(self, amount: float):
+        # A request larger than the bucket could never be served, so it waits for a full bucket instead
+        amount = min(amount, self.capacity)
+        # The lock makes waiters take turns, so a large request is not starved by a stream of small ones
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.refill_per_second)
+                self._refill()
+            self.tokens -= amount
+
+
+# Limits the LLM calls of this process: at most max_concurrency calls in flight, and requests and tokens per minute
+# below the provider quota.
+class LLMRateLimiter:
+    def __init__(self, max_concurrency: int, requests_per_minute: int, tokens_per_minute: int):
+        self.max_concurrency = max_concurrency
+        self.request_bucket = create_per_minute_bucket(requests_per_minute)
+        self.token_bucket = create_per_minute_bucket(tokens_per_minute)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _bind_to_running_loop(self):
+        # asyncio primitives belong to one event loop, so they are created again when the limiter is used in
+        # another loop (e.g. in scripts that call asyncio.run several times)
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency > 0 else None
+            for bucket in (self.request_bucket, self.token_bucket):
+                if bucket is not None:
+                    bucket.lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def limit(self, estimated_tokens: int):
+        self._bind_to_running_loop()
+        if self.semaphore is not None:
+            await self.semaphore.acquire()
+        try:
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(estimated_tokens)
+            yield
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+
+def create_per_minute_bucket(limit_per_minute: int) -> Optional[TokenBucket]:
+    if limit_per_minute <= 0:
+        return None
+    return TokenBucket(limit_per_minute, limit_per_minute / 60)
+
+
+llm_rate_limiter = LLMRateLimiter(MAX_CONCURRENT_LLM_CALLS, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
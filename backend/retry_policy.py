@@ -0,0 +1,81 @@
+import os
+import random
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional
+
+import openai
+
+
+# Number of retries per class of error. 'parse' retries send the invalid output back to the LLM with the error.
+RETRY_LIMITS = {
+    'parse': int(os.getenv('CONTRACT_ANALYSIS_LLM_PARSE_RETRIES', 1)),
+    'rate_limit': int(os.getenv('CONTRACT_ANALYSIS_LLM_RATE_LIMIT_RETRIES', 5)),
+    'server_error': int(os.getenv('CONTRACT_ANALYSIS_LLM_SERVER_ERROR_RETRIES', 3)),
+    'timeout': int(os.getenv('CONTRACT_ANALYSIS_LLM_TIMEOUT_RETRIES', 2)),
+}
+# Exponential backoff with full jitter: the n-th retry waits a random time up to min(max, base * 2^(n - 1)) seconds
+BACKOFF_BASE = float(os.getenv('CONTRACT_ANALYSIS_LLM_BACKOFF_BASE', 1.0))
+BACKOFF_MAX = float(os.getenv('CONTRACT_ANALYSIS_LLM_BACKOFF_MAX', 30.0))
+# Seconds before an LLM call is cancelled and counted as a timeout. Set to 0 to disable.
+LLM_CALL_TIMEOUT = float(os.getenv('CONTRACT_ANALYSIS_LLM_CALL_TIMEOUT', 120))
+
+# Hedged requests: when a call takes longer than this, a duplicate call is sent and the first response is used.
+# Either a number of seconds or a percentile of the observed call latencies, like 'p95'. Empty disables hedging.
+HEDGE_AFTER = os.getenv('CONTRACT_ANALYSIS_LLM_HEDGE_AFTER', '').strip().lower()
+# A percentile is only used when enough calls of the same operation were observed
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 500
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    # Returns the retry class of a transient error, or None when retrying would not help
+    if isinstance(error, openai.RateLimitError):
+        return 'rate_limit'
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(error, openai.APIConnectionError):
+        return 'server_error'
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return 'server_error'
+    return None
+
+
+def get_backoff_delay(error: BaseException, retry_number: int) -> float:
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (retry_number - 1)))
+    if isinstance(error, openai.RateLimitError):
+        # The provider knows best when the quota is available again
+        try:
+            delay = max(delay, float(error.response.headers.get('retry-after', 0)))
+        except (AttributeError, ValueError):
+            pass
+    return delay
+
+
+# Keeps the latencies of the last successful calls per operation, to derive the hedging threshold
+class LatencyTracker:
+    def __init__(self, window: int):
+        self.window = window
+        self.latencies: Dict[str, Deque[float]] = {}
+
+    def record(self, operation: str, latency: float):
+        self.latencies.setdefault(operation, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, operation: str, fraction: float) -> Optional[float]:
+        latencies = self.latencies.get(operation)
+        if latencies is None or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+latency_tracker = LatencyTracker(LATENCY_WINDOW)
+
+
+def get_hedge_delay(operation: str) -> Optional[float]:
+    if not HEDGE_AFTER:
+        return None
+    if HEDGE_AFTER.startswith('p'):
+        return latency_tracker.percentile(operation, float(HEDGE_AFTER[1:]) / 100)
+    delay = float(HEDGE_AFTER)
+    return delay if delay > 0 else None
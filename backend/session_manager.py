@@ -1,8 +1,11 @@
 import os
-import time
+import uuid
 from typing import Dict, Any
 from itsdangerous import TimestampSigner, BadSignature, SignatureExpired
 
+from backend.session_store import SessionStore, InMemorySessionStore, SqliteSessionStore
+from backend.utils import DATA_DIR
+
 
 SECRET_KEY = os.getenv('CONTRACT_ANALYSIS_LLM_SECRET')
 
@@ -10,34 +13,43 @@ if not SECRET_KEY:
     raise ValueError('The environment variable CONTRACT_ANALYSIS_LLM_SECRET is not set. Set it to a secure key first.')
 
 SESSION_EXPIRATION = 30 * 60  # Sessions expire after 30 minutes
+SESSION_SWEEP_INTERVAL = 60  # Expired sessions are removed every minute
+
+# 'memory' keeps the sessions in the process, 'sqlite' shares them between all workers on this machine
+SESSION_STORE = os.getenv('CONTRACT_ANALYSIS_LLM_SESSION_STORE', 'memory')
+SESSION_MAX_BYTES = int(os.getenv('CONTRACT_ANALYSIS_LLM_SESSION_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def create_session_store() -> SessionStore:
+    if SESSION_STORE == 'memory':
+        return InMemorySessionStore(SESSION_EXPIRATION, SESSION_SWEEP_INTERVAL, SESSION_MAX_BYTES)
+    if SESSION_STORE == 'sqlite':
+        return SqliteSessionStore(os.path.join(DATA_DIR, "sessions.sqlite3"), SESSION_EXPIRATION, SESSION_SWEEP_INTERVAL)
+    raise ValueError(f"Unknown session store '{SESSION_STORE}'. Use 'memory' or 'sqlite'.")
+
 
 signer = TimestampSigner(SECRET_KEY)
-session_store: Dict[str, Dict[str, Any]] = {}
+session_store = create_session_store()
 
 
 def create_session() -> str:
-    session_id = signer.sign("session").decode()
-    session_store[session_id] = {"created_at": time.time(), "data": {}}
+    # The id is random, so two sessions created in the same second do not get the same id
+    session_id = signer.sign(uuid.uuid4().hex).decode()
+    session_store.create(session_id)
     return session_id
 
 
 def get_session(session_id: str) -> Dict[str, Any]:
     try:
         signer.unsign(session_id, max_age=SESSION_EXPIRATION)
-        session = session_store.get(session_id)
-        if session and time.time() - session["created_at"] < SESSION_EXPIRATION:
-            return session["data"]
-        else:
-            # Session expired or does not exist
-            session_store.pop(session_id, None)
-            return {}
     except (BadSignature, SignatureExpired):
         # Invalid or expired session
-        session_store.pop(session_id, None)
+        session_store.delete(session_id)
         return {}
+    session_data = session_store.get_data(session_id)
+    # Session expired or does not exist
+    return session_data if session_data is not None else {}
 
 
 def set_session_data(session_id: str, key: str, value: Any):
-    session_data = get_session(session_id)
-    session_data[key] = value
-    session_store[session_id]["data"] = session_data
+    session_store.set_value(session_id, key, value)
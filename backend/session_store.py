@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+
+class SessionStore(ABC):
+    def __init__(self, expiration: float, sweep_interval: float):
+        self.expiration = expiration
+        self.sweep_interval = sweep_interval
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_lock = threading.Lock()
+
+    @abstractmethod
+    def create(self, session_id: str):
+        pass
+
+    @abstractmethod
+    def get_data(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # Returns None when the session does not exist or has expired
+        pass
+
+    @abstractmethod
+    def set_value(self, session_id: str, key: str, value: Any):
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        pass
+
+    @abstractmethod
+    def sweep(self):
+        # Removes expired sessions, and evicts sessions when the store exceeds its limits
+        pass
+
+    def start_sweeper(self):
+        # Expired sessions are removed in the background, not only when they happen to be read
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_periodically, name="session-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_periodically(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                # A failed sweep is retried in the next interval
+                pass
+
+
+def estimate_size(value: Any) -> int:
+    return len(json.dumps(value, default=str))
+
+
+# Keeps the sessions in the memory of this process. Use it with a single worker only.
+class InMemorySessionStore(SessionStore):
+    def __init__(self, expiration: float, sweep_interval: float, max_bytes: int):
+        super().__init__(expiration, sweep_interval)
+        self.max_bytes = max_bytes
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def create(self, session_id: str):
+        now = time.time()
+        with self.lock:
+            self.sessions[session_id] = {"created_at": now, "accessed_at": now, "data": {}, "sizes": {}}
+        self.start_sweeper()
+
+    def get_data(self, session_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            if now - session["created_at"] >= self.expiration:
+                del self.sessions[session_id]
+                return None
+            session["accessed_at"] = now
+            return session["data"]
+
+    def set_value(self, session_id: str, key: str, value: Any):
+        size = estimate_size(value)
+        now = time.time()
+        with self.lock:
+            session = self.sessions.setdefault(session_id, {"created_at": now, "data": {}, "sizes": {}})
+            session["accessed_at"] = now
+            session["data"][key] = value
+            session["sizes"][key] = size
+        self.start_sweeper()
+
+    def delete(self, session_id: str):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            for session_id in [session_id for session_id, session in self.sessions.items()
+                               if now - session["created_at"] >= self.expiration]:
+                del self.sessions[session_id]
+
+            # Evict the least recently used sessions until the store fits in its memory budget again
+            total_size = sum(sum(session["sizes"].values()) for session in self.sessions.values())
+            if total_size <= self.max_bytes:
+                return
+            by_access = sorted(self.sessions.items(), key=lambda item: item[1]["accessed_at"])
+            for session_id, session in by_access:
+                if total_size <= self.max_bytes:
+                    break
+                total_size -= sum(session["sizes"].values())
+                del self.sessions[session_id]
+
+
+# Keeps the sessions in a SQLite database, so several uvicorn workers on this machine can serve the same session
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path: str, expiration: float, sweep_interval: float):
+        super().__init__(expiration, sweep_interval)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_data ("
+                "session_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (session_id, key))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?, ?)", (session_id, time.time()))
+        self.start_sweeper()
+
+    def get_data(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT created_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[0] >= self.expiration:
+                self._delete(conn, session_id)
+                return None
+            rows = conn.execute("SELECT key, value FROM session_data WHERE session_id = ?", (session_id,)).fetchall()
+            return {key: json.loads(value) for key, value in rows}
+
+    def set_value(self, session_id: str, key: str, value: Any):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?, ?)", (session_id, time.time()))
+            conn.execute(
+                "INSERT OR REPLACE INTO session_data (session_id, key, value) VALUES (?, ?, ?)",
+                (session_id, key, json.dumps(value))
+            )
+        self.start_sweeper()
+
+    def delete(self, session_id: str):
+        with self._connect() as conn:
+            self._delete(conn, session_id)
+
+    def _delete(self, conn: sqlite3.Connection, session_id: str):
+        conn.execute("DELETE FROM session_data WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def sweep(self):
+        expired_before = time.time() - self.expiration
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM session_data WHERE session_id IN (SELECT id FROM sessions WHERE created_at <= ?)",
+                (expired_before,)
+            )
+            conn.execute("DELETE FROM sessions WHERE created_at <= ?", (expired_before,))
@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from backend.metrics import coalesced_calls
+
+
+class InFlightCall:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+# Coalesces identical concurrent calls: while a call for a key is running, other calls with the same key await the
+# same task instead of starting their own. The task is cancelled when all of its waiters are cancelled.
+class SingleFlight:
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.calls: Dict[str, InFlightCall] = {}
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        in_flight_call = self.calls.get(key)
+        # A task of another event loop (e.g. in scripts that call asyncio.run several times) cannot be awaited here
+        if in_flight_call is not None and in_flight_call.task.get_loop() is asyncio.get_running_loop():
+            coalesced_calls.inc(self.operation)
+        else:
+            in_flight_call = InFlightCall(asyncio.ensure_future(call()))
+            self.calls[key] = in_flight_call
+            in_flight_call.task.add_done_callback(lambda _: self._forget(key, in_flight_call))
+
+        in_flight_call.waiters += 1
+        try:
+            # The shield keeps the shared task running when a single waiter is cancelled. Errors of the task are
+            # raised to every waiter.
+            return await asyncio.shield(in_flight_call.task)
+        except asyncio.CancelledError:
+            if in_flight_call.waiters == 1 and not in_flight_call.task.done():
+                # Nobody is waiting for the result anymore; a new call with this key starts a new task
+                self._forget(key, in_flight_call)
+                in_flight_call.task.cancel()
+            raise
+        finally:
+            in_flight_call.waiters -= 1
+
+    def _forget(self, key: str, in_flight_call: InFlightCall):
+        if self.calls.get(key) is in_flight_call:
+            del self.calls[key]
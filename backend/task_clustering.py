@@ -0,0 +1,104 @@
+import re
+import zlib
+import random
+from typing import Dict, FrozenSet, List, Sequence, Tuple
+
+
+# Number of MinHash values per description, split into bands for the locality-sensitive hashing: two descriptions
+# become candidates when all values of one band are equal
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+MINHASH_PRIME = (1 << 31) - 1
+
+MONTH_PATTERN = (r"jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?"
+                 r"|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?")
+# Dates, numbers and codes (e.g. "RTM-042") differ between otherwise identical tasks, so they are replaced by
+# placeholders before the descriptions are compared
+DATE_PATTERN = re.compile(
+    rf"\b\d{{1,4}}[/.-]\d{{1,2}}(?:[/.-]\d{{1,4}})?\b"
+    rf"|\b\d{{1,2}}(?:st|nd|rd|th)?\s+(?:{MONTH_PATTERN})\b(?:\s+\d{{4}})?"
+    rf"|\b(?:{MONTH_PATTERN})\s+\d{{1,2}}(?:st|nd|rd|th)?\b(?:,?\s+\d{{4}})?",
+    re.IGNORECASE
+)
+CODE_PATTERN = re.compile(r"\b(?=[\w-]*[a-z])(?=[\w-]*\d)[a-z\d]+(?:-[a-z\d]+)*\b", re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+
+def normalize_for_clustering(task_description: str) -> List[str]:
+    text = DATE_PATTERN.sub(" <date> ", task_description)
+    text = CODE_PATTERN.sub(" <code> ", text)
+    text = NUMBER_PATTERN.sub(" <number> ", text)
+    return re.findall(r"<\w+>|\w+", text.lower())
+
+
+def get_shingles(tokens: List[str]) -> FrozenSet[str]:
+    # Words and pairs of words, so descriptions with the same words in another order are similar, but not identical
+    return frozenset(tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])])
+
+
+def jaccard_similarity(first: FrozenSet[str], second: FrozenSet[str]) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class MinHasher:
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, seed: int = 0):
+        # A fixed seed, so the clusters of a task list are the same in every worker
+        rng = random.Random(seed)
+        self.coefficients = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+                             for _ in range(permutations)]
+        # Task lists repeat the same words, so the hash values of a shingle are computed once
+        self.shingle_hashes: Dict[str, Tuple[int, ...]] = {}
+
+    def get_shingle_hashes(self, shingle: str) -> Tuple[int, ...]:
+        hashes = self.shingle_hashes.get(shingle)
+        if hashes is None:
+            value = zlib.crc32(shingle.encode('utf-8'))
+            hashes = self.shingle_hashes[shingle] = tuple((a * value + b) % MINHASH_PRIME
+                                                          for a, b in self.coefficients)
+        return hashes
+
+    def signature(self, shingles: FrozenSet[str]) -> List[int]:
+        return [min(values) for values in zip(*(self.get_shingle_hashes(shingle) for shingle in shingles))]
+
+
+def cluster_task_descriptions(task_descriptions: Sequence[str], similarity: float) -> List[int]:
+    # Returns the position of the representative of each description, which is its own position for a
+    # representative. Every description is compared with the representatives only, the first one that is similar
+    # enough is chosen, so a cluster does not drift away from its representative.
+    min_hasher = MinHasher()
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    buckets: List[Dict[tuple, List[int]]] = [{} for _ in range(MINHASH_BANDS)]
+    shingle_sets = []
+    representatives = []
+    for position, task_description in enumerate(task_descriptions):
+        shingles = get_shingles(normalize_for_clustering(task_description))
+        shingle_sets.append(shingles)
+        if not shingles:
+            representatives.append(position)
+            continue
+        signature = min_hasher.signature(shingles)
+        band_keys = [tuple(signature[band * rows:(band + 1) * rows]) for band in range(MINHASH_BANDS)]
+        candidates = sorted({candidate for band, key in enumerate(band_keys)
+                             for candidate in buckets[band].get(key, [])})
+        representative = next((candidate for candidate in candidates
+                               if jaccard_similarity(shingles, shingle_sets[candidate]) >= similarity), None)
+        if representative is not None:
+            representatives.append(representative)
+            continue
+        representatives.append(position)
+        for band, key in enumerate(band_keys):
+            buckets[band].setdefault(key, []).append(position)
+    return representatives
+
+
+def can_reuse_result(representative_cost: float, member_cost: float, cost_tolerance: float,
+                     cost_limits: List[float], margin: float) -> bool:
+    # A member only reuses the result of its representative when the costs are close, and no cost limit of the
+    # contract lies between them or close to either of them
+    if abs(member_cost - representative_cost) > cost_tolerance * max(abs(member_cost), abs(representative_cost)):
+        return False
+    low = min(member_cost, representative_cost) * (1 - margin)
+    high = max(member_cost, representative_cost) * (1 + margin)
+    return not any(low <= limit <= high for limit in cost_limits)
@@ -1,36 +1,302 @@
+import os
 import json
+import math
+import time
 import asyncio
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Optional, NamedTuple, AsyncIterator, Callable
 
 from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain.schema import BaseOutputParser
 from langchain_core.exceptions import OutputParserException
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
 from pydantic import ValidationError
 
-from backend.langchain_utils import invoke_chain_with_error_handling
-from backend.utils import extract_json_from_text
-from models import Contract, TaskAnalysisResult, TaskAnalysisResponse
+from backend.cost_rules import CostRuleEngine, find_cost_limits
+from backend.disk_cache import DiskCache
+from backend.json_repair import load_json_with_repair, coerce_task_analysis_data, record_repairs
+from backend.langchain_utils import ainvoke_chain_with_error_handling
+from backend.metrics import cascade_escalations, observe_stage, task_decisions
+from backend.single_flight import SingleFlight
+from backend.task_clustering import can_reuse_result, cluster_task_descriptions
+from backend.term_index import TermIndex, get_term_table
+from backend.token_estimation import estimate_prompt_tokens, estimate_wall_time
+from backend.utils import extract_json_from_text, hash_text
+from backend.models import (Contract, Term, TaskAnalysisOutput, TaskAnalysisResult, TaskAnalysisResponse,
+                            AnalysisEstimate)
+
+
+# Number of contract terms sent to the LLM per task. Set to 0 to always send the full contract.
+RETRIEVAL_TOP_K = int(os.getenv('CONTRACT_ANALYSIS_LLM_RETRIEVAL_TOP_K', 8))
+
+# Maximum number of tasks analyzed in one prompt. Set to 1 to analyze every task in its own prompt.
+TASK_BATCH_SIZE = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASK_BATCH_SIZE', 1))
+# Batches are closed earlier when the task descriptions together exceed this number of characters
+TASK_BATCH_MAX_CHARS = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASK_BATCH_MAX_CHARS', 4000))
+# Number of times the LLM is asked again for the tasks that are missing or invalid in a batch response
+TASK_BATCH_RETRIES = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASK_BATCH_RETRIES', 1))
+
+# Tasks that only match simple cost limits in the contract are decided locally, without the LLM
+COST_RULES_ENABLED = os.getenv('CONTRACT_ANALYSIS_LLM_COST_RULES', 'true').lower() == 'true'
+# A cost within this fraction of a limit is too close to decide locally
+COST_RULE_MARGIN = float(os.getenv('CONTRACT_ANALYSIS_LLM_COST_RULE_MARGIN', 0.05))
+
+# Near-duplicate tasks, e.g. the same trip on other dates, are clustered and only the representative of a cluster is
+# analyzed. Members reuse its result when their cost is within the tolerance (a fraction of the cost) and no cost
+# limit of the contract lies between the costs.
+TASK_CLUSTERING = os.getenv('CONTRACT_ANALYSIS_LLM_TASK_CLUSTERING', 'true').lower() == 'true'
+# Minimum Jaccard similarity of the normalized descriptions of a representative and its members
+CLUSTER_SIMILARITY = float(os.getenv('CONTRACT_ANALYSIS_LLM_CLUSTER_SIMILARITY', 0.8))
+CLUSTER_COST_TOLERANCE = float(os.getenv('CONTRACT_ANALYSIS_LLM_CLUSTER_COST_TOLERANCE', 0.1))
+
+# Model cascade: when a fast model is set, it analyzes every task first, and the result is only analyzed again by the
+# strong model when it is ambiguous, invalid or matches one of the escalation rules. Empty disables the cascade.
+CASCADE_FAST_MODEL = os.getenv('CONTRACT_ANALYSIS_LLM_CASCADE_FAST_MODEL', '')
+# Additional escalation rules: 'non_compliant' (the fast model found a violation) and 'no_terms' (it found no
+# applicable terms)
+CASCADE_ESCALATE_ON = [rule.strip() for rule in os.getenv('CONTRACT_ANALYSIS_LLM_CASCADE_ESCALATE_ON',
+                                                          'non_compliant').split(',') if rule.strip()]
+# Tasks with at least this cost go to the strong model directly. Set to 0 to disable.
+CASCADE_ESCALATE_COST = float(os.getenv('CONTRACT_ANALYSIS_LLM_CASCADE_ESCALATE_COST', 0))
+
+# Tiers in decided_by
+STRONG_MODEL_TIER = "llm"
+FAST_MODEL_TIER = "fast_llm"
+
+# Bump the prompt version whenever the compliance prompts change, so stale cached results are no longer used
+ANALYZE_TASK_COMPLIANCE_PROMPT_VERSION = "2"
+
+# Tokens of the result of one task in a response: the term ids, a few sentences of reasoning and the flags
+TASK_OUTPUT_TOKENS_ESTIMATE = 150
+# Maximum number of prompts that are rendered to estimate an analysis; the tokens of the others are extrapolated
+ESTIMATE_SAMPLE_PROMPTS = 200
+
+TASK_RESULT_CACHE_MAX_BYTES = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASK_RESULT_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+TASK_RESULT_CACHE_MAX_AGE = int(os.getenv('CONTRACT_ANALYSIS_LLM_TASK_RESULT_CACHE_MAX_AGE', 30 * 24 * 60 * 60))  # 30 days
 
 
 class TaskComplianceAnalysisAgent:
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0.6)
-        self.analyze_task_compliance_chain = get_analyze_task_compliance_chain(self.llm)
+    def __init__(self, llm: Optional[BaseChatModel] = None, fast_llm: Optional[BaseChatModel] = None):
+        # Another chat model can be passed in, e.g. a fake model for benchmarks. Retries are done by the retry policy
+        # in langchain_utils, so the client does not retry by itself.
+        self.llm = llm if llm is not None else ChatOpenAI(model="gpt-4o", temperature=0.6, max_retries=0)
+        if fast_llm is None and CASCADE_FAST_MODEL:
+            fast_llm = ChatOpenAI(model=CASCADE_FAST_MODEL, temperature=0.6, max_retries=0)
+        self.fast_llm = fast_llm
+        # Identical analyses that run at the same time, e.g. of the same sheet in two sessions, share one call
+        self.in_flight = SingleFlight("analyze_task_compliance")
+        self.batch_in_flight = SingleFlight("analyze_tasks_compliance_batch")
+        self.result_cache = DiskCache("task_results.sqlite3", TASK_RESULT_CACHE_MAX_BYTES, TASK_RESULT_CACHE_MAX_AGE)
+
+    def get_result_cache_key(self, contract_hash: str, task_description: str, task_cost: float) -> str:
+        # The retrieval and cascade settings are part of the key, because they change how a result is produced
+        cascade = f"cascade:{self.fast_llm.model_name}:{','.join(CASCADE_ESCALATE_ON)}:{CASCADE_ESCALATE_COST}" \
+            if self.fast_llm is not None else "cascade:"
+        return hash_text(self.llm.model_name, ANALYZE_TASK_COMPLIANCE_PROMPT_VERSION, f"top_k:{RETRIEVAL_TOP_K}",
+                         cascade, contract_hash, normalize_task_description(task_description),
+                         f"{float(task_cost):.2f}")
+
+    async def analyze_task_compliance(self, contract_json: str, task_description: str, task_cost: float,
+                                      escalation_reason: Optional[str] = None) -> TaskAnalysisResult:
+        call_key = hash_text(contract_json, str(task_description), f"{float(task_cost):.2f}", str(escalation_reason))
+        return await self.in_flight.run(call_key, lambda: self.analyze_task_compliance_cascade(
+            contract_json, task_description, task_cost, escalation_reason))
 
-    async def analyze_task_compliance(self, contract_json: str, task_description: str,
-                                      task_cost: float) -> TaskAnalysisResult:
+    async def analyze_task_compliance_cascade(self, contract_json: str, task_description: str, task_cost: float,
+                                              escalation_reason: Optional[str] = None) -> TaskAnalysisResult:
+        if self.fast_llm is None:
+            return await self.analyze_task_compliance_with(self.llm, STRONG_MODEL_TIER, contract_json,
+                                                           task_description, task_cost)
+        # A task that was already escalated, e.g. in a batch, goes straight to the strong model and is counted once
+        if escalation_reason is None:
+            escalation_reason = get_cost_escalation_reason(task_cost)
+            if escalation_reason is None:
+                try:
+                    fast_result = await self.analyze_task_compliance_with(self.fast_llm, FAST_MODEL_TIER,
+                                                                          contract_json, task_description, task_cost)
+                    escalation_reason = get_escalation_reason(fast_result)
+                except Exception:
+                    escalation_reason = "invalid"
+                if escalation_reason is None:
+                    return fast_result
+            cascade_escalations.inc(escalation_reason)
+        result = await self.analyze_task_compliance_with(self.llm, STRONG_MODEL_TIER, contract_json,
+                                                         task_description, task_cost)
+        return result.model_copy(update={'escalation_reason': escalation_reason})
+
+    async def analyze_task_compliance_with(self, llm: BaseChatModel, tier: str, contract_json: str,
+                                           task_description: str, task_cost: float) -> TaskAnalysisResult:
+        # The chain is created per contract, because its parser only accepts the ids of the terms in the prompt
+        term_table = get_term_table(contract_json)
         input_data = {
             'contract_json': contract_json,
             'task_description': task_description,
             'task_cost': task_cost,
             'extra_messages': []
         }
-        task_analysis_result = invoke_chain_with_error_handling(self.analyze_task_compliance_chain, input_data)
-        return task_analysis_result
+        chain = get_analyze_task_compliance_chain(llm, term_table)
+        task_analysis_output = await ainvoke_chain_with_error_handling(chain, input_data,
+                                                                       f"analyze_task_compliance:{tier}")
+        return expand_task_analysis_output(task_analysis_output, task_description, task_cost, term_table, tier)
+
+    async def analyze_tasks_compliance_batch(self, contract_json: str,
+                                             tasks: List[dict]) -> List[Optional[TaskAnalysisResult]]:
+        task_parts = [part for task in tasks
+                      for part in (str(task['task_description']), f"{float(task['task_cost']):.2f}")]
+        call_key = hash_text(contract_json, *task_parts)
+        return await self.batch_in_flight.run(call_key, lambda: self.analyze_tasks_compliance_batch_cascade(
+            contract_json, tasks))
+
+    async def analyze_tasks_compliance_batch_cascade(self, contract_json: str,
+                                                     tasks: List[dict]) -> List[Optional[TaskAnalysisResult]]:
+        if self.fast_llm is None:
+            return await self.analyze_tasks_compliance_batch_with(self.llm, STRONG_MODEL_TIER, contract_json, tasks)
+
+        escalation_reasons = [get_cost_escalation_reason(task['task_cost']) for task in tasks]
+        fast_indices = [i for i, reason in enumerate(escalation_reasons) if reason is None]
+        results: List[Optional[TaskAnalysisResult]] = [None] * len(tasks)
+        if fast_indices:
+            try:
+                fast_results = await self.analyze_tasks_compliance_batch_with(
+                    self.fast_llm, FAST_MODEL_TIER, contract_json, [tasks[i] for i in fast_indices])
+            except Exception:
+                fast_results = [None] * len(fast_indices)
+            for i, fast_result in zip(fast_indices, fast_results):
+                escalation_reasons[i] = get_escalation_reason(fast_result) if fast_result is not None else "invalid"
+                if escalation_reasons[i] is None:
+                    results[i] = fast_result
+
+        escalated_indices = [i for i, reason in enumerate(escalation_reasons) if reason is not None]
+        if escalated_indices:
+            for i in escalated_indices:
+                cascade_escalations.inc(escalation_reasons[i])
+            try:
+                strong_results = await self.analyze_tasks_compliance_batch_with(
+                    self.llm, STRONG_MODEL_TIER, contract_json, [tasks[i] for i in escalated_indices])
+            except Exception:
+                strong_results = [None] * len(escalated_indices)
+            for i, strong_result in zip(escalated_indices, strong_results):
+                if strong_result is not None:
+                    results[i] = strong_result.model_copy(update={'escalation_reason': escalation_reasons[i]})
+            # Escalated tasks without a valid result from the strong batch are analyzed one by one by the strong
+            # model, so the fast model is not asked again and a task that must be escalated is not decided by it
+            missing_indices = [i for i in escalated_indices if results[i] is None]
+            missing_results = await asyncio.gather(*(
+                self.analyze_task_compliance(contract_json, tasks[i]['task_description'], tasks[i]['task_cost'],
+                                             escalation_reason=escalation_reasons[i])
+                for i in missing_indices), return_exceptions=True)
+            for i, missing_result in zip(missing_indices, missing_results):
+                if isinstance(missing_result, Exception):
+                    missing_result = make_failed_result(tasks[i], missing_result)
+                results[i] = missing_result
+        return results
+
+    async def analyze_tasks_compliance_batch_with(self, llm: BaseChatModel, tier: str, contract_json: str,
+                                                  tasks: List[dict]) -> List[Optional[TaskAnalysisResult]]:
+        # Tasks are numbered from 1 in the prompt. The result list has the order of the tasks, with None for tasks
+        # that still have no valid result after the retries.
+        results: Dict[int, TaskAnalysisResult] = {}
+        term_table = get_term_table(contract_json)
+        chain = get_analyze_tasks_compliance_batch_chain(llm, term_table)
+        input_data = {
+            'contract_json': contract_json,
+            'tasks': format_tasks_for_batch_prompt(tasks),
+            'extra_messages': []
+        }
+        for attempt in range(TASK_BATCH_RETRIES + 1):
+            if attempt > 0:
+                # Ask again, but only for the tasks that are missing or invalid
+                missing_indices = [i for i in range(1, len(tasks) + 1) if i not in results]
+                input_data['extra_messages'].append(("ai", batch_result.llm_output))
+                input_data['extra_messages'].append(("human", format_batch_retry_message(missing_indices,
+                                                                                         batch_result.errors)))
+            batch_result = await ainvoke_chain_with_error_handling(chain, input_data,
+                                                                   f"analyze_tasks_compliance_batch:{tier}")
+            for task_index, output in batch_result.results.items():
+                if 1 <= task_index <= len(tasks) and task_index not in results:
+                    # The input is leading: the task index maps the result back to the task
+                    task = tasks[task_index - 1]
+                    results[task_index] = expand_task_analysis_output(output, task['task_description'],
+                                                                      task['task_cost'], term_table, tier)
+            if len(results) == len(tasks):
+                break
+        return [results.get(i) for i in range(1, len(tasks) + 1)]
+
+
+def expand_task_analysis_output(output: TaskAnalysisOutput, task_description: str, task_cost: float,
+                                term_table: Dict[str, Term], tier: str = STRONG_MODEL_TIER) -> TaskAnalysisResult:
+    # The LLM only returns the ids of the applicable terms; the response contains the full terms
+    return TaskAnalysisResult(
+        task_description=task_description,
+        task_cost=task_cost,
+        applicable_terms=[term_table[term_id] for term_id in dict.fromkeys(output.applicable_term_ids)],
+        reasoning=output.reasoning,
+        compliance=output.compliance,
+        ambiguous=output.ambiguous,
+        decided_by=tier
+    )
+
+
+def get_cost_escalation_reason(task_cost: float) -> Optional[str]:
+    if CASCADE_ESCALATE_COST > 0 and task_cost >= CASCADE_ESCALATE_COST:
+        return "cost"
+    return None
+
+
+def get_escalation_reason(fast_result: TaskAnalysisResult) -> Optional[str]:
+    # Returns why the result of the fast model must be checked by the strong model, or None to accept it
+    if fast_result.ambiguous:
+        return "ambiguous"
+    if 'non_compliant' in CASCADE_ESCALATE_ON and not fast_result.compliance:
+        return "non_compliant"
+    if 'no_terms' in CASCADE_ESCALATE_ON and not fast_result.applicable_terms:
+        return "no_terms"
+    return None
+
+
+def find_unknown_term_ids(output: TaskAnalysisOutput, term_table: Dict[str, Term]) -> List[str]:
+    return [term_id for term_id in output.applicable_term_ids if term_id not in term_table]
+
+
+def normalize_task_description(task_description: str) -> str:
+    return ' '.join(str(task_description).lower().split())
+
+
+def format_tasks_for_batch_prompt(tasks: List[dict]) -> str:
+    return '\n'.join(
+        f"TASK {i}: {task['task_description']}\nCOST {i}: {task['task_cost']}" for i, task in enumerate(tasks, start=1)
+    )
 
 
-def get_analyze_task_compliance_chain(llm: ChatOpenAI):
+def format_batch_retry_message(missing_indices: List[int], errors: Dict[int, str]) -> str:
+    lines = [f"The results for the following tasks are missing or invalid: {', '.join(map(str, missing_indices))}."]
+    for task_index in missing_indices:
+        if task_index in errors:
+            lines.append(f"- Task {task_index}: {errors[task_index]}")
+    lines.append("Respond with a JSON array that contains the results for these tasks only, and nothing else.")
+    return '\n'.join(lines)
+
+
+def make_task_batches(tasks: List[dict], max_batch_size: int, max_batch_chars: int) -> List[List[int]]:
+    # Returns batches of task indices. Many short tasks share one prompt, while long task descriptions get smaller
+    # batches.
+    batches = []
+    current_batch = []
+    current_chars = 0
+    for task_index, task in enumerate(tasks):
+        task_chars = len(str(task['task_description']))
+        if current_batch and (len(current_batch) >= max_batch_size or current_chars + task_chars > max_batch_chars):
+            batches.append(current_batch)
+            current_batch = []
+            current_chars = 0
+        current_batch.append(task_index)
+        current_chars += task_chars
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+def get_analyze_task_compliance_chain(llm: BaseChatModel, term_table: Dict[str, Term]):
 
     # JSON in prompt has double brackets, which is needed as escape characters.
     # Otherwise, LangChain tries to parse the texts as variables.
@@ -59,15 +325,8 @@ The analysis must be formatted as a JSON, detailed below.
 This is an example of the desired output, unrelated to the contract JSON above.
 
 {{
-  "task_description": "Training session in an offshore location in Greenland",
-  "task_cost": 2800,
-  "applicable_terms": [
-    {{
-      "title": "2.1 Travel Budget Cap",
-      "content": "The total travel budget for any single trip must not exceed $3,000."
-    }}
-  ],
-  "reasoning": "The trip does not exceed the budget cap of $3,000.",
+  "applicable_term_ids": ["T4"],
+  "reasoning": "The trip does not exceed the budget cap of $3,000 (T4).",
   "compliance": true,
   "ambiguous": false
 }}
@@ -75,28 +334,17 @@ This is an example of the desired output, unrelated to the contract JSON above.
 This is an example of an ambiguous case:
 
 {{
-  "task_description": "Training session in an offshore location in Greenland",
-  "task_cost": 4000,
-  "applicable_terms": [
-    {{
-      "title": "2.1 Travel Budget Cap",
-      "content": "The total travel budget for any single trip must not exceed $3,000."
-    }},
-    {{
-      "title": "2.2 Special Approval for Offshore Locations",
-      "content": "Trips to offshore locations may exceed the budget cap with prior written approval from the project manager."
-    }}
-  ],
-  "reasoning": "The trip was planned in advance and exceeds the budget cap of $3,000. However, it involves travel to an offshore location. It's unclear if prior approval was obtained, creating ambiguity about whether the expense is allowable.",
+  "applicable_term_ids": ["T4", "T5"],
+  "reasoning": "The trip was planned in advance and exceeds the budget cap of $3,000 (T4). However, it involves travel to an offshore location. It's unclear if prior approval was obtained, creating ambiguity about whether the expense is allowable.",
   "compliance": false,
   "ambiguous": true
 }}
 
 Notes on the example:
 - **All properties are required** and must match the structure provided.
-- **Terms consist of a title and content** and must refer back LITERALLY to the contract JSON.
+- **applicable_term_ids contains the ids of the applicable terms**, as given by the "id" of each term in the contract \
+JSON. Do NOT copy the title or content of the terms.
 - The JSON will be validated against a Pydantic model, so make sure to stick to the structure.
-- The task_cost type in the model is a float, so do not include a currency symbol.
 
 ### RESULT
 Respond with the JSON only. Do NOT add any other text. Stick to the structure of the JSON examples. 
@@ -113,16 +361,20 @@ Respond with the JSON only. Do NOT add any other text. Stick to the structure of
     chain = (
             prompt
             | llm
-            | TaskComplianceJsonOutputParser()
+            | TaskComplianceJsonOutputParser(term_table=term_table)
     )
     return chain
 
 
 class TaskComplianceJsonOutputParser(BaseOutputParser):
-    def parse(self, text: str) -> TaskAnalysisResult:
+    # The terms that were in the prompt: other term ids are rejected
+    term_table: Dict[str, Term] = {}
+
+    def parse(self, text: str) -> TaskAnalysisOutput:
         try:
             text = extract_json_from_text(text)
-            data = json.loads(text)
+            # Mechanical errors are repaired locally, which avoids another round trip to the LLM
+            data, repairs = load_json_with_repair(text)
         except json.JSONDecodeError as e:
             raise OutputParserException(
                 error=f"Invalid JSON format: {e}",
@@ -130,8 +382,9 @@ class TaskComplianceJsonOutputParser(BaseOutputParser):
                 llm_output=text,
                 send_to_llm=True
             )
+        repairs += coerce_task_analysis_data(data, text)
         try:
-            return TaskAnalysisResult(**data)
+            output = TaskAnalysisOutput.model_validate(data)
         except ValidationError as e:
             raise OutputParserException(
                 error=f"JSON does not conform to the expected structure: {e}",
@@ -139,29 +392,441 @@ class TaskComplianceJsonOutputParser(BaseOutputParser):
                 llm_output=text,
                 send_to_llm=True
             )
+        unknown_term_ids = find_unknown_term_ids(output, self.term_table)
+        if unknown_term_ids:
+            raise OutputParserException(
+                error=f"Unknown term ids: {', '.join(unknown_term_ids)}",
+                observation=format_unknown_term_ids_message(unknown_term_ids),
+                llm_output=text,
+                send_to_llm=True
+            )
+        record_repairs("task analysis result", repairs)
+        return output
 
 
-async def analyze_tasks_compliance(contract_json: str, tasks: List[dict],
-                                   agent: TaskComplianceAnalysisAgent) -> TaskAnalysisResponse:
+def format_unknown_term_ids_message(unknown_term_ids: List[str]) -> str:
+    return (f"The terms {', '.join(unknown_term_ids)} do not exist in the contract JSON. "
+            f"Only use the ids of the terms in the contract JSON in applicable_term_ids.")
+
+
+def get_analyze_tasks_compliance_batch_chain(llm: BaseChatModel, term_table: Dict[str, Term]):
+
+    # JSON in prompt has double brackets, which is needed as escape characters.
+    # Otherwise, LangChain tries to parse the texts as variables.
+
+    prompt_text = """### CONTEXT:
+The following JSON is a contract containing various terms and constraints for work execution.
+
+%%%
+{contract_json}
+%%%
+
+### OBJECTIVE
+You task is to analyze for each of the following tasks whether the task is compliant to the contract:
+
+{tasks}
+
+The analysis must be formatted as a JSON array with one result per task, detailed below.
+
+### GUIDELINES
+- Analyze each task on its own. Find the applicable terms in the contract and then reason whether the task complies \
+to these terms.
+- Possibly, the task compliance is ambiguous.
+
+### EXAMPLE
+
+This is an example of the desired output for two tasks, unrelated to the contract JSON above.
+
+[
+  {{
+    "task_index": 1,
+    "applicable_term_ids": ["T4"],
+    "reasoning": "The trip does not exceed the budget cap of $3,000 (T4).",
+    "compliance": true,
+    "ambiguous": false
+  }},
+  {{
+    "task_index": 2,
+    "applicable_term_ids": ["T4", "T5"],
+    "reasoning": "The trip exceeds the budget cap of $3,000 (T4). However, it involves travel to an offshore location. It's unclear if prior approval was obtained, creating ambiguity about whether the expense is allowable.",
+    "compliance": false,
+    "ambiguous": true
+  }}
+]
+
+Notes on the example:
+- **All properties are required** and must match the structure provided.
+- **task_index is the number of the task** in the list of tasks above.
+- **applicable_term_ids contains the ids of the applicable terms**, as given by the "id" of each term in the contract \
+JSON. Do NOT copy the title or content of the terms.
+- Each element will be validated against a Pydantic model, so make sure to stick to the structure.
+
+### RESULT
+Respond with the JSON array only. Do NOT add any other text. Stick to the structure of the JSON example. 
+"""
+
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You are an expert at judging compliance of tasks to a contract."),
+            ("human", prompt_text),
+            MessagesPlaceholder(variable_name="extra_messages")
+        ]
+    )
+
+    chain = (
+            prompt
+            | llm
+            | TaskComplianceBatchJsonOutputParser(term_table=term_table)
+    )
+    return chain
+
+
+class TaskBatchParseResult(NamedTuple):
+    results: Dict[int, TaskAnalysisOutput]
+    errors: Dict[int, str]
+    llm_output: str
+
+
+class TaskComplianceBatchJsonOutputParser(BaseOutputParser):
+    # Each element of the array is validated on its own, so one invalid result does not invalidate the whole batch
+    term_table: Dict[str, Term] = {}
+
+    def parse(self, text: str) -> TaskBatchParseResult:
+        try:
+            text = extract_json_from_text(text)
+            data, repairs = load_json_with_repair(text)
+        except json.JSONDecodeError as e:
+            raise OutputParserException(
+                error=f"Invalid JSON format: {e}",
+                observation="The output is not valid JSON. Ensure you provide the JSON as specified, and nothing else.",
+                llm_output=text,
+                send_to_llm=True
+            )
+        if isinstance(data, dict) and 'task_index' in data:
+            data = [data]
+            repairs.append("wrapped single result in an array")
+        if not isinstance(data, list):
+            raise OutputParserException(
+                error="JSON is not an array",
+                observation="The JSON structure is incorrect. Ensure it is an array with one result per task.",
+                llm_output=text,
+                send_to_llm=True
+            )
+        results = {}
+        errors = {}
+        for element in data:
+            if not isinstance(element, dict) or not isinstance(element.get('task_index'), int):
+                continue
+            task_index = element['task_index']
+            try:
+                repairs += coerce_task_analysis_data(element, text)
+                output = TaskAnalysisOutput.model_validate(element)
+            except OutputParserException as e:
+                errors[task_index] = e.observation
+                continue
+            except ValidationError as e:
+                errors[task_index] = f"JSON does not conform to the expected structure: {e}"
+                continue
+            unknown_term_ids = find_unknown_term_ids(output, self.term_table)
+            if unknown_term_ids:
+                errors[task_index] = format_unknown_term_ids_message(unknown_term_ids)
+                continue
+            results[task_index] = output
+        record_repairs("task analysis batch", repairs)
+        return TaskBatchParseResult(results=results, errors=errors, llm_output=text)
+
+
+# How the tasks of an analysis are decided, before any LLM call is made
+class TaskAnalysisPlan(NamedTuple):
+    # None when the contract cannot be indexed; the full contract is then sent with every task
+    term_index: Optional[TermIndex]
+    # Tasks by cache key. Identical tasks are analyzed once: the first task of each group is analyzed, the others
+    # reuse its result.
+    duplicate_groups: Dict[str, List[int]]
+    rule_results: Dict[str, TaskAnalysisResult]
+    # Cached results as JSON, by cache key
+    cached_results: Dict[str, str]
+    # Near-duplicate tasks that need the LLM are clustered. The id of a cluster is the index of its representative,
+    # and the members that reuse the result of a representative are listed by the index of the representative.
+    cluster_ids: Dict[int, int]
+    cluster_members: Dict[int, List[int]]
+    # Indices of the tasks that are sent to the LLM, by prompt
+    batches: List[List[int]]
+
+    def get_relevant_contract_json(self, contract_json: str, task_descriptions: List[str]) -> str:
+        if self.term_index is None:
+            return contract_json
+        return self.term_index.relevant_contract_json(task_descriptions, RETRIEVAL_TOP_K)
+
+
+async def plan_tasks_compliance(contract_json: str, tasks: List[dict], agent: TaskComplianceAnalysisAgent,
+                                get_cached_results: Callable[[List[str]], Dict[str, str]]) -> TaskAnalysisPlan:
+    # The index is built once, so each task prompt only needs to carry the terms that are relevant for the task
+    try:
+        term_index = TermIndex.from_contract_json(contract_json)
+    except ValueError:
+        term_index = None
+
+    contract_hash = hash_text(contract_json)
+    duplicate_groups: Dict[str, List[int]] = {}
+    for task_index, task in enumerate(tasks):
+        cache_key = agent.get_result_cache_key(contract_hash, task['task_description'], task['task_cost'])
+        duplicate_groups.setdefault(cache_key, []).append(task_index)
+
+    cost_rule_engine = CostRuleEngine(term_index, COST_RULE_MARGIN) if term_index and COST_RULES_ENABLED else None
+
+    rule_results: Dict[str, TaskAnalysisResult] = {}
+    undecided_keys = []
+    for cache_key, group_indices in duplicate_groups.items():
+        first_task = tasks[group_indices[0]]
+        rule_result = None
+        if cost_rule_engine is not None:
+            rule_result = cost_rule_engine.decide(first_task['task_description'], first_task['task_cost'])
+        if rule_result is not None:
+            rule_results[cache_key] = rule_result
+        else:
+            undecided_keys.append(cache_key)
+    # All tasks are looked up at once, in a thread, so the event loop does not wait for SQLite
+    cached_results = await asyncio.to_thread(get_cached_results, undecided_keys)
+    uncached_indices = [duplicate_groups[cache_key][0] for cache_key in undecided_keys
+                        if cache_key not in cached_results]
+
+    cluster_ids: Dict[int, int] = {}
+    cluster_members: Dict[int, List[int]] = {}
+    if TASK_CLUSTERING and len(uncached_indices) > 1:
+        # Clustering a large sheet takes a moment, so it does not block the event loop
+        representatives = await asyncio.to_thread(cluster_task_descriptions,
+                                                  [tasks[i]['task_description'] for i in uncached_indices],
+                                                  CLUSTER_SIMILARITY)
+        cost_limits = find_cost_limits(term_index) if term_index is not None else []
+        clusters: Dict[int, List[int]] = {}
+        for position, representative in enumerate(representatives):
+            clusters.setdefault(uncached_indices[representative], []).append(uncached_indices[position])
+        for representative_index, member_indices in clusters.items():
+            if len(member_indices) == 1:
+                continue
+            representative_cost = float(tasks[representative_index]['task_cost'])
+            for member_index in member_indices:
+                cluster_ids[member_index] = representative_index
+                # Members near a cost limit, or with a different cost, are analyzed on their own
+                if member_index != representative_index and can_reuse_result(
+                        representative_cost, float(tasks[member_index]['task_cost']), CLUSTER_COST_TOLERANCE,
+                        cost_limits, COST_RULE_MARGIN):
+                    cluster_members.setdefault(representative_index, []).append(member_index)
+        reused_indices = {i for member_indices in cluster_members.values() for i in member_indices}
+        uncached_indices = [i for i in uncached_indices if i not in reused_indices]
+
+    if TASK_BATCH_SIZE > 1:
+        uncached_tasks = [tasks[i] for i in uncached_indices]
+        batches = [[uncached_indices[i] for i in batch]
+                   for batch in make_task_batches(uncached_tasks, TASK_BATCH_SIZE, TASK_BATCH_MAX_CHARS)]
+    else:
+        batches = [[i] for i in uncached_indices]
+    return TaskAnalysisPlan(term_index, duplicate_groups, rule_results, cached_results, cluster_ids, cluster_members,
+                            batches)
+
+
+# Yields (task index, result) pairs as soon as they are available, so not in the order of the tasks
+async def iter_tasks_compliance(contract_json: str, tasks: List[dict],
+                                agent: TaskComplianceAnalysisAgent) -> AsyncIterator[Tuple[int, TaskAnalysisResult]]:
+    analysis_start = time.perf_counter()
+    plan = await plan_tasks_compliance(contract_json, tasks, agent, agent.result_cache.get_many)
+    duplicate_groups = plan.duplicate_groups
+    cluster_members = plan.cluster_members
+    cache_keys = {group_indices[0]: cache_key for cache_key, group_indices in duplicate_groups.items()}
 
     async def analyze_single_task(task):
         task_description = task['task_description']
         task_cost = task['task_cost']
+        task_contract_json = plan.get_relevant_contract_json(contract_json, [task_description])
         try:
-            return await agent.analyze_task_compliance(contract_json=contract_json,
+            return await agent.analyze_task_compliance(contract_json=task_contract_json,
                                                        task_description=task_description,
                                                        task_cost=task_cost)
         except Exception as e:
-            return TaskAnalysisResult(
-                task_description=task_description,
-                task_cost=task_cost,
-                applicable_terms=[],
-                reasoning=f"An error occurred while analyzing compliance: {e}.",
-                compliance=False,
-                ambiguous=True
-            )
+            return make_failed_result(task, e)
+
+    async def analyze_task_batch(batch: List[dict]) -> List[TaskAnalysisResult]:
+        batch_contract_json = plan.get_relevant_contract_json(contract_json,
+                                                              [task['task_description'] for task in batch])
+        try:
+            batch_results = await agent.analyze_tasks_compliance_batch(contract_json=batch_contract_json, tasks=batch)
+        except Exception:
+            batch_results = [None] * len(batch)
+        # Tasks without a valid result in the batch are analyzed one by one
+        missing_results = await asyncio.gather(
+            *(analyze_single_task(task) for task, result in zip(batch, batch_results) if result is None)
+        )
+        missing_results_iter = iter(missing_results)
+        return [result if result is not None else next(missing_results_iter) for result in batch_results]
+
+    async def analyze_indexed_batch(batch_indices: List[int]) -> List[Tuple[int, TaskAnalysisResult]]:
+        batch = [tasks[i] for i in batch_indices]
+        if len(batch) == 1:
+            batch_results = [await analyze_single_task(batch[0])]
+        else:
+            batch_results = await analyze_task_batch(batch)
+        indexed_results = list(zip(batch_indices, batch_results))
+        # The members of a cluster whose representative failed are analyzed on their own
+        failed_members = [member_index for task_index, result in indexed_results if result.failed
+                          for member_index in cluster_members.pop(task_index, [])]
+        member_results = await asyncio.gather(*(analyze_single_task(tasks[i]) for i in failed_members))
+        return indexed_results + list(zip(failed_members, member_results))
+
+    # Schedule all batches to run them concurrently
+    pending = [asyncio.ensure_future(analyze_indexed_batch(batch_indices)) for batch_indices in plan.batches]
+    try:
+        for cache_key, result in plan.rule_results.items():
+            task_decisions.inc("rules", amount=len(duplicate_groups[cache_key]))
+            for task_index in duplicate_groups[cache_key]:
+                yield task_index, result_for_task(result, tasks[task_index], cached=False)
+
+        for cache_key, cached_result_json in plan.cached_results.items():
+            result = TaskAnalysisResult.model_validate_json(cached_result_json)
+            task_decisions.inc("cache", amount=len(duplicate_groups[cache_key]))
+            for task_index in duplicate_groups[cache_key]:
+                yield task_index, result_for_task(result, tasks[task_index], cached=True)
+
+        for next_completed in asyncio.as_completed(pending):
+            for task_index, result in await next_completed:
+                cache_key = cache_keys[task_index]
+                # Results of failed analyses must not be cached. The results are written in the background, together
+                # with the other results that are available by then.
+                if not result.failed:
+                    agent.result_cache.set_later(cache_key, result.model_dump_json())
+                task_decisions.inc("error" if result.failed else result.decided_by)
+                task_decisions.inc("duplicate", amount=len(duplicate_groups[cache_key]) - 1)
+                analyzed_result = result
+                if task_index in plan.cluster_ids:
+                    result = result.model_copy(update={'cluster_id': plan.cluster_ids[task_index],
+                                                       'representative_index': task_index})
+                yield task_index, result
+                for duplicate_index in duplicate_groups[cache_key][1:]:
+                    yield duplicate_index, result_for_task(result, tasks[duplicate_index], cached=True)
+                # Members of a failed representative were analyzed on their own, so they are not in the cluster
+                for member_index in cluster_members.get(task_index, []):
+                    member_group = duplicate_groups[cache_keys[member_index]]
+                    task_decisions.inc("cluster", amount=len(member_group))
+                    # The reused result is cached for the member as well, without the cluster of this run, so the
+                    # member is not analyzed when its representative is a cache hit in a later run
+                    agent.result_cache.set_later(cache_keys[member_index], result_for_task(
+                        analyzed_result, tasks[member_index], cached=False).model_dump_json())
+                    for reusing_index in member_group:
+                        yield reusing_index, result_for_task(result, tasks[reusing_index], cached=False,
+                                                             cluster_reused=True)
+    finally:
+        # When the consumer stops early (e.g. the client disconnected), the remaining analyses are not needed
+        for future in pending:
+            future.cancel()
+        observe_stage("task_analysis", time.perf_counter() - analysis_start)
+
+
+def make_failed_result(task: dict, error: Exception) -> TaskAnalysisResult:
+    return TaskAnalysisResult(
+        task_description=task['task_description'],
+        task_cost=task['task_cost'],
+        applicable_terms=[],
+        reasoning=f"An error occurred while analyzing compliance: {error}.",
+        compliance=False,
+        ambiguous=True,
+        failed=True
+    )
+
+
+def result_for_task(result: TaskAnalysisResult, task: dict, cached: bool,
+                    cluster_reused: bool = False) -> TaskAnalysisResult:
+    # Reuses a result for a task with the same (normalized) description and cost, or for a member of its cluster
+    return result.model_copy(update={
+        'task_description': task['task_description'],
+        'task_cost': task['task_cost'],
+        'cached': cached,
+        'cluster_reused': cluster_reused
+    })
+
+
+async def analyze_tasks_compliance(contract_json: str, tasks: List[dict],
+                                   agent: TaskComplianceAnalysisAgent) -> TaskAnalysisResponse:
+    results = [None] * len(tasks)
+    async for task_index, result in iter_tasks_compliance(contract_json, tasks, agent):
+        results[task_index] = result
+    return TaskAnalysisResponse(
+        results=results,
+        cache_hits=sum(result.cached for result in results),
+        rule_decisions=sum(result.decided_by == "rules" for result in results),
+        fast_model_decisions=sum(result.decided_by == FAST_MODEL_TIER for result in results),
+        escalations=sum(result.escalation_reason is not None for result in results),
+        cluster_reuses=sum(result.cluster_reused for result in results)
+    )
+
+
+async def estimate_tasks_compliance(contract_json: str, tasks: List[dict],
+                                    agent: TaskComplianceAnalysisAgent) -> AnalysisEstimate:
+    # Plans the analysis like iter_tasks_compliance, but without calling the LLM and without using the cache entries.
+    # Retries, hedged calls and escalations of the fast model's results are not known in advance and not included.
+    plan = await plan_tasks_compliance(contract_json, tasks, agent, agent.result_cache.peek_many)
+    # Rendering the prompts of a large sheet takes a moment, so it does not block the event loop
+    llm_requests, input_tokens, analyzed_tasks = await asyncio.to_thread(estimate_prompts, plan, contract_json, tasks,
+                                                                         agent)
+    output_tokens = analyzed_tasks * TASK_OUTPUT_TOKENS_ESTIMATE
+
+    tier = FAST_MODEL_TIER if agent.fast_llm is not None else STRONG_MODEL_TIER
+    operation = f"analyze_tasks_compliance_batch:{tier}" if TASK_BATCH_SIZE > 1 else f"analyze_task_compliance:{tier}"
+    cache_keys = {group_indices[0]: cache_key for cache_key, group_indices in plan.duplicate_groups.items()}
+    llm_tasks = sum(len(batch) for batch in plan.batches)
+    cache_hits = sum(len(plan.duplicate_groups[cache_key]) for cache_key in plan.cached_results)
+    rule_decisions = sum(len(plan.duplicate_groups[cache_key]) for cache_key in plan.rule_results)
+    cluster_reuses = sum(len(plan.duplicate_groups[cache_keys[member_index]])
+                         for member_indices in plan.cluster_members.values() for member_index in member_indices)
+    return AnalysisEstimate(
+        llm_requests=llm_requests,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_tokens=input_tokens + output_tokens,
+        wall_time_s=estimate_wall_time(llm_requests, input_tokens, operation),
+        tasks=len(tasks),
+        llm_tasks=llm_tasks,
+        cache_hits=cache_hits,
+        rule_decisions=rule_decisions,
+        duplicates=len(tasks) - llm_tasks - cache_hits - rule_decisions - cluster_reuses,
+        cluster_reuses=cluster_reuses
+    )
 
-    # Gather all analyze_single_task coroutines to run them concurrently
-    results = await asyncio.gather(*(analyze_single_task(task) for task in tasks))
 
-    return TaskAnalysisResponse(results=results)
+def estimate_prompts(plan: TaskAnalysisPlan, contract_json: str, tasks: List[dict],
+                     agent: TaskComplianceAnalysisAgent) -> Tuple[int, int, int]:
+    # Returns the number of LLM calls, their input tokens and the number of task results they return. The prompts
+    # are rendered with the retrieved terms, like in the analysis, for an even sample of the batches.
+    if not plan.batches:
+        return 0, 0, 0
+    single_prompt = get_analyze_task_compliance_chain(agent.llm, {}).first
+    batch_prompt = get_analyze_tasks_compliance_batch_chain(agent.llm, {}).first
+    sample = plan.batches[::math.ceil(len(plan.batches) / ESTIMATE_SAMPLE_PROMPTS)]
+    llm_requests = input_tokens = analyzed_tasks = 0
+    for batch_indices in sample:
+        batch = [tasks[i] for i in batch_indices]
+        batch_contract_json = plan.get_relevant_contract_json(contract_json,
+                                                              [task['task_description'] for task in batch])
+        # With the cascade, the fast model gets the tasks below the escalation cost and the strong model the others
+        calls = [batch]
+        if agent.fast_llm is not None:
+            fast_tasks = [task for task in batch if get_cost_escalation_reason(task['task_cost']) is None]
+            escalated_tasks = [task for task in batch if get_cost_escalation_reason(task['task_cost']) is not None]
+            calls = [call for call in (fast_tasks, escalated_tasks) if call]
+        for call in calls:
+            if len(batch) == 1:
+                input_tokens += estimate_prompt_tokens(single_prompt, {
+                    'contract_json': batch_contract_json,
+                    'task_description': call[0]['task_description'],
+                    'task_cost': call[0]['task_cost'],
+                    'extra_messages': []
+                })
+            else:
+                input_tokens += estimate_prompt_tokens(batch_prompt, {
+                    'contract_json': batch_contract_json,
+                    'tasks': format_tasks_for_batch_prompt(call),
+                    'extra_messages': []
+                })
+            llm_requests += 1
+            analyzed_tasks += len(call)
+    scale = len(plan.batches) / len(sample)
+    return round(llm_requests * scale), round(input_tokens * scale), round(analyzed_tasks * scale)
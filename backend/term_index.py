@@ -0,0 +1,152 @@
+import re
+import math
+from collections import Counter
+from functools import lru_cache
+from itertools import count
+from typing import Dict, List, NamedTuple, Tuple, Set, Iterator
+
+from backend.models import Contract, Section, Term
+
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it", "its", "of", "on",
+    "or", "that", "the", "this", "to", "was", "were", "will", "with", "shall", "must", "may", "any", "all", "such"
+}
+
+
+class IndexedTerm(NamedTuple):
+    section_titles: Tuple[str, ...]
+    term: Term
+
+
+def flatten_contract_terms(contract: Contract) -> List[IndexedTerm]:
+    indexed_terms = []
+
+    def add_section_terms(section: Section, parent_titles: Tuple[str, ...]):
+        section_titles = parent_titles + (section.title,)
+        for term in section.terms:
+            indexed_terms.append(IndexedTerm(section_titles, term))
+        for subsection in section.subsections:
+            add_section_terms(subsection, section_titles)
+
+    for top_level_section in contract.sections:
+        add_section_terms(top_level_section, ())
+    return indexed_terms
+
+
+def assign_term_ids(contract: Contract) -> bool:
+    # Numbers the terms in the order of flatten_contract_terms, so the same contract always gets the same ids.
+    # Returns whether an id changed.
+    changed = False
+    for position, indexed_term in enumerate(flatten_contract_terms(contract), start=1):
+        term_id = f"T{position}"
+        if indexed_term.term.id != term_id:
+            indexed_term.term.id = term_id
+            changed = True
+    return changed
+
+
+@lru_cache(maxsize=64)
+def get_term_table(contract_json: str) -> Dict[str, Term]:
+    # The terms of a contract (or of a part of it that is sent to the LLM) by id
+    contract = Contract.model_validate_json(contract_json)
+    return {indexed_term.term.id: indexed_term.term for indexed_term in flatten_contract_terms(contract)
+            if indexed_term.term.id}
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOP_WORDS:
+            continue
+        # Very light stemming, so "visits" matches "visit"
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+# BM25 index over the flattened terms of a contract. It is used to send only the terms that are relevant for a task
+# to the LLM, instead of the whole contract.
+class TermIndex:
+    def __init__(self, contract: Contract, contract_json: str, k1: float = 1.5, b: float = 0.75):
+        self.contract = contract
+        self.contract_json = contract_json
+        self.k1 = k1
+        self.b = b
+        self.terms = flatten_contract_terms(contract)
+
+        self.term_frequencies: List[Counter] = []
+        self.document_lengths: List[int] = []
+        document_frequencies = Counter()
+        for indexed_term in self.terms:
+            term = indexed_term.term
+            tokens = tokenize(' '.join(indexed_term.section_titles + (term.title, term.content)))
+            term_frequency = Counter(tokens)
+            self.term_frequencies.append(term_frequency)
+            self.document_lengths.append(len(tokens))
+            document_frequencies.update(term_frequency.keys())
+
+        self.average_document_length = sum(self.document_lengths) / len(self.document_lengths) if self.terms else 0.0
+        document_count = len(self.terms)
+        self.inverse_document_frequencies = {
+            token: math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+            for token, frequency in document_frequencies.items()
+        }
+
+    @classmethod
+    def from_contract_json(cls, contract_json: str) -> 'TermIndex':
+        contract = Contract.model_validate_json(contract_json)
+        # Contracts that were extracted before terms had ids get them here
+        if assign_term_ids(contract):
+            contract_json = contract.model_dump_json(indent=2)
+        return cls(contract, contract_json)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        query_tokens = set(tokenize(query))
+        scores = []
+        for position, term_frequency in enumerate(self.term_frequencies):
+            score = 0.0
+            length_norm = 1 - self.b + self.b * self.document_lengths[position] / (self.average_document_length or 1)
+            for token in query_tokens:
+                frequency = term_frequency.get(token)
+                if frequency:
+                    score += (self.inverse_document_frequencies[token] * frequency * (self.k1 + 1)
+                              / (frequency + self.k1 * length_norm))
+            if score > 0:
+                scores.append((position, score))
+        scores.sort(key=lambda position_score: position_score[1], reverse=True)
+        return scores[:k]
+
+    def relevant_contract_json(self, queries: List[str], k: int) -> str:
+        positions = self.relevant_positions(queries, k)
+        if len(positions) == len(self.terms):
+            return self.contract_json
+        return self.contract_subset(positions).model_dump_json(indent=2)
+
+    def relevant_positions(self, queries: List[str], k: int) -> Set[int]:
+        # Each query contributes its top-k terms. Fall back to the full contract when retrieval is disabled,
+        # would not save anything, or finds nothing.
+        all_positions = set(range(len(self.terms)))
+        if k <= 0 or len(self.terms) <= k:
+            return all_positions
+        positions = {position for query in queries for position, _ in self.search(query, k)}
+        return positions or all_positions
+
+    def contract_subset(self, positions: Set[int]) -> Contract:
+        # Positions follow the order of flatten_contract_terms: the terms of a section first, then its subsections
+        return Contract(
+            title=self.contract.title,
+            definitions=self.contract.definitions,
+            sections=subset_sections(self.contract.sections, positions, count())
+        )
+
+
+def subset_sections(sections: List[Section], positions: Set[int], position_counter: Iterator[int]) -> List[Section]:
+    subset = []
+    for section in sections:
+        terms = [term for term in section.terms if next(position_counter) in positions]
+        subsections = subset_sections(section.subsections, positions, position_counter)
+        if terms or subsections:
+            subset.append(Section(title=section.title, terms=terms, subsections=subsections))
+    return subset
@@ -0,0 +1,168 @@
+import os
+import math
+import time
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from typing import List, NamedTuple, Optional, Tuple
+
+from backend.metrics import budget_decisions, estimated_tokens
+from backend.utils import DATA_DIR
+
+
+# Estimated tokens that one session, and all sessions together, may use in the budget window. Set to 0 to disable.
+SESSION_TOKEN_BUDGET = int(os.getenv('CONTRACT_ANALYSIS_LLM_SESSION_TOKEN_BUDGET', 0))
+GLOBAL_TOKEN_BUDGET = int(os.getenv('CONTRACT_ANALYSIS_LLM_GLOBAL_TOKEN_BUDGET', 0))
+TOKEN_BUDGET_WINDOW = int(os.getenv('CONTRACT_ANALYSIS_LLM_TOKEN_BUDGET_WINDOW', 60 * 60))  # 1 hour
+# A run that fits the budget within this many seconds waits for it, a run that does not is rejected
+TOKEN_BUDGET_MAX_WAIT = int(os.getenv('CONTRACT_ANALYSIS_LLM_TOKEN_BUDGET_MAX_WAIT', 30))
+
+BUDGET_ADMIT = "admit"
+BUDGET_QUEUE = "queue"
+BUDGET_REJECT = "reject"
+
+
+class Admission(NamedTuple):
+    decision: str
+    tokens: int
+    # Seconds until the run fits the budgets, or None when it never fits
+    wait: Optional[float]
+    # Tokens left in the budgets before the run, or None when a budget is disabled
+    session_remaining: Optional[int]
+    global_remaining: Optional[int]
+
+
+class BudgetExceededError(Exception):
+    def __init__(self, admission: Admission):
+        if admission.wait is None:
+            message = (f"The run needs about {admission.tokens:,} tokens, which is more than the token budget "
+                       f"allows.")
+        else:
+            message = f"The token budget is used up. Please try again in {math.ceil(admission.wait)} seconds."
+        super().__init__(message)
+        self.admission = admission
+
+    @property
+    def retry_after(self) -> Optional[int]:
+        return math.ceil(self.admission.wait) if self.admission.wait is not None else None
+
+
+# Admission control for runs that call the LLM. A run is charged with its estimated tokens before its first call, and
+# the charges count against the budgets for the length of the window. The charges are kept in SQLite, so the budgets
+# are shared by all workers on this machine.
+class TokenBudget:
+    def __init__(self, session_budget: int, global_budget: int, window: float, max_wait: float,
+                 filename: str = "token_budget.sqlite3"):
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.window = window
+        self.max_wait = max_wait
+        self.path = os.path.join(DATA_DIR, filename)
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS budget_charges ("
+                "session_id TEXT NOT NULL, tokens INTEGER NOT NULL, charged_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS budget_charges_charged_at ON budget_charges (charged_at)")
+
+    @property
+    def enabled(self) -> bool:
+        return self.session_budget > 0 or self.global_budget > 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def check(self, session_id: str, tokens: int) -> Admission:
+        # Returns the decision for a run without charging it, e.g. for a dry run
+        if not self.enabled:
+            return Admission(BUDGET_ADMIT, tokens, 0.0, None, None)
+        with self._connect() as conn:
+            return self._check(conn, session_id, tokens, time.time(), self.max_wait)
+
+    def try_charge(self, session_id: str, tokens: int, max_wait: float) -> Admission:
+        now = time.time()
+        with self._connect() as conn:
+            # The write lock is taken first, so two workers cannot both admit a run into the last tokens
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM budget_charges WHERE charged_at <= ?", (now - self.window,))
+            admission = self._check(conn, session_id, tokens, now, max_wait)
+            if admission.decision == BUDGET_ADMIT:
+                conn.execute("INSERT INTO budget_charges (session_id, tokens, charged_at) VALUES (?, ?, ?)",
+                             (session_id, tokens, now))
+            return admission
+
+    async def admit(self, session_id: str, tokens: int) -> Admission:
+        # Waits until the run fits the budgets and charges it, or raises BudgetExceededError when it does not fit
+        # within the maximum wait. The SQLite transactions run in a thread, so they do not block the event loop.
+        if not self.enabled or tokens <= 0:
+            return Admission(BUDGET_ADMIT, tokens, 0.0, None, None)
+        deadline = time.monotonic() + self.max_wait
+        queued = False
+        while True:
+            admission = await asyncio.to_thread(self.try_charge, session_id, tokens,
+                                                max(0.0, deadline - time.monotonic()))
+            if admission.decision == BUDGET_ADMIT:
+                budget_decisions.inc("queued" if queued else "admitted")
+                estimated_tokens.inc(amount=tokens)
+                return admission
+            if admission.decision == BUDGET_REJECT:
+                budget_decisions.inc("rejected")
+                raise BudgetExceededError(admission)
+            queued = True
+            await asyncio.sleep(admission.wait)
+
+    def _check(self, conn: sqlite3.Connection, session_id: str, tokens: int, now: float,
+               max_wait: float) -> Admission:
+        since = now - self.window
+        waits = []
+        remaining = []
+        for budget, session_filter in ((self.session_budget, session_id), (self.global_budget, None)):
+            if budget <= 0:
+                remaining.append(None)
+                continue
+            charges = self._get_charges(conn, since, session_filter)
+            remaining.append(max(0, budget - sum(charged_tokens for _, charged_tokens in charges)))
+            waits.append(get_budget_wait(charges, budget, tokens, self.window, now))
+
+        wait = None if None in waits else max(waits, default=0.0)
+        if wait == 0:
+            decision = BUDGET_ADMIT
+        elif wait is not None and wait <= max_wait:
+            decision = BUDGET_QUEUE
+        else:
+            decision = BUDGET_REJECT
+        return Admission(decision, tokens, wait, *remaining)
+
+    def _get_charges(self, conn: sqlite3.Connection, since: float,
+                     session_id: Optional[str]) -> List[Tuple[float, int]]:
+        if session_id is None:
+            return conn.execute("SELECT charged_at, tokens FROM budget_charges WHERE charged_at > ? "
+                                "ORDER BY charged_at", (since,)).fetchall()
+        return conn.execute("SELECT charged_at, tokens FROM budget_charges WHERE charged_at > ? AND session_id = ? "
+                            "ORDER BY charged_at", (since, session_id)).fetchall()
+
+
+def get_budget_wait(charges: List[Tuple[float, int]], budget: int, tokens: int, window: float,
+                    now: float) -> Optional[float]:
+    # Seconds until enough of the oldest charges have left the window for the run to fit, or None when the run is
+    # larger than the budget
+    if tokens > budget:
+        return None
+    excess = sum(charged_tokens for _, charged_tokens in charges) + tokens - budget
+    if excess <= 0:
+        return 0.0
+    for charged_at, charged_tokens in charges:
+        excess -= charged_tokens
+        if excess <= 0:
+            return max(0.0, charged_at + window - now)
+    return window
+
+
+token_budget = TokenBudget(SESSION_TOKEN_BUDGET, GLOBAL_TOKEN_BUDGET, TOKEN_BUDGET_WINDOW, TOKEN_BUDGET_MAX_WAIT)
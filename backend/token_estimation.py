@@ -0,0 +1,38 @@
+import math
+
+from backend.rate_limiting import (COMPLETION_TOKENS_ESTIMATE, MAX_CONCURRENT_LLM_CALLS, REQUESTS_PER_MINUTE,
+                                   TOKENS_PER_MINUTE)
+from backend.retry_policy import latency_tracker
+
+
+# Local estimate of the tokens of a text, without a tokenizer: English text and JSON average about 4 characters per
+# token for the OpenAI models, and every message of a chat adds a few tokens for its role and separators
+CHARACTERS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+# Latency of an LLM call that is assumed until enough calls of the operation were measured
+ESTIMATED_CALL_LATENCY = 10.0
+
+
+def estimate_text_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+
+def estimate_prompt_tokens(prompt, input_data: dict) -> int:
+    # The prompt is rendered like in the call, so the template and the examples are counted as well
+    messages = prompt.format_messages(**input_data)
+    return sum(estimate_text_tokens(str(message.content)) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def estimate_wall_time(llm_requests: int, input_tokens: int, operation: str) -> float:
+    # The calls run concurrently up to the concurrency limit, and the rate limits allow a burst of one minute of
+    # quota, after which the calls are spread over the following minutes
+    if llm_requests == 0:
+        return 0.0
+    latency = latency_tracker.percentile(operation, 0.5) or ESTIMATED_CALL_LATENCY
+    concurrency = MAX_CONCURRENT_LLM_CALLS if MAX_CONCURRENT_LLM_CALLS > 0 else llm_requests
+    wall_time = math.ceil(llm_requests / concurrency) * latency
+    rate_limited_tokens = input_tokens + llm_requests * COMPLETION_TOKENS_ESTIMATE
+    for amount, limit_per_minute in ((llm_requests, REQUESTS_PER_MINUTE), (rate_limited_tokens, TOKENS_PER_MINUTE)):
+        if limit_per_minute > 0 and amount > limit_per_minute:
+            wall_time = max(wall_time, (amount - limit_per_minute) / limit_per_minute * 60 + latency)
+    return round(wall_time, 1)
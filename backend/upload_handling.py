@@ -0,0 +1,111 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from backend.metrics import rejected_uploads
+
+
+# Uploads larger than this are rejected with 413 before they are parsed
+MAX_UPLOAD_BYTES = int(os.getenv('CONTRACT_ANALYSIS_LLM_MAX_UPLOAD_BYTES', 50 * 2 ** 20))  # 50 MB
+# Number of threads that parse uploaded files, so the parsing does not block the event loop
+PARSING_WORKERS = int(os.getenv('CONTRACT_ANALYSIS_LLM_PARSING_WORKERS', 2))
+# Number of uploads that may wait for a parsing thread. More uploads are rejected with 503.
+PARSING_QUEUE_DEPTH = int(os.getenv('CONTRACT_ANALYSIS_LLM_PARSING_QUEUE_DEPTH', 8))
+# Seconds after which a client should retry an upload that was rejected because the parsing pool is full
+PARSING_RETRY_AFTER = 5
+
+
+class ParsingPoolFullError(Exception):
+    pass
+
+
+class UploadTooLargeError(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=413, detail=get_upload_too_large_message())
+
+
+# Runs the blocking parsing of uploads in a thread pool with a bounded queue. An upload that would exceed the queue
+# is rejected immediately instead of waiting behind all the others.
+class ParsingPool:
+    def __init__(self, workers: int, queue_depth: int):
+        self.workers = workers
+        self.max_pending = workers + queue_depth
+        self.pending = 0
+        # Created on first use, and again after a shutdown, e.g. when the app is started again in tests
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    async def run(self, function: Callable[..., Any], *args) -> Any:
+        if self.pending >= self.max_pending:
+            rejected_uploads.inc("overloaded")
+            raise ParsingPoolFullError("The server is busy parsing other uploads. Please try again later.")
+        self.pending += 1
+        try:
+            # The context is copied, so the stage timings of the parsing are traced with the session of the request
+            context = contextvars.copy_context()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="parsing")
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(context.run, function, *args))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def is_upload_too_large(size: Optional[int]) -> bool:
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        rejected_uploads.inc("too_large")
+        return True
+    return False
+
+
+def get_upload_too_large_message() -> str:
+    return f"The file is too large. The maximum size is {round(MAX_UPLOAD_BYTES / 2 ** 20, 1):g} MB."
+
+
+def upload_too_large_response() -> JSONResponse:
+    return JSONResponse(content={"message": get_upload_too_large_message()}, status_code=413)
+
+
+# Rejects too large uploads while they are received: by their Content-Length before the body is read, and otherwise
+# (e.g. a chunked request without a Content-Length) as soon as the received body passes the maximum, so a too large
+# upload is never spooled in full
+class UploadSizeLimitMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        content_length = Headers(scope=scope).get('content-length')
+        if content_length is not None and content_length.isdigit() and is_upload_too_large(int(content_length)):
+            await upload_too_large_response()(scope, receive, send)
+            return
+
+        received_bytes = 0
+
+        async def receive_limited() -> Message:
+            nonlocal received_bytes
+            message = await receive()
+            if message['type'] == 'http.request':
+                received_bytes += len(message.get('body', b''))
+                # Raised in the endpoint that reads the body; the app turns it into the 413 response
+                if is_upload_too_large(received_bytes):
+                    raise UploadTooLargeError()
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+parsing_pool = ParsingPool(PARSING_WORKERS, PARSING_QUEUE_DEPTH)
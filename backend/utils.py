@@ -1,4 +1,9 @@
+import os
 import re
+import hashlib
+
+
+DATA_DIR = os.getenv('CONTRACT_ANALYSIS_LLM_DATA_DIR', '.data')
 
 
 def extract_json_from_text(text: str) -> str:
@@ -10,3 +15,12 @@ def extract_json_from_text(text: str) -> str:
     else:
         # No JSON block found; use the entire text
         return text.strip()
+
+
+def hash_text(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        # Separator, so ("ab", "c") and ("a", "bc") hash differently
+        digest.update(b'\0')
+    return digest.hexdigest()
@@ -0,0 +1,123 @@
+import re
+import json
+import time
+from random import Random
+import asyncio
+from typing import Any, List, Optional
+
+import httpx
+import openai
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatResult, ChatGeneration
+from pydantic import Field
+
+
+SINGLE_TASK_PATTERN = re.compile(r"^TASK: (?P<description>.*)\nCOST: (?P<cost>.*)$", re.MULTILINE)
+BATCH_TASK_PATTERN = re.compile(r"^TASK (?P<index>\d+): (?P<description>.*)\nCOST \d+: (?P<cost>.*)$", re.MULTILINE)
+TERM_ID_PATTERN = re.compile(r'"id": "(T\d+)"')
+
+
+# A connection error, so the retry policy treats it like a transient API error
+class FakeLLMError(openai.APIConnectionError):
+    def __init__(self, message: str):
+        super().__init__(message=message, request=httpx.Request("POST", "https://fake-chat-model.invalid"))
+
+
+class FakeChatModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.invalid_outputs = 0
+        self.errors = 0
+        self.call_latencies: List[float] = []
+
+
+# Local stand-in for ChatOpenAI. It answers the extraction and compliance prompts of the agents with canned outputs
+# after a configurable latency, and fails or returns invalid JSON at configurable rates.
+class FakeChatModel(BaseChatModel):
+    model_name: str = "fake-chat-model"
+    contract_json: str
+    latency: float = 0.05
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    invalid_json_rate: float = 0.0
+    seed: int = 0
+    stats: FakeChatModelStats = Field(default_factory=FakeChatModelStats)
+    rng: Random = Field(default_factory=Random)
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def model_post_init(self, __context: Any):
+        self.rng.seed(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs) -> ChatResult:
+        latency = self._next_latency()
+        time.sleep(latency)
+        return self._respond(messages, latency)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs) -> ChatResult:
+        latency = self._next_latency()
+        await asyncio.sleep(latency)
+        return self._respond(messages, latency)
+
+    def _next_latency(self) -> float:
+        return max(0.0, self.latency + self.rng.uniform(-self.latency_jitter, self.latency_jitter))
+
+    def _respond(self, messages: List[BaseMessage], latency: float) -> ChatResult:
+        self.stats.calls += 1
+        self.stats.call_latencies.append(latency)
+        # The agents append the failed output and a correction to the conversation when they ask again
+        if len(messages) > 2:
+            self.stats.retries += 1
+        if self.rng.random() < self.error_rate:
+            self.stats.errors += 1
+            raise FakeLLMError("Simulated API error")
+
+        prompt = next(message.content for message in messages if isinstance(message, HumanMessage))
+        if self.rng.random() < self.invalid_json_rate:
+            self.stats.invalid_outputs += 1
+            content = "Sorry, I cannot produce the JSON for this request."
+        else:
+            content = self._canned_output(prompt)
+
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        output_tokens = len(content) // 4
+        message = AIMessage(content=content, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens
+        })
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                                        "total_tokens": input_tokens + output_tokens}}
+        )
+
+    def _canned_output(self, prompt: str) -> str:
+        # Results refer to terms that are in the prompt, like a real model would
+        term_ids = TERM_ID_PATTERN.findall(prompt)
+        batch_tasks = list(BATCH_TASK_PATTERN.finditer(prompt))
+        if batch_tasks:
+            return json.dumps([
+                dict(task_index=int(match.group('index')), **self._task_result(term_ids)) for match in batch_tasks
+            ])
+        if SINGLE_TASK_PATTERN.search(prompt):
+            return json.dumps(self._task_result(term_ids))
+        return self.contract_json
+
+    def _task_result(self, term_ids: List[str]) -> dict:
+        compliance = self.rng.random() < 0.8
+        return {
+            "applicable_term_ids": self.rng.sample(term_ids, min(2, len(term_ids))),
+            "reasoning": "Synthetic result of the fake chat model.",
+            "compliance": compliance,
+            "ambiguous": not compliance and self.rng.random() < 0.5
+        }
@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+# The backend reads its configuration at import time, so the benchmark environment is set up first
+BENCHMARK_DIR = tempfile.mkdtemp(prefix="contract_analysis_benchmark_")
+os.environ.setdefault('CONTRACT_ANALYSIS_LLM_SECRET', 'benchmark-secret')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+os.environ['CONTRACT_ANALYSIS_LLM_CACHE_DIR'] = os.path.join(BENCHMARK_DIR, "cache")
+os.environ['CONTRACT_ANALYSIS_LLM_DATA_DIR'] = os.path.join(BENCHMARK_DIR, "data")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline offline with a fake chat model.")
+    parser.add_argument('--tasks', default="10,100,1000",
+                        help="Comma-separated numbers of tasks to benchmark (default: 10,100,1000)")
+    parser.add_argument('--contract-sections', type=int, default=20, help="Sections in the synthetic contract")
+    parser.add_argument('--latency', type=float, default=0.05, help="Latency of a fake LLM call in seconds")
+    parser.add_argument('--latency-jitter', type=float, default=0.02, help="Random variation of the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of fake LLM calls that raise")
+    parser.add_argument('--invalid-json-rate', type=float, default=0.02,
+                        help="Fraction of fake LLM calls that return invalid JSON")
+    parser.add_argument('--fast-latency', type=float, default=0.0,
+                        help="Latency of the fast model of the cascade in seconds. 0 disables the cascade")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help="Fraction of tasks that repeat an earlier task of the same sheet")
+    parser.add_argument('--near-duplicate-rate', type=float, default=0.0,
+                        help="Fraction of tasks that repeat an earlier task with another order number and a cost "
+                             "that differs by up to 5%%")
+    parser.add_argument('--hedge-after', default="",
+                        help="Seconds or a latency percentile like p95 after which a slow call is hedged")
+    parser.add_argument('--backoff-base', type=float, default=0.05,
+                        help="Base delay in seconds of the backoff between retries of failed calls")
+    parser.add_argument('--max-concurrent-calls', type=int, default=16)
+    parser.add_argument('--requests-per-minute', type=int, default=0, help="0 disables the limit")
+    parser.add_argument('--tokens-per-minute', type=int, default=0, help="0 disables the limit")
+    parser.add_argument('--skip-endpoints', action='store_true', help="Only benchmark the agents, not the API")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default="bench_results.json", help="Path of the JSON report")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ['CONTRACT_ANALYSIS_LLM_MAX_CONCURRENT_CALLS'] = str(args.max_concurrent_calls)
+os.environ['CONTRACT_ANALYSIS_LLM_REQUESTS_PER_MINUTE'] = str(args.requests_per_minute)
+os.environ['CONTRACT_ANALYSIS_LLM_TOKENS_PER_MINUTE'] = str(args.tokens_per_minute)
+os.environ['CONTRACT_ANALYSIS_LLM_HEDGE_AFTER'] = args.hedge_after
+os.environ['CONTRACT_ANALYSIS_LLM_BACKOFF_BASE'] = str(args.backoff_base)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend.contract_term_extraction import ContractTermExtractionAgent  # noqa: E402
+from backend.models import Contract, Section, Term  # noqa: E402
+from backend.task_compliance_analysis import TaskComplianceAnalysisAgent, iter_tasks_compliance  # noqa: E402
+from benchmarks.fake_chat_model import FakeChatModel  # noqa: E402
+
+
+SUBJECTS = ["travel", "maintenance", "training", "consulting", "hardware", "software", "catering", "cleaning",
+            "security", "transport", "inspection", "repair", "installation", "licensing", "hosting", "support"]
+LOCATIONS = ["Rotterdam", "Amsterdam", "Utrecht", "Eindhoven", "Groningen", "offshore platform", "Antwerp", "Hamburg"]
+
+
+def create_synthetic_contract(section_count: int, rng: random.Random) -> Tuple[str, Contract]:
+    sections = []
+    for section_number in range(1, section_count + 1):
+        subject = SUBJECTS[(section_number - 1) % len(SUBJECTS)]
+        terms = [
+            Term(title=f"{section_number}.1 {subject.title()} Cap",
+                 content=f"The cost of any single {subject} task must not exceed ${rng.randint(5, 50) * 100:,}."),
+            Term(title=f"{section_number}.2 {subject.title()} Approval",
+                 content=f"{subject.title()} tasks at offshore locations require prior written approval."),
+            Term(title=f"{section_number}.3 {subject.title()} Reporting",
+                 content=f"All {subject} tasks must be reported within 5 working days after completion.")
+        ]
+        sections.append(Section(title=f"{section_number}. {subject.title()}", terms=terms, subsections=[]))
+    contract = Contract(
+        title="Synthetic Framework Agreement",
+        definitions={"Supplier": "The party that executes the tasks.", "Client": "The party that orders the tasks."},
+        sections=sections
+    )
+    lines = [contract.title, "", "DEFINITIONS"]
+    lines += [f"{name}: {definition}" for name, definition in contract.definitions.items()]
+    for section in contract.sections:
+        lines += ["", section.title]
+        lines += [f"{term.title}\n{term.content}" for term in section.terms]
+    return '\n'.join(lines), contract
+
+
+def create_synthetic_tasks(task_count: int, duplicate_rate: float, near_duplicate_rate: float,
+                           rng: random.Random) -> List[dict]:
+    tasks = []
+    for i in range(task_count):
+        if tasks and rng.random() < duplicate_rate:
+            tasks.append(dict(rng.choice(tasks)))
+            continue
+        if tasks and rng.random() < near_duplicate_rate:
+            task = rng.choice(tasks)
+            tasks.append({
+                "task_description": task['task_description'].rsplit(' ', 1)[0] + f" {i}",
+                "task_cost": round(task['task_cost'] * rng.uniform(0.95, 1.05), 2)
+            })
+            continue
+        subject = rng.choice(SUBJECTS)
+        tasks.append({
+            "task_description": f"{subject.title()} at {rng.choice(LOCATIONS)}, order {i}",
+            "task_cost": float(rng.randint(1, 60) * 100)
+        })
+    return tasks
+
+
+def create_docx(contract_text: str) -> bytes:
+    document = Document()
+    for line in contract_text.split('\n'):
+        document.add_paragraph(line)
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def create_csv(tasks: List[dict]) -> bytes:
+    lines = ["Task Description,Amount"]
+    lines += [f"\"{task['task_description']}\",\"${task['task_cost']:,.2f}\"" for task in tasks]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def percentile(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+    return {"p50": percentile(0.50), "p95": percentile(0.95), "p99": percentile(0.99)}
+
+
+def create_fake_llm(contract: Contract, seed: int, latency: Optional[float] = None,
+                    model_name: str = "fake-chat-model") -> FakeChatModel:
+    latency = args.latency if latency is None else latency
+    return FakeChatModel(
+        model_name=model_name,
+        contract_json=contract.model_dump_json(indent=2),
+        latency=latency,
+        latency_jitter=min(args.latency_jitter, latency),
+        error_rate=args.error_rate,
+        invalid_json_rate=args.invalid_json_rate,
+        seed=seed
+    )
+
+
+def llm_stats(llm: FakeChatModel) -> dict:
+    return {
+        "llm_calls": llm.stats.calls,
+        "llm_retries": llm.stats.retries,
+        "llm_invalid_outputs": llm.stats.invalid_outputs,
+        "llm_errors": llm.stats.errors,
+        "llm_call_latency_s": percentiles(llm.stats.call_latencies)
+    }
+
+
+async def benchmark_extraction(contract_text: str, contract: Contract, seed: int) -> dict:
+    llm = create_fake_llm(contract, seed)
+    agent = ContractTermExtractionAgent(llm=llm)
+    tracemalloc.start()
+    start = time.perf_counter()
+    await agent.extract_contract_terms(contract_text)
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_time_s": round(wall_time, 4), "peak_memory_mb": round(peak_memory / 2 ** 20, 2), **llm_stats(llm)}
+
+
+def create_fake_fast_llm(contract: Contract, seed: int) -> Optional[FakeChatModel]:
+    if args.fast_latency <= 0:
+        return None
+    return create_fake_llm(contract, seed + 1000, latency=args.fast_latency, model_name="fake-fast-chat-model")
+
+
+async def benchmark_analysis(contract: Contract, tasks: List[dict], seed: int) -> dict:
+    llm = create_fake_llm(contract, seed)
+    fast_llm = create_fake_fast_llm(contract, seed)
+    agent = TaskComplianceAnalysisAgent(llm=llm, fast_llm=fast_llm)
+    result_latencies = []
+    results = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    async for _, result in iter_tasks_compliance(contract.model_dump_json(indent=2), tasks, agent):
+        # Time from the start of the run until the result is available, as a streaming client would see it
+        result_latencies.append(time.perf_counter() - start)
+        results.append(result)
+    wall_time = time.perf_counter() - start
+    # The results are cached in the background; the run is done when they are written
+    await agent.result_cache.flush()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wall_time_s": round(wall_time, 4),
+        "throughput_tasks_per_s": round(len(tasks) / wall_time, 2) if wall_time else None,
+        "result_latency_s": percentiles(result_latencies),
+        "peak_memory_mb": round(peak_memory / 2 ** 20, 2),
+        "cache_hits": sum(result.cached for result in results),
+        "rule_decisions": sum(result.decided_by == "rules" for result in results),
+        "fast_model_decisions": sum(result.decided_by == "fast_llm" for result in results),
+        "escalations": sum(result.escalation_reason is not None for result in results),
+        "cluster_reuses": sum(result.cluster_reused for result in results),
+        "failed_tasks": sum(result.failed for result in results),
+        **llm_stats(llm),
+        **({f"fast_{key}": value for key, value in llm_stats(fast_llm).items()} if fast_llm is not None else {})
+    }
+
+
+def benchmark_endpoints(contract_text: str, contract: Contract, tasks: List[dict], seed: int) -> dict:
+    import backend.app as app_module
+
+    llm = create_fake_llm(contract, seed)
+    app_module.contract_term_extraction_agent = ContractTermExtractionAgent(llm=llm)
+    app_module.task_compliance_analysis_agent = TaskComplianceAnalysisAgent(
+        llm=llm, fast_llm=create_fake_fast_llm(contract, seed))
+    timings = {}
+    with TestClient(app_module.app) as client:
+        for name, send_request in [
+            ("upload_contract", lambda: client.post("/upload_contract", files={
+                'file': ("contract.docx", create_docx(contract_text), "application/octet-stream")})),
+            ("upload_tasks", lambda: client.post("/upload_tasks", files={
+                'file': ("tasks.csv", create_csv(tasks), "text/csv")})),
+            ("get_tasks", lambda: client.get("/get_tasks")),
+            ("analyze_tasks", lambda: client.get("/analyze_tasks"))
+        ]:
+            start = time.perf_counter()
+            response = send_request()
+            timings[name] = {"wall_time_s": round(time.perf_counter() - start, 4), "status_code": response.status_code}
+    return {**timings, **llm_stats(llm)}
+
+
+async def run_benchmarks() -> dict:
+    rng = random.Random(args.seed)
+    contract_text, contract = create_synthetic_contract(args.contract_sections, rng)
+    runs = []
+    for run_number, task_count in enumerate(int(count) for count in args.tasks.split(',')):
+        tasks = create_synthetic_tasks(task_count, args.duplicate_rate, args.near_duplicate_rate, rng)
+        # Every run gets its own task descriptions, so results cached by an earlier run are not reused
+        for task in tasks:
+            task['task_description'] += f" (run {run_number})"
+        seed = args.seed + run_number
+        run = {
+            "tasks": task_count,
+            "extraction": await benchmark_extraction(contract_text, contract, seed),
+            "analysis": await benchmark_analysis(contract, tasks, seed)
+        }
+        if not args.skip_endpoints:
+            # Distinct inputs keep the endpoint run from being answered by the caches the agent runs filled
+            endpoint_tasks = [{**task, 'task_description': task['task_description'] + " via api"} for task in tasks]
+            run["endpoints"] = await asyncio.to_thread(
+                benchmark_endpoints, f"{contract_text}\n\nRun {run_number}", contract, endpoint_tasks, seed)
+        print(f"{task_count} tasks: {run['analysis']['wall_time_s']} s, "
+              f"{run['analysis']['throughput_tasks_per_s']} tasks/s, "
+              f"p95 {run['analysis']['result_latency_s']['p95']} s")
+        runs.append(run)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "runs": runs
+    }
+
+
+if __name__ == "__main__":
+    report = asyncio.run(run_benchmarks())
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from urllib.error import URLError
+from typing import List, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that should only be imported when they are needed, not when the app is imported
+HEAVY_MODULES = ("langchain", "langchain_core", "langchain_openai", "openai", "pandas", "docx")
+
+IMPORT_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import backend.app
+import_time = time.perf_counter() - start
+print(json.dumps({"import_time_s": import_time, "heavy_modules": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of the backend: the import time of the app and "
+                                                 "the time until a new worker answers /version.")
+    parser.add_argument('--runs', type=int, default=5, help="Number of times each measurement is repeated")
+    parser.add_argument('--no-warm-up', action='store_true', help="Start the workers without the background warm-up")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for a worker to answer")
+    parser.add_argument('--output', default="startup_results.json", help="Path of the JSON report")
+    return parser.parse_args()
+
+
+def create_environment(warm_up: bool) -> dict:
+    benchmark_dir = tempfile.mkdtemp(prefix="contract_analysis_startup_")
+    environment = dict(os.environ)
+    environment.setdefault('CONTRACT_ANALYSIS_LLM_SECRET', 'benchmark-secret')
+    environment.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+    environment['CONTRACT_ANALYSIS_LLM_CACHE_DIR'] = os.path.join(benchmark_dir, "cache")
+    environment['CONTRACT_ANALYSIS_LLM_DATA_DIR'] = os.path.join(benchmark_dir, "data")
+    environment['CONTRACT_ANALYSIS_LLM_WARM_UP'] = 'true' if warm_up else 'false'
+    environment['PYTHONPATH'] = ROOT_DIR + os.pathsep + environment.get('PYTHONPATH', '')
+    return environment
+
+
+def measure_import(environment: dict) -> dict:
+    # A new interpreter for every run, so no module is cached
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=environment, cwd=ROOT_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, deadline: float, condition=lambda body: True) -> Optional[float]:
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200 and condition(response.read().decode()):
+                    return time.perf_counter()
+        except (URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_worker_start(environment: dict, timeout: float, warm_up: bool) -> dict:
+    port = get_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        env=environment, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = start + timeout
+        first_response = wait_for(f"{base_url}/version", deadline)
+        warm = None
+        if warm_up and first_response is not None:
+            # The warm-up reports its duration as a stage when it is done
+            warm = wait_for(f"{base_url}/metrics", deadline,
+                            lambda body: 'contract_analysis_stage_duration_seconds_count{stage="warm_up"}' in body)
+        return {
+            "time_to_first_version_s": round(first_response - start, 4) if first_response else None,
+            "time_to_warm_s": round(warm - start, 4) if warm else None
+        }
+    finally:
+        worker.terminate()
+        worker.wait(timeout=30)
+
+
+def summarize(values: List[Optional[float]]) -> dict:
+    values = [value for value in values if value is not None]
+    if not values:
+        return {"median": None, "min": None, "max": None}
+    return {"median": round(statistics.median(values), 4), "min": round(min(values), 4),
+            "max": round(max(values), 4)}
+
+
+def main():
+    args = parse_args()
+    warm_up = not args.no_warm_up
+    environment = create_environment(warm_up)
+
+    imports = [measure_import(environment) for _ in range(args.runs)]
+    worker_starts = [measure_worker_start(environment, args.timeout, warm_up) for _ in range(args.runs)]
+
+    report = {
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "import_time_s": summarize([run["import_time_s"] for run in imports]),
+        "heavy_modules_at_import": imports[-1]["heavy_modules"],
+        "time_to_first_version_s": summarize([run["time_to_first_version_s"] for run in worker_starts]),
+        "time_to_warm_s": summarize([run["time_to_warm_s"] for run in worker_starts]) if warm_up else None
+    }
+    print(f"import: {report['import_time_s']['median']} s, first /version: "
+          f"{report['time_to_first_version_s']['median']} s"
+          + (f", warm: {report['time_to_warm_s']['median']} s" if warm_up else ""))
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
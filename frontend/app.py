@@ -1,24 +1,84 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
+import time
 import pandas as pd
+from typing import Optional
 
 # Read the API URL from the environment variable or use localhost as default
 API_URL = os.getenv('CONTRACT_ANALYSIS_LLM_API', 'http://localhost:8008')
+# Number of tasks or results shown per page
+PAGE_SIZE = 50
+JOB_POLL_INTERVAL = 1.0  # seconds
 
 st.title("Contract Analysis LLM")
 
-# Initialize session state for cookies, contract JSON, tasks, and analysis results
-if 'cookies' not in st.session_state:
-    st.session_state.cookies = None
+# Initialize session state for the HTTP session, contract JSON, tasks, and analysis job
+if 'http' not in st.session_state:
+    # One pooled HTTP session per user: its connections are reused across reruns, and it keeps the session cookie
+    # of the backend. It is not shared between users, because the cookie identifies the user's session.
+    st.session_state.http = requests.Session()
+    st.session_state.http.mount(API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=4))
 if 'contract_json' not in st.session_state:
     st.session_state.contract_json = None
-if 'tasks' not in st.session_state:
-    st.session_state.tasks = None
+if 'tasks_total' not in st.session_state:
+    st.session_state.tasks_total = None
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
 if 'analysis_result' not in st.session_state:
     st.session_state.analysis_result = None
 
+http = st.session_state.http
+
+
+def fetch_page(url: str, params: dict, total_field: str, key: str) -> dict:
+    # Fetches only the page that is selected, then shows the page selector for the number of matching items
+    page = st.session_state.get(key, 1)
+    response = http.get(url, params={'offset': (page - 1) * PAGE_SIZE, 'limit': PAGE_SIZE, **params})
+    data = response.json() if response.status_code == 200 else {total_field: 0}
+    page_count = max(1, -(-data[total_field] // PAGE_SIZE))
+    if page > page_count:
+        # The filter changed and the selected page no longer exists
+        st.session_state[key] = 1
+        return fetch_page(url, params, total_field, key)
+    st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, key=key)
+    return data
+
+
+def show_cost_filter(key: str) -> dict:
+    min_cost_column, max_cost_column = st.columns(2)
+    min_cost = min_cost_column.number_input("Minimum cost", min_value=0.0, value=None, key=f"{key}_min_cost")
+    max_cost = max_cost_column.number_input("Maximum cost", min_value=0.0, value=None, key=f"{key}_max_cost")
+    return {name: value for name, value in (('min_cost', min_cost), ('max_cost', max_cost)) if value is not None}
+
+
+def get_task_number(task_index: Optional[int]) -> Optional[int]:
+    return task_index + 1 if task_index is not None else None
+
+
+def show_results(placeholder, page: dict):
+    rows = [{
+        'Task': item['index'] + 1,
+        'Task Description': item['result']['task_description'],
+        'Cost': item['result']['task_cost'],
+        'Compliant': item['result']['compliance'],
+        'Ambiguous': item['result']['ambiguous'],
+        'Cached': item['result'].get('cached', False),
+        'Decided By': item['result'].get('decided_by', 'llm'),
+        # Tasks are numbered from 1, like in the Task column
+        'Cluster': get_task_number(item['result'].get('cluster_id')),
+        'Representative': get_task_number(item['result'].get('representative_index')),
+        'Reasoning': item['result']['reasoning']
+    } for item in page.get('results', [])]
+    with placeholder.container():
+        st.caption(f"{page.get('total_results', 0)} matching results")
+        if rows:
+            st.dataframe(pd.DataFrame(rows), height=300, hide_index=True)
+        else:
+            st.write("No results to display.")
+
 # Step 1: Upload Contract
 st.header("Upload Contract Document")
 contract_file = st.file_uploader("Choose a contract file (DOCX)", type=['docx'], accept_multiple_files=False)
@@ -28,16 +88,15 @@ if contract_file is not None and st.session_state.contract_json is None:
     with st.spinner("Uploading and processing contract..."):
         # Send the file to the backend
         files = {'file': (contract_file.name, contract_file.getvalue(), contract_file.type)}
-        response = requests.post(f"{API_URL}/upload_contract", files=files)
+        response = http.post(f"{API_URL}/upload_contract", files=files)
         if response.status_code == 200:
             data = response.json()
             st.success(f"{data['message']} Filename: {data['contract_filename']}")
 
             # Store the contract JSON
             st.session_state.contract_json = data['contract_json']
-            st.session_state.cookies = response.cookies
         else:
-            st.error("Failed to upload and process contract.")
+            st.error(f"Failed to upload and process contract. Error: {response.json().get('message')}")
 
 # Display the contract JSON if available
 if st.session_state.contract_json is not None:
@@ -61,63 +120,116 @@ if st.session_state.contract_json is not None:
 st.header("Upload Task Descriptions")
 task_file = st.file_uploader("Choose a task file (CSV or XLSX)", type=['csv', 'xlsx'], accept_multiple_files=False)
 
-if task_file is not None and st.session_state.tasks is None:
+if task_file is not None and st.session_state.tasks_total is None:
     # Send the file to the backend
     with st.spinner("Uploading and processing tasks..."):
         files = {'file': (task_file.name, task_file.getvalue(), task_file.type)}
-        response = requests.post(f"{API_URL}/upload_tasks", files=files, cookies=st.session_state.cookies)
-        st.session_state.cookies = response.cookies
+        response = http.post(f"{API_URL}/upload_tasks", files=files)
         if response.status_code == 200:
             data = response.json()
             st.success(f"{data['message']} Tasks uploaded: {data['tasks_uploaded']}")
-            # Store the tasks in the session state
-            tasks_response = requests.get(f"{API_URL}/get_tasks", cookies=st.session_state.cookies)
-            st.session_state.cookies = tasks_response.cookies
-            if tasks_response.status_code == 200:
-                tasks_data = tasks_response.json()
-                st.session_state.tasks = tasks_data.get('tasks', [])
+            if data.get('rows_rejected'):
+                st.warning(f"{data['rows_rejected']} rows were skipped because they could not be read.")
+                st.dataframe(pd.DataFrame(data['row_errors']).rename(columns={'row': 'Row', 'message': 'Error'}))
+            # The tasks stay in the backend; only the page that is shown is fetched
+            st.session_state.tasks_total = data['tasks_uploaded']
+            st.session_state.job_id = None
         else:
             st.error(f"Failed to upload tasks. Error: {response.json().get('message')}")
 
 # Display the tasks if available
-if st.session_state.tasks is not None:
+if st.session_state.tasks_total is not None:
     st.subheader("Uploaded Tasks")
     with st.expander("Show/Hide Tasks", expanded=False):
-        tasks_list = st.session_state.tasks
+        tasks_page = fetch_page(f"{API_URL}/get_tasks", show_cost_filter("tasks"), 'total', "tasks_page")
+        tasks_list = tasks_page.get('tasks', [])
         if tasks_list:
             tasks_df = pd.DataFrame(tasks_list)
+            tasks_df['index'] += 1
             tasks_df.rename(columns={
+                'index': 'Task',
                 'task_description': 'Task Description',
                 'task_cost': 'Cost'
             }, inplace=True)
-            st.dataframe(tasks_df, height=300)
+            st.caption(f"{tasks_page['total']} matching tasks")
+            st.dataframe(tasks_df, height=300, hide_index=True)
         else:
             st.write("No tasks to display.")
 
 # Step 3: Analyze Tasks
-if st.button("Analyze Tasks"):
-    if st.session_state.cookies and st.session_state.tasks:
-        with st.spinner("Analyzing tasks..."):
-            response = requests.get(f"{API_URL}/analyze_tasks", cookies=st.session_state.cookies)
-            st.session_state.cookies = response.cookies
-            if response.status_code == 200:
-                data = response.json()
-                # Store the analysis result
-                st.session_state.analysis_result = json.dumps(data, indent=4)  # Store as a formatted string
-
-                # Display the analysis results in a structured JSON format
-                st.header("Analysis Results")
-                with st.expander("Show/Hide Analysis Details", expanded=False):
-                    st.json(data)
-
-                # Button to download the analysis JSON
-                st.download_button(
-                    label="Download Analysis JSON",
-                    data=st.session_state.analysis_result.encode('utf-8'),  # Encode the string directly to bytes
-                    file_name="analysis_results.json",
-                    mime="application/json"
-                )
-            else:
-                st.error("Failed to analyze tasks. Ensure both contract and tasks are uploaded.")
+estimate_column, analyze_column = st.columns(2)
+if estimate_column.button("Estimate Analysis"):
+    # Dry run: the backend estimates the analysis without calling the LLM
+    response = http.get(f"{API_URL}/estimate_analysis")
+    if response.status_code == 200:
+        estimate = response.json()
+        st.info(f"About {estimate['total_tokens']:,} tokens in {estimate['llm_requests']:,} LLM requests, "
+                f"{estimate['wall_time_s']:,.0f} seconds. {estimate['llm_tasks']:,} of {estimate['tasks']:,} tasks "
+                f"are sent to the LLM.")
+        if estimate['admission'] == 'queue':
+            st.warning(f"The analysis would wait about {estimate['queue_wait_s']:,.0f} seconds for the token budget.")
+        elif estimate['admission'] == 'reject':
+            st.warning("The analysis does not fit the token budget.")
+    else:
+        st.error(f"Failed to estimate the analysis. Error: {response.json().get('message')}")
+
+if analyze_column.button("Analyze Tasks"):
+    if st.session_state.contract_json is not None and st.session_state.tasks_total:
+        # The analysis runs as a background job in the backend, which saves every result as soon as it is available
+        response = http.post(f"{API_URL}/jobs")
+        if response.status_code == 200:
+            st.session_state.job_id = response.json()['job_id']
+            st.session_state.analysis_result = None
+        elif response.status_code == 429:
+            st.error(f"The analysis was not started. {response.json().get('message')}")
+        else:
+            st.error("Failed to analyze tasks. Ensure both contract and tasks are uploaded.")
     else:
         st.error("Please upload tasks before analysis.")
+
+if st.session_state.job_id is not None:
+    job_url = f"{API_URL}/jobs/{st.session_state.job_id}"
+    job = http.get(job_url).json()
+    job_status_placeholder = st.empty()
+
+    # Display a page of the analysis results; the filters are applied by the backend
+    st.header("Analysis Results")
+    compliance_column, ambiguous_column = st.columns(2)
+    flag_options = {"All": None, "Yes": True, "No": False}
+    compliance = flag_options[compliance_column.selectbox("Compliant", list(flag_options), key="results_compliance")]
+    ambiguous = flag_options[ambiguous_column.selectbox("Ambiguous", list(flag_options), key="results_ambiguous")]
+    results_filter = {**show_cost_filter("results"),
+                      **{name: str(value).lower() for name, value in (('compliance', compliance),
+                                                                      ('ambiguous', ambiguous)) if value is not None}}
+    page = fetch_page(f"{job_url}/results", results_filter, 'total_results', "results_page")
+    results_placeholder = st.empty()
+    show_results(results_placeholder, page)
+
+    if job['status'] in ('queued', 'running'):
+        while job['status'] in ('queued', 'running'):
+            job_status_placeholder.progress(job['completed'] / job['total'] if job['total'] else 0.0,
+                                            text=f"Analyzed {job['completed']} of {job['total']} tasks")
+            time.sleep(JOB_POLL_INTERVAL)
+            job = http.get(job_url).json()
+            # The selected page is shown with the results that are available so far
+            page = http.get(f"{job_url}/results",
+                            params={'offset': page.get('offset', 0), 'limit': PAGE_SIZE, **results_filter}).json()
+            show_results(results_placeholder, page)
+        # Rerun, so the page selector counts all results of the job
+        st.rerun()
+    if job['status'] != 'completed':
+        job_status_placeholder.error(f"The analysis {job['status']}. {job.get('error') or ''}")
+
+    # All results are only fetched when a download is requested
+    if st.button("Prepare Analysis JSON"):
+        all_results = http.get(f"{job_url}/results").json()['results']
+        results = [item['result'] for item in sorted(all_results, key=lambda item: item['index'])]
+        st.session_state.analysis_result = json.dumps({'results': results}, indent=4)  # Store as a formatted string
+    if st.session_state.analysis_result is not None:
+        # Button to download the analysis JSON
+        st.download_button(
+            label="Download Analysis JSON",
+            data=st.session_state.analysis_result.encode('utf-8'),  # Encode the string directly to bytes
+            file_name="analysis_results.json",
+            mime="application/json"
+        )
@@ -0,0 +1,72 @@
+from backend.contract_diff import TERM_ADDED, TERM_CHANGED, TERM_REMOVED, TermChange, diff_contracts, match_terms
+from backend.models import Contract, Section, Term
+from backend.term_index import assign_term_ids, flatten_contract_terms
+
+
+def create_contract(terms, definitions=None) -> Contract:
+    contract = Contract(
+        title="Service Agreement",
+        definitions=definitions or {},
+        sections=[Section(title="5. Travel", terms=[Term(title=title, content=content) for title, content in terms])]
+    )
+    assign_term_ids(contract)
+    return contract
+
+
+CAP = ("5.1 Budget Caps", "Total expenses for any single trip must not exceed USD 2,500.")
+PER_DIEM = ("5.2 Per Diem", "Meals are reimbursed with a per diem of USD 60.")
+BOOKING = ("5.3 Booking", "Flights must be booked at least 14 days in advance.")
+
+
+def test_inserted_term_renumbers_ids_but_leaves_the_other_terms_unchanged():
+    old_contract = create_contract([CAP, PER_DIEM])
+    new_contract = create_contract([BOOKING, CAP, PER_DIEM])
+    diff = diff_contracts(old_contract, new_contract)
+    assert diff.changes == [TermChange(TERM_ADDED, None, 0)]
+    assert diff.unchanged_positions == {0: 1, 1: 2}
+    # The ids of the unchanged terms are not the same anymore
+    assert diff.old_terms[0].term.id == "T1"
+    assert diff.new_terms[1].term.id == "T2"
+
+
+def test_formatting_differences_are_unchanged():
+    old_contract = create_contract([CAP])
+    new_contract = create_contract([("5.1  budget caps",
+                                     "total expenses for any single trip\nmust not exceed USD 2,500")])
+    diff = diff_contracts(old_contract, new_contract)
+    assert diff.changes == []
+    assert diff.unchanged_positions == {0: 0}
+
+
+def test_changed_clause_is_matched_by_its_title():
+    old_contract = create_contract([CAP, PER_DIEM])
+    new_contract = create_contract([(CAP[0], "Total expenses for any single trip must not exceed USD 3,000."),
+                                    PER_DIEM])
+    diff = diff_contracts(old_contract, new_contract)
+    assert diff.changes == [TermChange(TERM_CHANGED, 0, 0)]
+    assert diff.unchanged_positions == {1: 1}
+    assert diff.count(TERM_CHANGED) == 1
+
+
+def test_removed_term():
+    diff = diff_contracts(create_contract([CAP, PER_DIEM]), create_contract([PER_DIEM]))
+    assert diff.changes == [TermChange(TERM_REMOVED, 0, None)]
+    assert diff.unchanged_positions == {1: 0}
+
+
+def test_changed_and_removed_definitions():
+    old_contract = create_contract([CAP], {"Client": "ClientProject Inc.", "Site": "The offices of the Client."})
+    new_contract = create_contract([CAP], {"Client": "ClientProject GmbH"})
+    assert diff_contracts(old_contract, new_contract).changed_definitions == ["Client", "Site"]
+
+
+def test_match_terms_with_unique_keys_skips_duplicate_keys():
+    old_terms = flatten_contract_terms(create_contract([CAP, (CAP[0], "Other content."), PER_DIEM]))
+    new_terms = flatten_contract_terms(create_contract([(CAP[0], "New content."), (PER_DIEM[0], "New per diem.")]))
+    unmatched_old = [0, 1, 2]
+    unmatched_new = [0, 1]
+    matches = match_terms(unmatched_old, unmatched_new, lambda indexed_term: indexed_term.term.title,
+                          old_terms, new_terms, unique=True)
+    assert matches == {2: 1}
+    assert unmatched_old == [0, 1]
+    assert unmatched_new == [0]
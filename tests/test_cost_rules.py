@@ -0,0 +1,43 @@
+from backend.cost_rules import CostRuleEngine
+from backend.models import Contract, Section, Term
+from backend.term_index import TermIndex
+
+
+def create_engine() -> CostRuleEngine:
+    contract = Contract(
+        title="Service Agreement",
+        definitions={},
+        sections=[
+            Section(title="4. Events", terms=[
+                Term(id="T1", title="4.1 Catering",
+                     content="Catering for any single event must not exceed USD 1,500.")
+            ]),
+            Section(title="5. General Travel Provisions", terms=[
+                Term(id="T2", title="5.1 Budget Caps",
+                     content="Total expenses for any single trip must not exceed USD 2,500.")
+            ])
+        ]
+    )
+    return CostRuleEngine(TermIndex(contract, contract.model_dump_json()), margin=0.05)
+
+
+def test_decides_task_that_names_the_subject_of_the_rule():
+    result = create_engine().decide("Catering for the kick-off event", 3000)
+    assert result is not None
+    assert result.compliance is False
+    assert [term.id for term in result.applicable_terms] == ["T1"]
+
+
+def test_decides_task_that_names_the_subject_in_the_section_title():
+    result = create_engine().decide("Travel to the client site, single trip", 1000)
+    assert result is not None
+    assert result.compliance is True
+    assert [term.id for term in result.applicable_terms] == ["T2"]
+
+
+def test_leaves_task_that_matches_only_on_a_shared_word_to_the_llm():
+    assert create_engine().decide("Server hardware for single developer", 4000) is None
+
+
+def test_leaves_task_that_matches_only_on_the_event_to_the_llm():
+    assert create_engine().decide("Total cost of event security", 900) is None
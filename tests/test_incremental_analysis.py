@@ -0,0 +1,80 @@
+from typing import List
+
+from backend.incremental_analysis import plan_reanalysis
+from backend.models import Contract, Section, Term, TaskAnalysisResult
+from backend.term_index import assign_term_ids
+
+# More subjects than the retrieval top-k, so each task only retrieves the term of its subject
+SUBJECTS = ["travel", "catering", "hardware", "software", "training", "maintenance", "consulting", "printing",
+            "shipping", "insurance"]
+TASKS = [{'task_description': f"{subject.title()} for the rollout", 'task_cost': 100.0} for subject in SUBJECTS]
+
+
+def create_contract_json(subjects: List[str], contents=None, definitions=None) -> str:
+    contents = contents or {}
+    contract = Contract(
+        title="Service Agreement",
+        definitions=definitions or {},
+        sections=[Section(title="1. Costs", terms=[
+            Term(title=f"{subject.title()} Cap",
+                 content=contents.get(subject, f"Expenses on {subject} are limited to USD 500 per month."))
+            for subject in subjects
+        ])]
+    )
+    assign_term_ids(contract)
+    return contract.model_dump_json()
+
+
+def create_previous_results(contract_json: str) -> dict:
+    contract = Contract.model_validate_json(contract_json)
+    return {
+        task_index: TaskAnalysisResult(task_description=task['task_description'], task_cost=task['task_cost'],
+                                       applicable_terms=[contract.sections[0].terms[task_index]],
+                                       reasoning="Within the cap.", compliance=True, ambiguous=False)
+        for task_index, task in enumerate(TASKS)
+    }
+
+
+def test_inserted_term_carries_the_results_with_the_new_ids():
+    old_contract_json = create_contract_json(SUBJECTS)
+    new_contract_json = create_contract_json(["parking"] + SUBJECTS)
+    plan = plan_reanalysis(old_contract_json, new_contract_json, TASKS, create_previous_results(old_contract_json))
+    assert plan.affected_indices == []
+    assert sorted(plan.carried_results) == list(range(len(TASKS)))
+    # The terms were renumbered by the inserted term, so the carried results refer to the new ids
+    assert plan.carried_results[0].applicable_terms[0].id == "T2"
+    assert plan.carried_results[0].cached
+
+
+def test_changed_clause_affects_the_tasks_that_use_it():
+    old_contract_json = create_contract_json(SUBJECTS)
+    new_contract_json = create_contract_json(SUBJECTS, {"travel": "Expenses on travel are limited to USD 300."})
+    plan = plan_reanalysis(old_contract_json, new_contract_json, TASKS, create_previous_results(old_contract_json))
+    assert plan.affected_indices == [0]
+    assert 0 not in plan.carried_results
+
+
+def test_removed_term_affects_the_tasks_that_used_it():
+    old_contract_json = create_contract_json(SUBJECTS)
+    new_contract_json = create_contract_json(SUBJECTS[:-1])
+    plan = plan_reanalysis(old_contract_json, new_contract_json, TASKS, create_previous_results(old_contract_json))
+    assert plan.affected_indices == [len(SUBJECTS) - 1]
+
+
+def test_changed_definition_affects_the_tasks_that_mention_it():
+    old_contract_json = create_contract_json(SUBJECTS, {"hardware": "Expenses on Equipment are limited to USD 500."},
+                                             {"Equipment": "Laptops and monitors."})
+    new_contract_json = create_contract_json(SUBJECTS, {"hardware": "Expenses on Equipment are limited to USD 500."},
+                                             {"Equipment": "Laptops, monitors and phones."})
+    plan = plan_reanalysis(old_contract_json, new_contract_json, TASKS, create_previous_results(old_contract_json))
+    assert plan.affected_indices == [SUBJECTS.index("hardware")]
+
+
+def test_failed_and_missing_results_are_analyzed_again():
+    contract_json = create_contract_json(SUBJECTS)
+    previous_results = create_previous_results(contract_json)
+    previous_results[1] = previous_results[1].model_copy(update={'failed': True})
+    del previous_results[2]
+    plan = plan_reanalysis(contract_json, contract_json, TASKS, previous_results)
+    assert plan.affected_indices == [1, 2]
+    assert len(plan.carried_results) == len(TASKS) - 2
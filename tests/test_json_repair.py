@@ -0,0 +1,116 @@
+import json
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+
+from backend.json_repair import coerce_contract_data, coerce_task_analysis_data, load_json_with_repair
+
+
+def test_valid_json_needs_no_repairs():
+    assert load_json_with_repair('{"a": [1, 2]}') == ({"a": [1, 2]}, [])
+
+
+def test_removes_trailing_commas():
+    data, repairs = load_json_with_repair('{"a": [1, 2,], "b": 3,}')
+    assert data == {"a": [1, 2], "b": 3}
+    assert repairs == ["removed trailing comma"]
+
+
+def test_commas_in_strings_are_kept():
+    data, _ = load_json_with_repair('{"a": "x,}", "b": 1,}')
+    assert data == {"a": "x,}", "b": 1}
+
+
+def test_closes_truncated_brackets():
+    data, repairs = load_json_with_repair('{"results": [{"index": 1, "compliance": true}, {"index": 2')
+    assert data == {"results": [{"index": 1, "compliance": True}, {"index": 2}]}
+    assert "closed truncated JSON" in repairs
+
+
+def test_drops_truncated_element():
+    data, repairs = load_json_with_repair('{"a": 1, "b": tr')
+    assert data == {"a": 1}
+    assert "dropped truncated element" in repairs
+
+
+def test_replaces_python_literals():
+    data, repairs = load_json_with_repair('{"compliance": True, "ambiguous": False, "reason": None}')
+    assert data == {"compliance": True, "ambiguous": False, "reason": None}
+    assert repairs == ["replaced Python literal"]
+
+
+def test_python_literals_in_strings_are_kept():
+    data, _ = load_json_with_repair('{"reasoning": "True to the contract", "ok": True}')
+    assert data == {"reasoning": "True to the contract", "ok": True}
+
+
+def test_removes_text_around_json():
+    data, repairs = load_json_with_repair('Here is the result:\n```json\n{"a": 1}\n```\nLet me know.')
+    assert data == {"a": 1}
+    assert "removed text around JSON" in repairs
+
+
+@pytest.mark.parametrize("text", ['{"a": 1, é}', '{"reasoning": "ok", naïve: 1}'])
+def test_non_ascii_words_outside_strings(text):
+    # A non-ASCII word outside a string is invalid; it is either dropped or the original error is raised
+    try:
+        data, _ = load_json_with_repair(text)
+    except json.JSONDecodeError:
+        return
+    assert isinstance(data, dict)
+
+
+def test_non_ascii_text_in_strings_is_kept():
+    data, repairs = load_json_with_repair('{"reasoning": "naïve café", "ok": True,}')
+    assert data == {"reasoning": "naïve café", "ok": True}
+
+
+def test_unrepairable_text_raises_original_error():
+    with pytest.raises(json.JSONDecodeError):
+        load_json_with_repair("no json here")
+
+
+@pytest.mark.parametrize("task_cost, expected", [("$2,800", 2800.0), ("2.800,50 EUR", 2800.5), ("USD 2800", 2800.0)])
+def test_converts_task_cost_to_a_number(task_cost, expected):
+    data = {"task_cost": task_cost}
+    assert coerce_task_analysis_data(data, "") == ["converted task_cost to a number"]
+    assert data["task_cost"] == expected
+
+
+def test_converts_flags_and_term_ids():
+    data = {"compliance": "yes", "ambiguous": "False", "applicable_term_ids": [3, " T4 ", "5"], "reasoning": None}
+    repairs = coerce_task_analysis_data(data, "")
+    assert data == {"compliance": True, "ambiguous": False, "applicable_term_ids": ["T3", "T4", "T5"],
+                    "reasoning": ""}
+    assert "converted compliance to a boolean" in repairs
+    assert "replaced null reasoning" in repairs
+
+
+def test_converts_copied_terms_to_ids():
+    data = {"applicable_terms": [{"id": "T2", "title": "Cap", "content": "..."}]}
+    assert "converted applicable_terms to ids" in coerce_task_analysis_data(data, "")
+    assert data == {"applicable_term_ids": ["T2"]}
+
+
+def test_copied_terms_without_ids_are_sent_back_to_the_llm():
+    data = {"applicable_terms": [{"title": "Cap", "content": "..."}]}
+    with pytest.raises(OutputParserException) as exc_info:
+        coerce_task_analysis_data(data, "llm output")
+    assert exc_info.value.send_to_llm
+    assert exc_info.value.llm_output == "llm output"
+
+
+def test_coerces_contract_data():
+    data = {
+        "title": None,
+        "definitions": [{"term": "Client", "definition": "ClientProject Inc."}],
+        "sections": [{"title": "1. Travel", "terms": [{"title": "1.1 Cap", "content": None}]}]
+    }
+    repairs = coerce_contract_data(data)
+    assert data == {
+        "title": "",
+        "definitions": {"Client": "ClientProject Inc."},
+        "sections": [{"title": "1. Travel", "terms": [{"title": "1.1 Cap", "content": ""}], "subsections": []}]
+    }
+    assert set(repairs) == {"added empty title", "converted definitions list to an object", "added empty term content",
+                            "added empty subsections"}